@@ -1,5 +1,18 @@
+import argparse
+import base64
+import hashlib
+import hmac
+import os
+import time
+import zlib
+import ujson
 from cryptography.fernet import Fernet
 from pointy.utils import JsonFileWrapper, ApiError
+from pointy.metrics import METRICS
+
+CREDENTIALS_TTL = 300
+SESSION_TTL = 3600
+SHARD_COUNT = 64
 
 
 def to_bytes(s):
@@ -8,61 +21,135 @@ def to_bytes(s):
 
 
 class AccountRegister:
+    """
+    Accounts, their passwords and the apps they may use.
+
+    Passwords which were checked recently are remembered (as a hash) for
+    credentials_ttl seconds, so repeat checks skip decryption. Alternatively
+    clients can log in once for a session token, which is verified with an
+    HMAC alone. Changing the password or removing the app invalidates both.
+    """
 
-    def __init__(self, secret_key, db_path):
+    def __init__(self, secret_key, db_path, credentials_ttl=CREDENTIALS_TTL,
+                 session_ttl=SESSION_TTL):
         self._db = JsonFileWrapper(db_path, {'accounts': {}})
         self._data = None
         self._cipher_suite = Fernet(to_bytes(secret_key))
+        self._session_key = hashlib.sha256(b'session:' + to_bytes(secret_key)).digest()
+        self._credentials_ttl = credentials_ttl
+        self._session_ttl = session_ttl
+        self._verified_credentials = {}
 
     def create_user(self, username, password):
-        self._load()
-        if username in self._data['accounts']:
+        accounts = self._accounts(username)
+        if username in accounts:
             raise ApiError(code="account_exists")
-        self._data['accounts'][username] = {
+        accounts[username] = {
             'password': self._encrypt(password),
             'apps': []
         }
-        self._save()
+        self._save(username)
 
     def user_exists(self, username):
-        try:
-            self._assert_user_exists(username)
-            return True
-        except ApiError:
-            return False
+        return username in self._accounts(username)
 
     def has_account_for_app(self, username, app):
-        self._assert_user_exists(username)
-        return username in self._data['accounts'] and app in self._data['accounts'][username]['apps']
+        return app in self._get_account(username)['apps']
 
     def add_user_app(self, username, app):
-        self._assert_user_exists(username)
-        apps_list = self._data['accounts'][username]['apps']
+        apps_list = self._get_account(username)['apps']
         if app not in apps_list:
             apps_list.append(app)
-        self._save()
+        self._save(username)
 
     def remove_user_app(self, username, app):
-        self._assert_user_exists(username)
-        apps_list = self._data['accounts'][username]['apps']
+        apps_list = self._get_account(username)['apps']
         if app in apps_list:
             apps_list.remove(app)
-        self._save()
+        self._end_sessions(username)
+        self._save(username)
 
     def change_password(self, username, password):
-        self._assert_user_exists(username)
-        self._data['accounts'][username]['password'] = self._encrypt(password)
-        self._save()
+        self._get_account(username)['password'] = self._encrypt(password)
+        self._end_sessions(username)
+        self._save(username)
 
     def password_matches(self, username, password):
-        self._assert_user_exists(username)
-        saved = self._decrypt(self._data['accounts'][username]['password'])
-        return saved == to_bytes(password)
-
-    def _assert_user_exists(self, username):
-        self._load()
-        if username not in self._data['accounts']:
+        with METRICS.timer('pointy_auth_seconds', method='password'):
+            return self._password_matches(username, password)
+
+    def _password_matches(self, username, password):
+        account = self._get_account(username)
+        digest = hashlib.sha256(to_bytes(password)).digest()
+        cached = self._verified_credentials.get(username)
+        if cached is not None:
+            cached_digest, encrypted, expires = cached
+            # The stored password is compared too, in case it was changed by
+            # another process
+            if expires > time.time() and encrypted == account['password'] \
+                    and hmac.compare_digest(cached_digest, digest):
+                METRICS.inc('pointy_auth_checks_total', method='password', result='remembered')
+                return True
+        METRICS.inc('pointy_auth_checks_total', method='password', result='decrypted')
+        saved = self._decrypt(account['password'])
+        matches = saved == to_bytes(password)
+        if matches:
+            self._verified_credentials[username] = (
+                digest, account['password'], time.time() + self._credentials_ttl)
+        return matches
+
+    def issue_session_token(self, username, app):
+        """
+        Returns a signed token with which username may use app until it
+        expires. Check the password first.
+        """
+        expires = int(time.time()) + self._session_ttl
+        session = self._get_account(username).get('session', 0)
+        payload = base64.urlsafe_b64encode(
+            to_bytes(ujson.dumps([username, app, expires, session])))
+        return {'token': '{}.{}'.format(str(payload, 'utf-8'), self._sign(payload)),
+                'expires': expires}
+
+    def verify_session_token(self, token, app):
+        """
+        Returns the username the token was issued to, or raises ApiError.
+        """
+        with METRICS.timer('pointy_auth_seconds', method='session'):
+            return self._verify_session_token(token, app)
+
+    def _verify_session_token(self, token, app):
+        try:
+            payload, signature = to_bytes(token).split(b'.')
+            valid = hmac.compare_digest(self._sign(payload), str(signature, 'utf-8'))
+            username, token_app, expires, session = ujson.loads(base64.urlsafe_b64decode(payload))
+        except (ValueError, TypeError):
+            valid = False
+        if not valid or token_app != app:
+            raise ApiError(code="invalid_session")
+        if expires < time.time():
+            raise ApiError(code="session_expired")
+        account = self._accounts(username).get(username)
+        if account is None or app not in account['apps'] \
+                or account.get('session', 0) != session:
+            raise ApiError(code="invalid_session")
+        return username
+
+    def _end_sessions(self, username):
+        """
+        Invalidates the user's session tokens and remembered password.
+        """
+        account = self._get_account(username)
+        account['session'] = account.get('session', 0) + 1
+        self._verified_credentials.pop(username, None)
+
+    def _sign(self, payload):
+        return hmac.new(self._session_key, payload, hashlib.sha256).hexdigest()
+
+    def _get_account(self, username):
+        accounts = self._accounts(username)
+        if username not in accounts:
             raise ApiError(code="account_not_found")
+        return accounts[username]
 
     def _encrypt(self, password):
         return self._cipher_suite.encrypt(to_bytes(password))
@@ -70,8 +157,81 @@ class AccountRegister:
     def _decrypt(self, password):
         return self._cipher_suite.decrypt(password)
 
-    def _load(self):
+    def _accounts(self, username):
+        """
+        Returns the dict of accounts which holds (or would hold) username.
+        """
         self._data = self._db.load()
-
-    def _save(self):
-        self._db.save()
\ No newline at end of file
+        return self._data['accounts']
+
+    def _save(self, username):
+        self._db.save()
+
+
+class ShardedAccountRegister(AccountRegister):
+    """
+    An AccountRegister whose accounts are spread over shard_count files in
+    db_dir by a hash of the username, so each lookup parses and each write
+    rewrites just one shard. Shards are loaded on first use and then only
+    parsed again if they change on disk.
+
+    The shard count is stored in db_dir the first time, and that stored
+    count is used from then on. Use migrate_to_shards to move accounts over
+    from a single file register.
+    """
+
+    def __init__(self, secret_key, db_dir, shard_count=SHARD_COUNT,
+                 credentials_ttl=CREDENTIALS_TTL, session_ttl=SESSION_TTL):
+        super().__init__(secret_key, os.path.join(db_dir, 'shards.json'),
+                         credentials_ttl, session_ttl)
+        os.makedirs(db_dir, exist_ok=True)
+        self._db_dir = db_dir
+        self._db = JsonFileWrapper(os.path.join(db_dir, 'shards.json'),
+                                   {'shard_count': shard_count})
+        self._shard_count = self._db.load()['shard_count']
+        self._shards = {}
+
+    def _accounts(self, username):
+        return self._shard(username).load()['accounts']
+
+    def _save(self, username):
+        self._shard(username).save()
+
+    def _shard(self, username):
+        number = shard_number(username, self._shard_count)
+        if number not in self._shards:
+            filepath = os.path.join(self._db_dir, 'accounts_{}.json'.format(number))
+            self._shards[number] = JsonFileWrapper(filepath, {'accounts': {}})
+        return self._shards[number]
+
+
+def shard_number(username, shard_count):
+    return zlib.crc32(to_bytes(username)) % shard_count
+
+
+def migrate_to_shards(db_path, db_dir, shard_count=SHARD_COUNT):
+    """
+    Copies the accounts of a single file register into a new sharded one,
+    writing each shard once. Passwords are copied still encrypted.
+    """
+    if os.path.exists(os.path.join(db_dir, 'shards.json')):
+        raise ValueError('{} already holds a sharded register'.format(db_dir))
+    os.makedirs(db_dir, exist_ok=True)
+    accounts = JsonFileWrapper(db_path).load()['accounts']
+    shards = {}
+    for username, account in accounts.items():
+        shard = shards.setdefault(shard_number(username, shard_count), {})
+        shard[username] = account
+    for number, shard in shards.items():
+        filepath = os.path.join(db_dir, 'accounts_{}.json'.format(number))
+        JsonFileWrapper(filepath).save({'accounts': shard})
+    JsonFileWrapper(os.path.join(db_dir, 'shards.json')).save({'shard_count': shard_count})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migrate accounts to a sharded register')
+    parser.add_argument('db_path', help='The single accounts json file')
+    parser.add_argument('db_dir', help='Directory for the shards')
+    parser.add_argument('--shards', type=int, default=SHARD_COUNT)
+    args = parser.parse_args()
+    migrate_to_shards(args.db_path, args.db_dir, args.shards)
@@ -0,0 +1,318 @@
+"""
+Asyncio serving mode: an ASGI application exposing the same
+POST /<app>/<method> API as bottle_app, run with any ASGI server, e.g.
+
+    uvicorn asgi_app:application
+
+Requests for different stores run concurrently, while those for the same
+store are serialized by a per store lock. Storage calls, which may read or
+write files, run in a thread pool so they never block the event loop.
+
+Watches (POST /<app>/watch, or GET for server-sent events) wait on the
+event loop rather than in the pool, and only take the store's lock to check
+its revision.
+"""
+import asyncio
+import concurrent.futures
+import urllib.parse
+import weakref
+import ujson
+from bottle import HTTPError
+from bottle_app import validate_app_method, authenticate, issue_session, get_storage, failure, \
+    metric_labels, RESPONSE_CACHE, SSE_KEEPALIVE, VALID_APPS, JSON_STORES, CORS_ALLOW_HEADERS, \
+    CORS_EXPOSE_HEADERS
+from http_cache import is_cacheable, conditional_call
+from pointy.utils import iter_json_chunks, dumps_response, iter_lines, join_chunks
+from pointy.metrics import METRICS
+from pointy.json_storage import WATCH_MAX_TIMEOUT
+
+EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=16)
+# How often a watch checks its store wasn't evicted and opened again
+WATCH_STORE_CHECK_INTERVAL = 1.0
+# Locks go once no request holds or waits for them
+STORE_LOCKS = weakref.WeakValueDictionary()
+
+
+def get_store_lock(key):
+    # No await between the lookup and insert, so no other task can interleave
+    lock = STORE_LOCKS.get(key)
+    if lock is None:
+        lock = STORE_LOCKS[key] = asyncio.Lock()
+    return lock
+
+
+async def application(scope, receive, send):
+    if scope['type'] != 'http':
+        return
+    headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope['headers']}
+    if scope['method'] == 'OPTIONS':
+        await respond(send, 200, b'')
+        return
+    if scope['method'] == 'GET' and scope['path'] == '/metrics':
+        await respond(send, 200, METRICS.render().encode('utf-8'), 'text/plain; version=0.0.4')
+        return
+    chunks = scope['path'].strip('/').split('/')
+    if scope['method'] == 'GET' and len(chunks) == 2 and chunks[1] == 'watch':
+        await watch_events(receive, send, chunks[0], headers, scope.get('query_string', b''))
+        return
+    if scope['method'] == 'GET' and len(chunks) == 2 and chunks[1] == 'export':
+        await export_records(send, chunks[0], headers, scope.get('query_string', b''))
+        return
+    if scope['method'] == 'POST' and len(chunks) == 2 and chunks[1] == 'login':
+        await login(send, chunks[0], headers)
+        return
+    if scope['method'] == 'POST' and len(chunks) == 2 and chunks[1] == 'import':
+        await import_records(receive, send, chunks[0], headers)
+        return
+    if scope['method'] != 'POST' or len(chunks) != 2:
+        await respond(send, 404, b'Not found', 'text/plain')
+        return
+    app, method = chunks
+    body = await read_body(receive)
+    stream = b'stream=1' in scope.get('query_string', b'').split(b'&')
+    with METRICS.timer('pointy_request_seconds', **metric_labels(app, method)):
+        await storage_call(send, app, method, body, headers, stream)
+
+
+async def storage_call(send, app, method, body, headers, stream):
+    """
+    Equivalent of bottle_app.wrap_storage_call.
+    """
+    loop = asyncio.get_event_loop()
+    try:
+        params = ujson.loads(body) if body else {}
+        validate_app_method(app, method)
+        # Authentication may read the accounts file, so it goes to a thread
+        user = await loop.run_in_executor(
+            EXECUTOR, authenticate, app,
+            headers.get('authorization'), headers.get('x-session-token'))
+        storage = get_storage(app, user)
+        stream = stream and method == 'push_actions'
+        if stream:
+            params = dict(params, stream=True)
+        if method == 'watch':
+            result = {
+                "status" : "success",
+                "data" : await watch((app, user), **params)
+            }
+            await respond(send, 200, dumps_response(result).encode('utf-8'))
+            return
+        async with get_store_lock((app, user)):
+            if not stream and is_cacheable(method, params):
+                status, extra_headers, body = await loop.run_in_executor(
+                    EXECUTOR, conditional_call, RESPONSE_CACHE, app, user, storage, method, params,
+                    headers.get('if-none-match'), headers.get('accept-encoding'))
+                content_type = extra_headers.pop('Content-Type', 'application/json')
+                await respond(send, status, body, content_type, extra_headers)
+                return
+            result = await loop.run_in_executor(EXECUTOR, lambda: getattr(storage, method)(**params))
+        result = {
+            "status" : "success",
+            "data" : result
+        }
+        if stream:
+            # Streamed results walk copies, so are sent without the lock
+            await respond_stream(send, iter_json_chunks(result), loop)
+            return
+    except HTTPError as e:
+        await respond(send, e.status_code, str(e.body).encode('utf-8'), 'text/plain', e.headers)
+        return
+    except BaseException as e:
+        result = failure(e)
+    await respond(send, 200, dumps_response(result).encode('utf-8'))
+
+
+async def watch(key, revision, timeout=30, delta=False):
+    """
+    Equivalent of the store's watch(), woken by a save listener. The store
+    is looked up again each time round, so a watch outlives its store being
+    evicted from JSON_STORES and opened again.
+    """
+    loop = asyncio.get_event_loop()
+    saved = asyncio.Event()
+
+    def listener():
+        loop.call_soon_threadsafe(saved.set)
+
+    storage = get_storage(*key)
+    storage.add_save_listener(listener)
+    try:
+        deadline = loop.time() + min(float(timeout), WATCH_MAX_TIMEOUT)
+        while True:
+            saved.clear()
+            if JSON_STORES.peek(key) is not storage:
+                storage.remove_save_listener(listener)
+                storage = get_storage(*key)
+                storage.add_save_listener(listener)
+            async with get_store_lock(key):
+                result = await loop.run_in_executor(EXECUTOR, storage.revision_moved, revision, delta)
+            remaining = deadline - loop.time()
+            if result is not None or remaining <= 0:
+                return result or {'revision': storage.revision}
+            remaining = min(remaining, storage.watch_poll_interval or WATCH_STORE_CHECK_INTERVAL)
+            try:
+                await asyncio.wait_for(saved.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        storage.remove_save_listener(listener)
+
+
+async def watch_events(receive, send, app, headers, query_string):
+    """
+    Equivalent of bottle_app.watch_events.
+    """
+    loop = asyncio.get_event_loop()
+    query = urllib.parse.parse_qs(query_string.decode('latin-1'))
+    try:
+        validate_app_method(app, 'watch')
+        token = headers.get('x-session-token') or query.get('token', [None])[0]
+        user = await loop.run_in_executor(
+            EXECUTOR, authenticate, app, headers.get('authorization'), token)
+        revision = query.get('revision', [None])[0]
+        if revision is not None:
+            try:
+                revision = int(revision)
+            except ValueError:
+                raise HTTPError(400, 'revision must be an integer')
+    except HTTPError as e:
+        await respond(send, e.status_code, str(e.body).encode('utf-8'), 'text/plain', e.headers)
+        return
+    storage = get_storage(app, user)
+    delta = query.get('delta') == ['1']
+    if revision is None:
+        async with get_store_lock((app, user)):
+            revision = (await loop.run_in_executor(EXECUTOR, storage.revision_moved, -1))['revision']
+    await send({'type': 'http.response.start', 'status': 200, 'headers': cors_headers() + [
+        (b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache')]})
+    # A GET has no body, so the next message is the client disconnecting
+    disconnected = asyncio.ensure_future(receive())
+    while not disconnected.done():
+        result = await watch((app, user), revision, SSE_KEEPALIVE, delta)
+        if result['revision'] != revision:
+            revision = result['revision']
+            event = 'event: revision\ndata: {}\n\n'.format(dumps_response(result))
+        else:
+            event = ': keepalive\n\n'
+        await send({'type': 'http.response.body', 'body': event.encode('utf-8'), 'more_body': True})
+
+
+async def login(send, app, headers):
+    """
+    Equivalent of bottle_app.login.
+    """
+    loop = asyncio.get_event_loop()
+    try:
+        if app not in VALID_APPS:
+            raise HTTPError(404, 'App {} does not exist'.format(app))
+        token = await loop.run_in_executor(EXECUTOR, issue_session, app, headers.get('authorization'))
+    except HTTPError as e:
+        await respond(send, e.status_code, str(e.body).encode('utf-8'), 'text/plain', e.headers)
+        return
+    result = {
+        "status" : "success",
+        "data" : token
+    }
+    await respond(send, 200, dumps_response(result).encode('utf-8'))
+
+
+async def export_records(send, app, headers, query_string):
+    """
+    Equivalent of bottle_app.export_records.
+    """
+    loop = asyncio.get_event_loop()
+    query = urllib.parse.parse_qs(query_string.decode('latin-1'))
+    try:
+        if app not in VALID_APPS:
+            raise HTTPError(404, 'App {} does not exist'.format(app))
+        user = await loop.run_in_executor(
+            EXECUTOR, authenticate, app,
+            headers.get('authorization'), headers.get('x-session-token'))
+    except HTTPError as e:
+        await respond(send, e.status_code, str(e.body).encode('utf-8'), 'text/plain', e.headers)
+        return
+    storage = get_storage(app, user)
+    # The export streams from a copy, so the lock is only needed to take it
+    async with get_store_lock((app, user)):
+        lines = await loop.run_in_executor(EXECUTOR, storage.export_records, query.get('path', [''])[0])
+    await respond_stream(send, join_chunks(lines), loop, 'application/x-ndjson')
+
+
+async def import_records(receive, send, app, headers):
+    """
+    Equivalent of bottle_app.import_records. The body is passed to the
+    import as it arrives, rather than read in full first.
+    """
+    loop = asyncio.get_event_loop()
+    more_body = [True]
+
+    async def receive_chunk():
+        if not more_body[0]:
+            return b''
+        message = await receive()
+        more_body[0] = message.get('more_body', False)
+        return message.get('body', b'')
+
+    def read(size):
+        # Called from the executor thread, with the event loop free to receive
+        return asyncio.run_coroutine_threadsafe(receive_chunk(), loop).result()
+
+    try:
+        if app not in VALID_APPS:
+            raise HTTPError(404, 'App {} does not exist'.format(app))
+        user = await loop.run_in_executor(
+            EXECUTOR, authenticate, app,
+            headers.get('authorization'), headers.get('x-session-token'))
+        storage = get_storage(app, user)
+        with METRICS.timer('pointy_request_seconds', app=app, method='import_records'):
+            async with get_store_lock((app, user)):
+                result = await loop.run_in_executor(
+                    EXECUTOR, lambda: storage.import_records(iter_lines(read)))
+        result = {
+            "status" : "success",
+            "data" : result
+        }
+    except HTTPError as e:
+        await respond(send, e.status_code, str(e.body).encode('utf-8'), 'text/plain', e.headers)
+        return
+    except BaseException as e:
+        result = failure(e)
+    await respond(send, 200, dumps_response(result).encode('utf-8'))
+
+
+async def read_body(receive):
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return body
+
+
+def cors_headers():
+    return [
+        (b'access-control-allow-origin', b'*'),
+        (b'access-control-allow-methods', b'PUT, GET, POST, DELETE, OPTIONS'),
+        (b'access-control-allow-headers', CORS_ALLOW_HEADERS.encode('latin-1')),
+        (b'access-control-expose-headers', CORS_EXPOSE_HEADERS.encode('latin-1')),
+    ]
+
+
+async def respond(send, status, body, content_type='application/json', extra_headers=None):
+    headers = cors_headers() + [(b'content-type', content_type.encode('latin-1'))]
+    for name, value in (extra_headers or {}).items():
+        headers.append((name.lower().encode('latin-1'), value.encode('latin-1')))
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def respond_stream(send, chunks, loop, content_type='application/json'):
+    headers = cors_headers() + [(b'content-type', content_type.encode('latin-1'))]
+    await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+    while True:
+        chunk = await loop.run_in_executor(EXECUTOR, next, chunks, None)
+        if chunk is None:
+            break
+        await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
@@ -0,0 +1,156 @@
+"""
+Point-in-time backups of every store under a base directory (bottle_app's
+JSON_BASE), taken with the stores' snapshot() so they can stay in use:
+
+    python -m pointy.backup snapshot /home/andyhasit/pointy/json_dbs /backups/today --concurrency 4
+
+writes one gzipped snapshot per store, as <dest_dir>/<app>/<user>.json.gz.
+A snapshot is restored into a new store directory with:
+
+    python -m pointy.backup restore /backups/today/pointy_v2/tim.json.gz /path/to/store
+
+Stores are opened read only (as replicas are), so taking a snapshot never
+writes to a store's files. Pass --multiprocess when the stores are served in
+multiprocess mode, so each snapshot is taken under the store's lock.
+Otherwise a store is read again if its files changed while it was read, so
+the data never comes from one save and the revision from another.
+"""
+import argparse
+import concurrent.futures
+import gzip
+import os
+import ujson
+from pointy.json_storage import REV_KEY, LAST_ID_KEY
+from pointy.replication import open_replica_dir
+from pointy.utils import atomic_write, file_signature, FileLock
+from pointy.metrics import METRICS
+
+SNAPSHOT_CONCURRENCY = 4
+# Times to read a store changing underfoot before giving up on it
+SNAPSHOT_ATTEMPTS = 5
+
+
+def find_store_dirs(base_dir):
+    """
+    The store directories under base_dir, laid out as <app>/<user>, as
+    (app, user, store_dir).
+    """
+    for app in sorted(os.listdir(base_dir)):
+        app_dir = os.path.join(base_dir, app)
+        if not os.path.isdir(app_dir):
+            continue
+        for user in sorted(os.listdir(app_dir)):
+            store_dir = os.path.join(app_dir, user)
+            if os.path.exists(os.path.join(store_dir, 'meta_data.json')):
+                yield app, user, store_dir
+
+
+def store_signature(store_dir):
+    """
+    The signatures of the files in store_dir, which change with each save.
+    """
+    signatures = {}
+    for dirpath, dirnames, filenames in os.walk(store_dir):
+        for name in filenames:
+            filepath = os.path.join(dirpath, name)
+            try:
+                signatures[filepath] = file_signature(os.stat(filepath))
+            except FileNotFoundError:
+                pass
+    return signatures
+
+
+def open_unchanging(store_dir):
+    """
+    Opens and loads the store in store_dir (read only), trying again if its
+    files change while they're read.
+    """
+    for attempt in range(SNAPSHOT_ATTEMPTS):
+        before = store_signature(store_dir)
+        store = open_replica_dir(store_dir)
+        store.load()
+        if store_signature(store_dir) == before:
+            return store
+    raise RuntimeError('{} kept changing while it was read'.format(store_dir))
+
+
+def snapshot_all(base_dir, dest_dir, concurrency=SNAPSHOT_CONCURRENCY, multiprocess=False):
+    """
+    Snapshots every store under base_dir into dest_dir, at most concurrency
+    at a time. Returns a dict of store_dir to the snapshot's revision and
+    last id, or to the exception raised taking it.
+    """
+    def take_snapshot(app, user, store_dir):
+        os.makedirs(os.path.join(dest_dir, app), exist_ok=True)
+        archive_path = os.path.join(dest_dir, app, user + '.json.gz')
+        if not multiprocess:
+            return open_unchanging(store_dir).snapshot(archive_path).result()
+        # Multiprocess stores are fully saved before the lock is released.
+        # Only the copy needs the lock, the archive is written after
+        lock = FileLock(os.path.join(store_dir, 'meta_data.json.lock'))
+        lock.acquire()
+        try:
+            future = open_replica_dir(store_dir).snapshot(archive_path)
+        finally:
+            lock.release()
+        return future.result()
+
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {
+            executor.submit(take_snapshot, app, user, store_dir): store_dir
+            for app, user, store_dir in find_store_dirs(base_dir)
+        }
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                results[futures[future]] = future.result()
+                METRICS.inc('pointy_snapshots_total', outcome='written')
+            except Exception as e:
+                results[futures[future]] = e
+                METRICS.inc('pointy_snapshots_total', outcome='failed')
+    return results
+
+
+def restore(archive_path, store_dir):
+    """
+    Writes a snapshot out as a store in store_dir, which mustn't hold one.
+    The store has no journal, so clients will need to resync.
+    """
+    if os.path.exists(os.path.join(store_dir, 'meta_data.json')):
+        raise ValueError('{} already holds a store'.format(store_dir))
+    with gzip.open(archive_path, 'rt') as fp:
+        snapshot = ujson.load(fp)
+    os.makedirs(store_dir, exist_ok=True)
+    atomic_write(os.path.join(store_dir, 'data.json'), ujson.dumps(snapshot['data'], indent=4))
+    atomic_write(os.path.join(store_dir, 'meta_data.json'), ujson.dumps(
+        {REV_KEY: snapshot['rev'], LAST_ID_KEY: snapshot['last_id']}, indent=4))
+    return {'revision': snapshot['rev'], 'last_id': snapshot['last_id']}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Online snapshots of stores, and restoring them')
+    commands = parser.add_subparsers(dest='command', required=True)
+    snapshot_parser = commands.add_parser('snapshot', help='Snapshot every store under base_dir')
+    snapshot_parser.add_argument('base_dir', help='The directory holding the stores (JSON_BASE)')
+    snapshot_parser.add_argument('dest_dir', help='The directory to write the snapshots to')
+    snapshot_parser.add_argument('--concurrency', type=int, default=SNAPSHOT_CONCURRENCY,
+                                 help='How many stores to snapshot at once')
+    snapshot_parser.add_argument('--multiprocess', action='store_true',
+                                 help='Lock each store, as when served in multiprocess mode')
+    restore_parser = commands.add_parser('restore', help='Restore a snapshot as a new store')
+    restore_parser.add_argument('archive', help='The snapshot file')
+    restore_parser.add_argument('store_dir', help='The directory to create the store in')
+    args = parser.parse_args()
+    if args.command == 'snapshot':
+        failed = 0
+        for store_dir, result in sorted(snapshot_all(
+                args.base_dir, args.dest_dir, args.concurrency, args.multiprocess).items()):
+            if isinstance(result, Exception):
+                failed += 1
+                print('{}: failed: {!r}'.format(store_dir, result))
+            else:
+                print('{}: revision {}'.format(store_dir, result['revision']))
+        parser.exit(1 if failed else 0)
+    else:
+        result = restore(args.archive, args.store_dir)
+        print('Restored revision {}'.format(result['revision']))
@@ -0,0 +1,83 @@
+"""
+Compares the throughput of the asyncio app (asgi_app) with the WSGI app
+(bottle_app, one request at a time as in a single threaded worker), both
+driven in-process without a network.
+
+    python -m pointy.benchmarks.asgi_load [--users 8] [--requests 100]
+"""
+import argparse
+import asyncio
+import shutil
+import tempfile
+import time
+import ujson
+from pointy.benchmarks.in_process import APP, setup_apps, auth_header, wsgi_call
+import asgi_app
+
+
+def push_body(i):
+    return ujson.dumps({
+        'revision': i,
+        'action_sets': {
+            'create': {'a': {'path': 'records', 'record': {'n': i}}},
+            'read': {'recent': {'path': 'records', 'sort': '-n', 'limit': 10}},
+        }
+    }).encode('utf-8')
+
+
+def run_wsgi(users, requests):
+    start = time.perf_counter()
+    for i in range(requests):
+        for user in users:
+            wsgi_call(user, 'push_actions', push_body(i))
+    return len(users) * requests / (time.perf_counter() - start)
+
+
+def run_asgi(users, requests):
+    async def call(user, body):
+        scope = {
+            'type': 'http',
+            'method': 'POST',
+            'path': '/{}/push_actions'.format(APP),
+            'query_string': b'',
+            'headers': [(b'authorization', auth_header(user).encode('latin-1'))],
+        }
+
+        async def receive():
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        async def send(message):
+            pass
+
+        await asgi_app.application(scope, receive, send)
+
+    async def client(user):
+        for i in range(requests):
+            await call(user, push_body(i))
+
+    async def main():
+        await asyncio.gather(*[client(user) for user in users])
+
+    start = time.perf_counter()
+    asyncio.run(main())
+    return len(users) * requests / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=100)
+    args = parser.parse_args()
+    users = ['user{}'.format(i) for i in range(args.users)]
+    print('{:<6}{:>14}'.format('app', 'requests/sec'))
+    for name, run in (('wsgi', run_wsgi), ('asgi', run_asgi)):
+        base_dir = tempfile.mkdtemp()
+        try:
+            setup_apps(base_dir, users)
+            print('{:<6}{:>14.0f}'.format(name, run(users, args.requests)))
+        finally:
+            shutil.rmtree(base_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+Measures pushes/sec at each durability level with concurrent clients, each
+pushing to their own store as separate users would.
+
+    python -m pointy.benchmarks.group_commit [--clients 8] [--pushes 200]
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+import time
+from pointy.json_storage import MyJsonStorageHandler
+from pointy.utils import GroupCommitWriter, DURABILITY_LEVELS
+
+
+def run(durability, clients, pushes, base_dir):
+    writer = GroupCommitWriter(durability)
+    stores = []
+    for i in range(clients):
+        store_dir = os.path.join(base_dir, durability, str(i))
+        os.makedirs(store_dir)
+        stores.append(MyJsonStorageHandler(
+            os.path.join(store_dir, 'data.json'),
+            os.path.join(store_dir, 'meta_data.json'),
+            os.path.join(store_dir, 'changes.log'),
+            writer=writer
+        ))
+
+    def push_many(storage):
+        revision = 0
+        for i in range(pushes):
+            result = storage.push_actions(revision, {
+                'create': {'a': {'path': 'records', 'record': {'n': i}}}
+            })
+            revision = result['revision']
+
+    threads = [threading.Thread(target=push_many, args=(s,)) for s in stores]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    writer.flush()
+    elapsed = time.perf_counter() - start
+    return clients * pushes / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--pushes', type=int, default=200)
+    args = parser.parse_args()
+    base_dir = tempfile.mkdtemp()
+    try:
+        print('{:<10}{:>14}'.format('durability', 'pushes/sec'))
+        for durability in DURABILITY_LEVELS:
+            rate = run(durability, args.clients, args.pushes, base_dir)
+            print('{:<10}{:>14.0f}'.format(durability, rate))
+    finally:
+        shutil.rmtree(base_dir)
+
+
+if __name__ == '__main__':
+    main()
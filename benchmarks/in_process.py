@@ -0,0 +1,59 @@
+"""
+Helpers for driving the HTTP apps in-process, without a network.
+"""
+import base64
+import io
+import os
+import sys
+from cryptography.fernet import Fernet
+
+# The apps import their sibling modules as top level modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('POINTY_SECRET_KEY', str(Fernet.generate_key(), 'utf-8'))
+
+import bottle_app
+from accounts import ShardedAccountRegister
+from pointy.utils import GroupCommitWriter
+
+APP = 'pointy_v2'
+PASSWORD = 'pass'
+
+
+def setup_apps(base_dir, users, durability='request'):
+    """
+    Points bottle_app (and so asgi_app) at fresh stores and accounts for
+    users under base_dir.
+    """
+    bottle_app.JSON_BASE = base_dir
+    bottle_app.JSON_WRITER = GroupCommitWriter(durability)
+    bottle_app.JSON_STORES._stores.clear()
+    bottle_app.ACCOUNT_REGISTER = ShardedAccountRegister(
+        os.environ['POINTY_SECRET_KEY'], os.path.join(base_dir, 'accounts'))
+    for user in users:
+        bottle_app.ACCOUNT_REGISTER.create_user(user, PASSWORD)
+        bottle_app.ACCOUNT_REGISTER.add_user_app(user, APP)
+        os.makedirs(os.path.join(base_dir, APP, user))
+
+
+def auth_header(user):
+    credentials = bytes('{}:{}'.format(user, PASSWORD), 'utf-8')
+    return 'Basic ' + str(base64.b64encode(credentials), 'utf-8')
+
+
+def wsgi_call(user, method, body, query_string=''):
+    """
+    Calls POST /<APP>/<method> on bottle_app, returning status and body.
+    """
+    environ = {
+        'REQUEST_METHOD': 'POST',
+        'PATH_INFO': '/{}/{}'.format(APP, method),
+        'QUERY_STRING': query_string,
+        'CONTENT_TYPE': 'application/json',
+        'CONTENT_LENGTH': str(len(body)),
+        'HTTP_AUTHORIZATION': auth_header(user),
+        'wsgi.input': io.BytesIO(body),
+    }
+    statuses = []
+    chunks = bottle_app.application(environ, lambda status, headers: statuses.append(status))
+    body = b''.join(c if isinstance(c, bytes) else c.encode('utf-8') for c in chunks)
+    return statuses[0], body
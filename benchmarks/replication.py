@@ -0,0 +1,117 @@
+"""
+Runs a primary store and read replicas together. The primary takes a steady
+stream of pushes throughout, while filtered reads are made as fast as they
+can be, first on the primary alone and then on each replica in its own
+process. Reports read throughput both ways, and how far behind the primary
+the replicas ran. The query cache is off on both sides, so each read runs
+its query and the comparison is of serving reads, not of caching them.
+
+    python -m pointy.benchmarks.replication [--replicas 4] [--seconds 5] [--records 10000] [--pushes 50]
+"""
+import argparse
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+from pointy.json_storage import MyJsonStorageHandler
+from pointy.replication import ReplicaStorageHandler
+from pointy.metrics import METRICS
+
+READ = {'read': {'open': {'path': 'records', 'filter': {'status': 'open', 'n': {'gte': 9000}}}}}
+
+
+def store_paths(base_dir):
+    return [os.path.join(base_dir, name) for name in
+            ('data.json', 'meta_data.json', 'changes.log', 'replication.log')]
+
+
+def open_primary(base_dir):
+    data, meta, log, replication_log = store_paths(base_dir)
+    return MyJsonStorageHandler(data, meta, log, replication_log_path=replication_log,
+                                query_cache_max_bytes=0)
+
+
+def count_reads(storage, seconds):
+    reads = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        storage.push_actions(0, READ)
+        reads += 1
+    return reads
+
+
+def push_steadily(primary, per_second, stop):
+    i = 0
+    while not stop.wait(1 / per_second):
+        primary.push_actions(primary.revision, {
+            'create': {'a': {'path': 'records', 'record': {'n': i, 'status': 'open'}}}
+        })
+        i += 1
+
+
+def lag_seconds():
+    """
+    Mean replication lag observed in this process, from the metrics.
+    """
+    values = {}
+    for line in METRICS.render().splitlines():
+        name, _, value = line.partition(' ')
+        if name in ('pointy_replication_lag_seconds_sum', 'pointy_replication_lag_seconds_count'):
+            values[name] = float(value)
+    count = values.get('pointy_replication_lag_seconds_count', 0)
+    return values['pointy_replication_lag_seconds_sum'] / count if count else 0.0
+
+
+def run_replica(base_dir, seconds, results):
+    data, meta, log, replication_log = store_paths(base_dir)
+    replica = ReplicaStorageHandler(data, meta, replication_log, log, query_cache_max_bytes=0)
+    reads = count_reads(replica, seconds)
+    results.put((reads, lag_seconds(), replica.revision))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--replicas', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--records', type=int, default=10000)
+    parser.add_argument('--pushes', type=float, default=50, help='Pushes per second to the primary')
+    args = parser.parse_args()
+    base_dir = tempfile.mkdtemp()
+    try:
+        primary = open_primary(base_dir)
+        lines = ('{{"path": "records", "record": {{"n": {}, "status": "{}"}}}}'.format(
+            i, 'open' if i % 3 else 'closed') for i in range(args.records))
+        primary.import_records(lines)
+        stop = threading.Event()
+        pusher = threading.Thread(target=push_steadily, args=(primary, args.pushes, stop))
+        pusher.start()
+        try:
+            alone = count_reads(primary, args.seconds) / args.seconds
+            context = multiprocessing.get_context('fork')
+            results = context.Queue()
+            replicas = [context.Process(target=run_replica, args=(base_dir, args.seconds, results))
+                        for i in range(args.replicas)]
+            for replica in replicas:
+                replica.start()
+            replica_results = [results.get() for replica in replicas]
+            for replica in replicas:
+                replica.join()
+        finally:
+            stop.set()
+            pusher.join()
+
+        total = sum(reads for reads, lag, revision in replica_results) / args.seconds
+        print('{:.0f} pushes/sec to the primary throughout'.format(args.pushes))
+        print('primary alone: {:>8.0f} reads/sec'.format(alone))
+        print('{} replicas:    {:>8.0f} reads/sec'.format(args.replicas, total))
+        for i, (reads, lag, revision) in enumerate(replica_results):
+            print('  replica {}: {:>8.0f} reads/sec, mean lag {:.1f}ms, {} revisions behind at the end'.format(
+                i, reads / args.seconds, lag * 1000, primary.revision - revision))
+    finally:
+        shutil.rmtree(base_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+"""
+Benchmarks for the storage engine and HTTP layer, run without a network.
+
+For each case reports throughput, p50/p99 latency and peak memory (as
+traced by tracemalloc, including the case's setup), and compares them with
+a saved baseline:
+
+    python -m pointy.benchmarks.suite                  # compare with baseline
+    python -m pointy.benchmarks.suite --save-baseline  # after a deliberate change
+    python -m pointy.benchmarks.suite -k push          # only cases matching "push"
+
+Exits with status 1 if any case's throughput dropped, or its p99 latency
+or peak memory grew, by more than --tolerance (default 25%).
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import ujson
+from cryptography.fernet import Fernet
+from pointy.accounts import AccountRegister
+from pointy.json_storage import MyJsonStorageHandler
+from pointy.benchmarks.in_process import setup_apps, wsgi_call
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+CASES = []
+
+
+def case(name, iterations):
+    """
+    Registers a benchmark case. The decorated function takes a temp dir,
+    does its setup and returns the operation to time.
+    """
+    def decorator(setup):
+        CASES.append((name, iterations, setup))
+        return setup
+    return decorator
+
+
+def new_store(base_dir, records=0, path='records'):
+    storage = MyJsonStorageHandler(
+        os.path.join(base_dir, 'data.json'),
+        os.path.join(base_dir, 'meta_data.json'),
+        os.path.join(base_dir, 'changes.log'),
+    )
+    storage.load()
+    for i in range(records):
+        storage._create(path, {'name': 'record {}'.format(i), 'n': i})
+    storage.save()
+    return storage
+
+
+def deep_path(depth):
+    return '/'.join('level{}'.format(i) for i in range(depth))
+
+
+def push_case(store_size, action_count, depth):
+    def setup(base_dir):
+        path = deep_path(depth)
+        storage = new_store(base_dir, store_size, path)
+        action_sets = {
+            'create': {
+                str(i): {'path': path, 'record': {'name': 'new', 'n': i}}
+                for i in range(action_count)
+            }
+        }
+
+        def push():
+            storage.push_actions(storage.revision, ujson.loads(ujson.dumps(action_sets)))
+        return push
+    return setup
+
+
+for store_size in (100, 10000):
+    for action_count in (1, 50):
+        for depth in (1, 8):
+            case('push_actions store={} actions={} depth={}'.format(
+                store_size, action_count, depth), 200)(push_case(store_size, action_count, depth))
+
+
+@case('push_actions read store=10000', 50)
+def read_case(base_dir):
+    storage = new_store(base_dir, 10000)
+    read = {'read': {'all': {'path': 'records'}}}
+    return lambda: storage.push_actions(storage.revision, read)
+
+
+@case('drill depth=64', 20000)
+def drill_case(base_dir):
+    storage = new_store(base_dir)
+    path = deep_path(64)
+    storage._drill(path)
+    return lambda: storage._drill(path)
+
+
+@case('transaction commit', 200)
+def commit_case(base_dir):
+    storage = new_store(base_dir, 1000)
+
+    def cycle():
+        started = storage.start_transaction()
+        storage.push_actions(started['revision'], {
+            'create': {'a': {'path': 'records', 'record': {'name': 'new'}}}
+        }, started['transaction_id'])
+        storage.commit_transaction(started['transaction_id'])
+    return cycle
+
+
+@case('transaction abort', 200)
+def abort_case(base_dir):
+    storage = new_store(base_dir, 1000)
+
+    def cycle():
+        started = storage.start_transaction()
+        storage.push_actions(started['revision'], {
+            'create': {'a': {'path': 'records', 'record': {'name': 'new'}}}
+        }, started['transaction_id'])
+        storage.abort_transaction(started['transaction_id'])
+    return cycle
+
+
+@case('auth password_matches', 2000)
+def password_case(base_dir):
+    register = AccountRegister(str(Fernet.generate_key(), 'utf-8'),
+                               os.path.join(base_dir, 'accounts.json'))
+    register.create_user('bob', 'pass')
+    register.add_user_app('bob', 'app')
+
+    def check():
+        register.has_account_for_app('bob', 'app')
+        register.password_matches('bob', 'pass')
+    return check
+
+
+@case('auth session token', 2000)
+def session_case(base_dir):
+    register = AccountRegister(str(Fernet.generate_key(), 'utf-8'),
+                               os.path.join(base_dir, 'accounts.json'))
+    register.create_user('bob', 'pass')
+    register.add_user_app('bob', 'app')
+    token = register.issue_session_token('bob', 'app')['token']
+    return lambda: register.verify_session_token(token, 'app')
+
+
+@case('wsgi app_method push_actions', 200)
+def wsgi_case(base_dir):
+    setup_apps(base_dir, ['bob'])
+    revision = [0]
+
+    def call():
+        body = ujson.dumps({
+            'revision': revision[0],
+            'action_sets': {'create': {'a': {'path': 'records', 'record': {'n': 1}}}},
+        }).encode('utf-8')
+        status, body = wsgi_call('bob', 'push_actions', body)
+        revision[0] = ujson.loads(body)['data']['revision']
+    return call
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def run_case(iterations, setup):
+    base_dir = tempfile.mkdtemp()
+    try:
+        operation = setup(base_dir)
+        for i in range(min(10, iterations)):
+            operation()
+        latencies = []
+        start = time.perf_counter()
+        for i in range(iterations):
+            op_start = time.perf_counter()
+            operation()
+            latencies.append(time.perf_counter() - op_start)
+        elapsed = time.perf_counter() - start
+    finally:
+        shutil.rmtree(base_dir)
+
+    # Memory is traced in a separate run as tracing slows everything down
+    base_dir = tempfile.mkdtemp()
+    try:
+        tracemalloc.start()
+        operation = setup(base_dir)
+        for i in range(min(50, iterations)):
+            operation()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        shutil.rmtree(base_dir)
+
+    latencies.sort()
+    return {
+        'ops_per_sec': iterations / elapsed,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'peak_kb': peak / 1024,
+    }
+
+
+def regressions(result, baseline, tolerance):
+    found = []
+    if result['ops_per_sec'] < baseline['ops_per_sec'] * (1 - tolerance):
+        found.append('throughput')
+    for metric in ('p99_ms', 'peak_kb'):
+        if result[metric] > baseline[metric] * (1 + tolerance):
+            found.append(metric)
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-k', dest='keyword', help='Only run cases containing this')
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as fp:
+            baseline = ujson.load(fp)
+
+    results = {}
+    failed = False
+    row = '{:<48}{:>12}{:>10}{:>10}{:>12}  {}'
+    print(row.format('case', 'ops/sec', 'p50 ms', 'p99 ms', 'peak KB', 'vs baseline'))
+    for name, iterations, setup in CASES:
+        if args.keyword and args.keyword not in name:
+            continue
+        result = results[name] = run_case(iterations, setup)
+        if name not in baseline:
+            comparison = 'new'
+        else:
+            found = regressions(result, baseline[name], args.tolerance)
+            failed = failed or bool(found)
+            comparison = 'REGRESSED: ' + ', '.join(found) if found else '{:+.0%} ops/sec'.format(
+                result['ops_per_sec'] / baseline[name]['ops_per_sec'] - 1)
+        print(row.format(name, '{:.0f}'.format(result['ops_per_sec']),
+                         '{:.3f}'.format(result['p50_ms']), '{:.3f}'.format(result['p99_ms']),
+                         '{:.0f}'.format(result['peak_kb']), comparison))
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, 'w') as fp:
+            ujson.dump(baseline, fp, indent=4, sort_keys=True)
+        print('Saved baseline to {}'.format(args.baseline))
+    elif failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,50 @@
 import os
 from bottle import default_app, route, template, static_file, request, response,\
-    HTTPError
+    HTTPError, parse_auth
 from json_storage import MyJsonStorageHandler
-from accounts import AccountRegister
-from utils import ApiError
+from accounts import ShardedAccountRegister
+from store_cache import StoreCache
+from reaper import TransactionReaper
+from replication import ReplicaStorageHandler
+from http_cache import ResponseCache, is_cacheable, conditional_call
+from pointy.utils import ApiError, GroupCommitWriter, iter_json_chunks, iter_lines, \
+    join_chunks
+from pointy.metrics import METRICS
 
 JSON_BASE = '/home/andyhasit/pointy/json_dbs'
-JSON_STORES = {}
+# Limits for the cache of open stores (JSON_STORES)
+JSON_STORES_MAX_ENTRIES = 1000
+JSON_STORES_MAX_BYTES = 512 * 1024 * 1024
+RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# Append changes to a log instead of rewriting the data files on every save
+JSON_CHANGE_LOG = True
+# Keep each top level collection in its own file under data/ instead, so
+# saves only rewrite what changed (takes precedence over JSON_CHANGE_LOG)
+JSON_COLLECTION_FILES = False
+# One of 'request', 'batch' or 'async', see GroupCommitWriter
+JSON_DURABILITY = 'batch'
+JSON_WRITER = GroupCommitWriter(JSON_DURABILITY)
+# Set when running several worker processes, e.g. gunicorn -w 4 bottle_app:application
+JSON_MULTIPROCESS = False
+# Expires timed out transactions in the background
+TRANSACTION_REAPER = TransactionReaper()
+# Secondary indexes per app, as {collection path: [field, ...]}
+JSON_INDEXES = {
+    'pointy_v2': {},
+}
+# Publish each store's saved changes to replication.log, for read replicas
+JSON_REPLICATION = False
+# Serve read only replicas of the stores under JSON_BASE, following their
+# replication.log, e.g. as a separate pool of workers taking read traffic
+JSON_REPLICA = False
+# Collections to hold column-wise in memory per app, as [collection path, ...]
+JSON_COLUMNAR = {
+    'pointy_v2': [],
+}
 
-ACCOUNT_REGISTER = AccountRegister('/home/andyhasit/pointy/json_dbs/accounts.json')
+SECRET_KEY = os.environ.get('POINTY_SECRET_KEY')
+# Migrate an existing accounts.json with: python -m pointy.accounts <file> <dir>
+ACCOUNT_REGISTER = ShardedAccountRegister(SECRET_KEY, '/home/andyhasit/pointy/json_dbs/accounts')
 
 VALID_APPS = (
     'pointy_v2',
@@ -18,29 +54,127 @@ VALID_METHODS = (
     'push_actions',
     'start_transaction',
     'abort_transaction',
-    'commit_transaction'
+    'commit_transaction',
+    'changes_since',
+    'watch',
 )
+# Seconds between events on an idle server-sent events watch (asgi_app)
+SSE_KEEPALIVE = 15
+# Headers browser clients may send, and read, cross-origin (both apps)
+CORS_ALLOW_HEADERS = 'Authorization, Origin, Accept, Content-Type, X-Requested-With, ' \
+    'If-None-Match, X-Session-Token'
+CORS_EXPOSE_HEADERS = 'ETag'
+WATCH_NOT_SERVED = 'Watches are only served by asgi_app'
 
 
 def validate_user(app, user, password):
-    if not ACCOUNT_REGISTER.has_account_for_app(app, user):
+    try:
+        has_account = ACCOUNT_REGISTER.has_account_for_app(user, app)
+    except ApiError as e:
+        if e.code != 'account_not_found':
+            raise
+        has_account = False
+    if not has_account:
+        METRICS.inc('pointy_auth_failures_total', reason='no_account')
         raise HTTPError(403, 'No account for user {} in app {}'.format(user, app))
     if not ACCOUNT_REGISTER.password_matches(user, password):
+        METRICS.inc('pointy_auth_failures_total', reason='password')
         err = HTTPError(401, 'Invalid login')
         err.add_header('WWW-Authenticate','')
         raise err
 
 
+def authenticate(app, authorization, token=None):
+    """
+    Returns the user, authenticated either by a session token (from an
+    X-Session-Token header or as a Bearer token) or by basic auth.
+
+    @authorization: the Authorization header, if any
+    """
+    authorization = authorization or ''
+    if token is None and authorization.startswith('Bearer '):
+        token = authorization[len('Bearer '):]
+    if token is not None:
+        try:
+            return ACCOUNT_REGISTER.verify_session_token(token, app)
+        except ApiError as e:
+            METRICS.inc('pointy_auth_failures_total', reason=e.code)
+            err = HTTPError(401, 'Invalid session: {}'.format(e.code))
+            err.add_header('WWW-Authenticate', '')
+            raise err
+    return basic_auth_user(app, authorization)
+
+
+def basic_auth_user(app, authorization):
+    """
+    Returns the user authenticated by the basic auth credentials in the
+    Authorization header.
+    """
+    credentials = parse_auth(authorization or '')
+    if credentials is None:
+        METRICS.inc('pointy_auth_failures_total', reason='no_credentials')
+        err = HTTPError(401, 'Missing or malformed Authorization header')
+        err.add_header('WWW-Authenticate', '')
+        raise err
+    user, password = credentials
+    validate_user(app, user, password)
+    return user
+
+
+def issue_session(app, authorization):
+    """
+    Exchanges the basic auth credentials in the Authorization header for a
+    session token.
+    """
+    user = basic_auth_user(app, authorization)
+    return ACCOUNT_REGISTER.issue_session_token(user, app)
+
+
 def get_storage(app, user):
-    key = (app, user)
-    if key in JSON_STORES:
-        storage = JSON_STORES[key]
-    else:
-        data_db_path = os.path.join(JSON_BASE, app, user, 'data.json')
-        meta_data_db_path = os.path.join(JSON_BASE, app, user, 'meta_data.json')
-        storage = MyJsonStorageHandler(data_db_path, meta_data_db_path)
-        JSON_STORES[key] = storage
-    return storage
+    return JSON_STORES.get((app, user))
+
+
+def open_storage(key):
+    app, user = key
+    data_db_path = os.path.join(JSON_BASE, app, user, 'data.json')
+    meta_data_db_path = os.path.join(JSON_BASE, app, user, 'meta_data.json')
+    log_db_path = None
+    if JSON_COLLECTION_FILES:
+        data_db_path = os.path.join(JSON_BASE, app, user, 'data')
+    elif JSON_CHANGE_LOG:
+        log_db_path = os.path.join(JSON_BASE, app, user, 'changes.log')
+    journal_db_path = os.path.join(JSON_BASE, app, user, 'journal.log')
+    replication_log_path = os.path.join(JSON_BASE, app, user, 'replication.log')
+    if JSON_REPLICA:
+        return ReplicaStorageHandler(data_db_path, meta_data_db_path, replication_log_path,
+                                     log_db_path, collection_files=JSON_COLLECTION_FILES,
+                                     indexes=JSON_INDEXES.get(app),
+                                     columnar=JSON_COLUMNAR.get(app))
+    if not JSON_REPLICATION:
+        replication_log_path = None
+    return MyJsonStorageHandler(data_db_path, meta_data_db_path, log_db_path,
+                                writer=JSON_WRITER, journal_db_path=journal_db_path,
+                                indexes=JSON_INDEXES.get(app),
+                                columnar=JSON_COLUMNAR.get(app),
+                                collection_files=JSON_COLLECTION_FILES,
+                                reaper=TRANSACTION_REAPER,
+                                multiprocess=JSON_MULTIPROCESS,
+                                replication_log_path=replication_log_path)
+
+
+JSON_STORES = StoreCache(open_storage, JSON_STORES_MAX_ENTRIES, JSON_STORES_MAX_BYTES)
+# Serialized responses to read only calls, see http_cache
+RESPONSE_CACHE = ResponseCache(RESPONSE_CACHE_MAX_BYTES)
+
+
+def store_cache_metrics():
+    return [('pointy_store_cache_' + name, {}, value)
+            for name, value in JSON_STORES.stats().items()] + \
+        [('pointy_response_cache_' + name, {}, value)
+         for name, value in RESPONSE_CACHE.stats().items()]
+
+
+METRICS.add_collector(store_cache_metrics)
 
 
 def validate_app_method(app, method):
@@ -50,21 +184,81 @@ def validate_app_method(app, method):
         raise HTTPError(404, 'App {} does not exist'.format(app))
 
 
-def wrap_storage_call(request, app, method, params):
+def metric_labels(app, method):
+    """
+    The app and method labels of a request's metrics. Requests for unknown
+    apps or methods share one series, so clients can't add series at will.
+    """
+    if app in VALID_APPS and method in VALID_METHODS:
+        return {'app': app, 'method': method}
+    return {'app': 'invalid', 'method': 'invalid'}
+
+
+def wrap_storage_call(request, app, method, params, stream=False):
     """
     Generic wrapper for all storage calls.
+
+    Read only calls are answered by http_cache.conditional_call, with an
+    ETag, 304s and gzip.
+
+    With stream set (push_actions only) a successful result is returned as a
+    generator of json chunks, with query results serialized record by record
+    from copies of the collections taken when the call was made.
     """
+    labels = metric_labels(app, method)
+    with METRICS.timer('pointy_request_seconds', **labels):
+        result = _wrap_storage_call(request, app, method, params, stream)
+    if isinstance(result, HTTPError):
+        status = 'http_error'
+    elif response.status_code == 304:
+        status = 'not_modified'
+    elif isinstance(result, dict):
+        status = result['status']
+    else:
+        status = 'success'
+    METRICS.inc('pointy_requests_total', status=status, **labels)
+    return result
+
+
+def _wrap_storage_call(request, app, method, params, stream):
     try:
-        user, password = request.auth or (None, None)
         validate_app_method(app, method)
-        validate_user(app, user, password)
-        storage = get_storage(app, user, password)
+        if method == 'watch':
+            raise HTTPError(501, WATCH_NOT_SERVED)
+        user = authenticate(app, request.get_header('Authorization'),
+                            request.get_header('X-Session-Token'))
+        storage = get_storage(app, user)
+        stream = stream and method == 'push_actions'
+        if stream:
+            params = dict(params, stream=True)
+        elif is_cacheable(method, params):
+            status, headers, body = conditional_call(
+                RESPONSE_CACHE, app, user, storage, method, params,
+                request.get_header('If-None-Match'), request.get_header('Accept-Encoding'))
+            response.status = status
+            for name, value in headers.items():
+                response.set_header(name, value)
+            return body
         result = getattr(storage, method)(**params)
-        return {
+        result = {
             "status" : "success",
             "data" : result
         }
-    except ApiError as e:
+        if stream:
+            response.content_type = 'application/json'
+            return iter_json_chunks(result)
+        return result
+    except HTTPError as e:
+        return e
+    except BaseException as e:
+        return failure(e)
+
+
+def failure(e):
+    """
+    The response for an exception raised by a storage call.
+    """
+    if isinstance(e, ApiError):
         return {
             "status" : "fail",
             "data" : {
@@ -73,16 +267,13 @@ def wrap_storage_call(request, app, method, params):
                 "data": e.data
             }
         }
-    except HTTPError as e:
-        return e
-    except BaseException as e:
-        return {
-            "status" : "error",
-            "data" : {
-                "type": str(type(e)),
-                "message": str(e)
-            }
+    return {
+        "status" : "error",
+        "data" : {
+            "type": str(type(e)),
+            "message": str(e)
         }
+    }
 
 application = default_app()
 
@@ -96,7 +287,8 @@ def enable_cors():
     """
     response.headers['Access-Control-Allow-Origin'] = '*' # 'http://localhost:100'
     response.headers['Access-Control-Allow-Methods'] = 'PUT, GET, POST, DELETE, OPTIONS'
-    response.headers['Access-Control-Allow-Headers'] = 'Authorization, Origin, Accept, Content-Type, X-Requested-With'
+    response.headers['Access-Control-Allow-Headers'] = CORS_ALLOW_HEADERS
+    response.headers['Access-Control-Expose-Headers'] = CORS_EXPOSE_HEADERS
     #'Origin, Accept, Content-Type, X-Requested-With, X-CSRF-Token'
 
 
@@ -119,8 +311,71 @@ def index():
     return template('index')
 
 
-# The app's API actions
+@route('/metrics')
+def metrics():
+    response.content_type = 'text/plain; version=0.0.4'
+    return METRICS.render()
+
+
+# Exchanges basic auth credentials for a session token
+@route('/<app>/login', method='POST')
+def login(app):
+    if app not in VALID_APPS:
+        return HTTPError(404, 'App {} does not exist'.format(app))
+    try:
+        token = issue_session(app, request.get_header('Authorization'))
+    except HTTPError as e:
+        return e
+    return {
+        "status" : "success",
+        "data" : token
+    }
+
+
+# Watches wait for other requests' saves, which a worker serving one request
+# at a time could never make, so only asgi_app serves them
+@route('/<app>/watch', method='GET')
+def watch_events(app):
+    return HTTPError(501, WATCH_NOT_SERVED)
+
+
+# Bulk export of a store (or of the records under ?path=) as NDJSON
+@route('/<app>/export', method='GET')
+def export_records(app):
+    try:
+        if app not in VALID_APPS:
+            raise HTTPError(404, 'App {} does not exist'.format(app))
+        user = authenticate(app, request.get_header('Authorization'),
+                            request.get_header('X-Session-Token'))
+    except HTTPError as e:
+        return e
+    response.content_type = 'application/x-ndjson'
+    return join_chunks(get_storage(app, user).export_records(request.query.get('path', '')))
+
+
+# Bulk import of NDJSON records, as written by export, read as they arrive
+@route('/<app>/import', method='POST')
+def import_records(app):
+    try:
+        if app not in VALID_APPS:
+            raise HTTPError(404, 'App {} does not exist'.format(app))
+        user = authenticate(app, request.get_header('Authorization'),
+                            request.get_header('X-Session-Token'))
+        with METRICS.timer('pointy_request_seconds', app=app, method='import_records'):
+            result = get_storage(app, user).import_records(iter_lines(request.body.read))
+        return {
+            "status" : "success",
+            "data" : result
+        }
+    except HTTPError as e:
+        return e
+    except BaseException as e:
+        return failure(e)
+
+
+# The app's API actions, add ?stream=1 to stream large reads
 @route('/<app>/<method>', method='POST')
 def app_method(app, method):
-    return wrap_storage_call(request, app, method, request.json)
+    stream = request.query.get('stream') == '1'
+    return wrap_storage_call(request, app, method, request.json, stream)
 
@@ -0,0 +1,245 @@
+"""
+A compact column-wise collection for large numbers of records sharing the
+same few fields.
+
+Each field's values are kept in one column: integers, floats and booleans
+in typed arrays, strings as indexes into a table holding each distinct
+string once, and anything else in a plain list. Records are only built as
+dicts when read, and filters and aggregates run over the columns.
+"""
+import array
+import collections.abc
+import sys
+from pointy.query import matches, aggregate_rows
+
+# Returned by Column.get for a record without the field
+MISSING = object()
+_ABSENT, _PRESENT, _NONE = 0, 1, 2
+_TYPECODES = {'int': 'q', 'float': 'd', 'bool': 'b', 'str': 'I'}
+
+
+def _kind_of(value):
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, int):
+        return 'int' if -2 ** 63 <= value < 2 ** 63 else 'object'
+    if isinstance(value, float):
+        return 'float'
+    if isinstance(value, str):
+        return 'str'
+    return 'object'
+
+
+class Column:
+    """
+    One field's values, by row. The column takes the type of its first
+    value, and becomes a plain list if a value of another type arrives.
+    """
+
+    def __init__(self, rows=0):
+        self.kind = None
+        self.values = [None] * rows
+        # Per row, whether the field is absent, set, or set to None
+        self.states = bytearray(rows)
+        self.strings = []
+        self.codes = {}
+
+    def __len__(self):
+        return len(self.states)
+
+    def append(self, value):
+        self.values.append(None if self.kind in (None, 'object') else 0)
+        self.states.append(_ABSENT)
+        self.set(len(self.states) - 1, value)
+
+    def set(self, row, value):
+        if value is MISSING or value is None:
+            self.states[row] = _ABSENT if value is MISSING else _NONE
+            return
+        kind = _kind_of(value)
+        if self.kind is None:
+            self._become(kind)
+        elif kind != self.kind and self.kind != 'object':
+            self._become('object')
+        self.values[row] = self._encode(value)
+        self.states[row] = _PRESENT
+
+    def get(self, row):
+        state = self.states[row]
+        if state == _PRESENT:
+            value = self.values[row]
+            if self.kind == 'str':
+                return self.strings[value]
+            # Booleans are stored as bytes
+            return bool(value) if self.kind == 'bool' else value
+        return None if state == _NONE else MISSING
+
+    def copy(self):
+        copied = Column()
+        copied.kind = self.kind
+        copied.values = self.values[:]
+        copied.states = self.states[:]
+        copied.strings = self.strings[:]
+        copied.codes = dict(self.codes)
+        return copied
+
+    def move(self, from_row, to_row):
+        self.values[to_row] = self.values[from_row]
+        self.states[to_row] = self.states[from_row]
+
+    def pop(self):
+        self.values.pop()
+        self.states.pop()
+
+    def matching_rows(self, op, value, rows):
+        """
+        Those of rows whose value satisfies op (as in query.matches).
+        """
+        values, states = self.values, self.states
+        if self.kind == 'str' and isinstance(value, str) and op == 'eq':
+            code = self.codes.get(value)
+            return [r for r in rows if states[r] == _PRESENT and values[r] == code]
+        if self.kind in ('int', 'float') and _kind_of(value) in ('int', 'float') and op != 'eq':
+            # Numbers compare with numbers as they do in sort_key order
+            compare = {
+                'gt': lambda v: v > value,
+                'gte': lambda v: v >= value,
+                'lt': lambda v: v < value,
+                'lte': lambda v: v <= value,
+            }.get(op)
+            if compare is not None:
+                below = op in ('lt', 'lte')
+                # Absent and None values sort before any number
+                return [
+                    r for r in rows
+                    if (states[r] == _PRESENT and compare(values[r])) or (below and states[r] != _PRESENT)
+                ]
+        conditions = [('value', op, value)]
+        return [r for r in rows if matches({'value': self._value_or_none(r)}, conditions)]
+
+    def _value_or_none(self, row):
+        value = self.get(row)
+        return None if value is MISSING else value
+
+    def _encode(self, value):
+        if self.kind != 'str':
+            return value
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.strings)
+            self.strings.append(sys.intern(value))
+        return code
+
+    def _become(self, kind):
+        decoded = [self.get(row) for row in range(len(self.states))]
+        self.kind = kind
+        if kind == 'object':
+            self.values = [None if value in (MISSING, None) else value for value in decoded]
+            self.strings = []
+            self.codes = {}
+            return
+        self.values = array.array(_TYPECODES[kind], bytes(array.array(_TYPECODES[kind]).itemsize * len(decoded)))
+        for row, value in enumerate(decoded):
+            if self.states[row] == _PRESENT:
+                self.values[row] = self._encode(value)
+
+
+class ColumnarCollection(collections.abc.MutableMapping):
+    """
+    A collection of records (dicts) stored column-wise, used in place of a
+    dict. Reading a record builds a new dict, so changes to it are only kept
+    by setting it again. Serializes with ujson as a plain dict (toDict).
+    """
+
+    def __init__(self, records=None):
+        self._keys = []
+        self._rows = {}
+        self._columns = {}
+        for key, record in (records or {}).items():
+            self[key] = record
+
+    def __getitem__(self, key):
+        return self._record(self._rows[key])
+
+    def __setitem__(self, key, record):
+        if not isinstance(record, dict):
+            raise TypeError('Columnar collections only hold records (dicts)')
+        row = self._rows.get(key)
+        if row is None:
+            row = self._rows[key] = len(self._keys)
+            self._keys.append(key)
+            for column in self._columns.values():
+                column.append(MISSING)
+        for field in record:
+            if field not in self._columns:
+                self._columns[field] = Column(len(self._keys))
+        for field, column in self._columns.items():
+            column.set(row, record.get(field, MISSING))
+
+    def __delitem__(self, key):
+        row = self._rows.pop(key)
+        last = len(self._keys) - 1
+        if row != last:
+            # Move the last row into the gap
+            moved_key = self._keys[row] = self._keys[last]
+            self._rows[moved_key] = row
+            for column in self._columns.values():
+                column.move(last, row)
+        self._keys.pop()
+        for column in self._columns.values():
+            column.pop()
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def __iter__(self):
+        return iter(list(self._keys))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def copy(self):
+        copied = ColumnarCollection()
+        copied._keys = self._keys[:]
+        copied._rows = dict(self._rows)
+        copied._columns = {field: column.copy() for field, column in self._columns.items()}
+        return copied
+
+    def toDict(self):
+        return {key: self._record(row) for row, key in enumerate(self._keys)}
+
+    def matching_keys(self, conditions):
+        """
+        Keys of the records matching conditions (as from query.parse_filter).
+        """
+        return [self._keys[row] for row in self._matching_rows(conditions)]
+
+    def aggregate(self, conditions, aggregates, group_by=None):
+        """
+        As query.aggregate over the records matching conditions, without
+        building them.
+        """
+        return aggregate_rows(self._matching_rows(conditions), self._value, aggregates, group_by)
+
+    def _matching_rows(self, conditions):
+        rows = range(len(self._keys))
+        for field, op, value in conditions:
+            column = self._columns.get(field)
+            if column is not None:
+                rows = column.matching_rows(op, value, rows)
+            elif not matches({}, [(field, op, value)]):
+                return []
+        return rows
+
+    def _value(self, row, field):
+        column = self._columns.get(field)
+        value = column.get(row) if column is not None else MISSING
+        return None if value is MISSING else value
+
+    def _record(self, row):
+        record = {}
+        for field, column in self._columns.items():
+            value = column.get(row)
+            if value is not MISSING:
+                record[field] = value
+        return record
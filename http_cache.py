@@ -0,0 +1,154 @@
+"""
+HTTP caching of read only storage calls.
+
+The revision identifies a state of a store, so the response to a read only
+call is fixed by the store's revision and the call's parameters. Such calls
+get an ETag made of both, which clients send back in If-None-Match to get a
+304 without the store being read, and their serialized (and gzipped)
+responses are cached so repeating a call at the same revision costs a dict
+lookup.
+"""
+import collections
+import gzip
+import hashlib
+import threading
+import ujson
+from pointy.utils import dumps_response
+
+# Bodies smaller than this aren't worth compressing
+GZIP_MIN_BYTES = 1024
+
+
+def is_cacheable(method, params):
+    """
+    Whether the call can't change the store, and returns the same for the
+    same revision. Reads in a transaction see its private writes, so aren't.
+    """
+    if method == 'changes_since':
+        return True
+    if method == 'push_actions':
+        return params.get('transaction_id') is None and set(params.get('action_sets', {})) <= {'read'}
+    return False
+
+
+def make_etag(app, user, revision, method, params):
+    # params hold the client's revision, which decides whether the call
+    # succeeds (a client ahead of the store gets a revision_mismatch)
+    text = ujson.dumps([app, user, method, params], sort_keys=True)
+    return 'W/"{}-{}"'.format(revision, hashlib.sha1(text.encode('utf-8')).hexdigest()[:20])
+
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag[2:] in [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+
+
+def accepts_gzip(accept_encoding):
+    for coding in (accept_encoding or '').split(','):
+        name, _, params = coding.partition(';')
+        if name.strip() in ('gzip', '*'):
+            q = params.replace(' ', '')
+            try:
+                return not q.startswith('q=') or float(q[2:]) > 0
+            except ValueError:
+                return True
+    return False
+
+
+class CachedResponse:
+
+    def __init__(self, body):
+        self.body = body
+        self.gzipped = None
+        if len(body) >= GZIP_MIN_BYTES:
+            self.gzipped = gzip.compress(body, 6)
+
+    @property
+    def size(self):
+        return len(self.body) + len(self.gzipped or b'')
+
+
+class ResponseCache:
+    """
+    Least recently used cache of serialized responses by ETag, limited in
+    bytes. Entries for old revisions are never hit again and age out.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, etag):
+        with self._lock:
+            entry = self._entries.get(etag)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(etag)
+            return entry
+
+    def put(self, etag, body):
+        """
+        Caches the body, returning its CachedResponse.
+        """
+        entry = CachedResponse(body)
+        with self._lock:
+            old = self._entries.pop(etag, None)
+            if old is not None:
+                self._total_bytes -= old.size
+            if entry.size <= self.max_bytes:
+                self._entries[etag] = entry
+                self._total_bytes += entry.size
+            while self._total_bytes > self.max_bytes:
+                evicted = self._entries.popitem(last=False)[1]
+                self._total_bytes -= evicted.size
+        return entry
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'bytes': self._total_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+def conditional_call(cache, app, user, storage, method, params,
+                     if_none_match=None, accept_encoding=None):
+    """
+    Performs a cacheable storage call, returning (status, headers, body).
+
+    A matching If-None-Match gets a 304, and a response cached for the
+    current revision is sent again, without the call being made.
+    """
+    with storage.locked():
+        storage.load()
+        etag = make_etag(app, user, storage.revision, method, params)
+        headers = {'ETag': etag, 'Vary': 'Accept-Encoding'}
+        if etag_matches(if_none_match, etag):
+            return 304, headers, b''
+        entry = cache.get(etag)
+        if entry is None:
+            result = getattr(storage, method)(**params)
+            body = dumps_response({
+                "status" : "success",
+                "data" : result
+            }).encode('utf-8')
+            # Key on the revision actually read
+            etag = headers['ETag'] = make_etag(app, user, result['revision'], method, params)
+            entry = cache.put(etag, body)
+    headers['Content-Type'] = 'application/json'
+    if entry.gzipped is not None and accepts_gzip(accept_encoding):
+        headers['Content-Encoding'] = 'gzip'
+        return 200, headers, entry.gzipped
+    return 200, headers, entry.body
@@ -5,34 +5,255 @@ A crude but flexible JSON database which:
     - Enables version mismatch handling
 
 """
+import argparse
+import bisect
+import collections
+import collections.abc
+import concurrent.futures
+import contextlib
 import datetime
+import functools
+import os
+import sys
+import threading
+import time
 import uuid
-from pointy.utils import JsonFileWrapper
+import ujson
+from pointy.utils import JsonFileWrapper, JsonLinesFile, CollectionFiles
+from pointy.utils import FileLock, RevisionHeader, DEFAULT_WRITER
+from pointy.utils import atomic_write_gzipped, iter_json_chunks
 from pointy.utils import ApiError
+from pointy.query import SortedIndex, QueryCache, run_query, project, parse_filter
+from pointy.query import aggregate as aggregate_records
+from pointy.columnar import ColumnarCollection
+from pointy.metrics import METRICS
 
 REV_KEY = 'rev'
 LAST_ID_KEY = 'last_id'
+COMPACT_THRESHOLD = 1024 * 1024
+JOURNAL_SIZE = 10000
+QUERY_CACHE_MAX_BYTES = 8 * 1024 * 1024
+WATCH_MAX_TIMEOUT = 60
+IMPORT_BATCH_SIZE = 1000
+REPLICATION_LOG_MAX_BYTES = 16 * 1024 * 1024
+# How often multiprocess stores check for other processes' saves while watched
+WATCH_POLL_INTERVAL = 0.25
+
+
+def normalise_path(path):
+    return '/'.join(chunk for chunk in path.split('/') if chunk != '')
+
+
+def record_path(path, key):
+    """
+    The path of a record as a string, used to compare writes for conflicts.
+    """
+    return '{}/{}'.format(normalise_path(path), key).lstrip('/')
+
+
+def parent_paths(path):
+    chunks = path.split('/')
+    return ['/'.join(chunks[:i]) for i in range(1, len(chunks))]
+
+
+def drill(data, path):
+    """
+    Returns the collection at path, creating empty collections as needed.
+    """
+    collection = data
+    for chunk in path.split('/'):
+        if chunk != '':
+            if chunk not in collection:
+                collection[chunk] = {}
+            collection = collection[chunk]
+    return collection
+
+
+def is_collection(key, value):
+    """
+    Whether value, found under key, is a collection rather than a record.
+    Records are dicts whose id is their key.
+    """
+    return isinstance(value, collections.abc.Mapping) and str(value.get('id')) != str(key)
+
+
+def copy_collections(data):
+    """
+    Copies the collections making up data, sharing the records. Records are
+    only ever replaced, never changed in place, so the copy stays as it is
+    while data changes.
+    """
+    if isinstance(data, ColumnarCollection):
+        return data.copy()
+    copied = dict(data)
+    for key, value in copied.items():
+        # Most values are records, so check the cheap cases first (keys
+        # are strings once loaded from json)
+        if type(value) is dict:
+            ident = value.get('id')
+            if ident == key or (type(key) is str and ident is not None and str(ident) == key):
+                continue
+        if is_collection(key, value):
+            copied[key] = copy_collections(value)
+    return copied
+
+
+def iter_export_lines(path, collection):
+    """
+    The NDJSON lines of export_records for the records in collection, at path.
+    """
+    stack = [(path, collection)]
+    while stack:
+        collection_path, collection = stack.pop()
+        for key in list(collection):
+            value = collection[key]
+            if is_collection(key, value):
+                stack.append((record_path(collection_path, key), value))
+            else:
+                yield ujson.dumps({'path': collection_path, 'key': key, 'record': value}) + '\n'
+
+
+def exclusive(method):
+    """
+    Runs the method inside the store's locked() block.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.locked():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def apply_change(data, change):
+    """
+    Applies a change as recorded in the change log. Deleting a missing key is
+    ignored so that replaying a change twice is harmless.
+    """
+    collection = drill(data, change['path'])
+    if change['op'] == 'delete':
+        collection.pop(change['key'], None)
+    else:
+        collection[change['key']] = change['record']
+
 
 class JsonTwoFileStorageHandler:
     """
-    Transaction aware json database. Allows only one transaction.
+    Transaction aware json database. Any number of transactions may be open,
+    each writing to its own private write set. Conflicts are detected per
+    record at commit time (and on stale non-transactional pushes) using the
+    journal, rather than by comparing the global revision.
 
     Methods for working with two-file system:
         xyz_data.json  --  the data object which is entirely modifiable by clients
         xyz_metadata.json  --  meta data such as the last_id and revision.
 
+    If log_db_path is given, saves append each change to that log as one json
+    line instead of rewriting both files. The two files then act as a snapshot
+    which is rewritten in a background thread once the log grows past
+    compact_threshold bytes, and loading replays the log over the snapshot.
+
+    The writer (a GroupCommitWriter) sets how durable saves are before they
+    return, and lets saves from many stores share one fsync.
+
+    Saved changes are also kept in a journal of roughly the last journal_size
+    changes (in memory, and in journal_db_path if given) which changes_since
+    uses to send clients only what changed since their revision.
+
+    Secondary indexes may be declared as a dict of collection path to a list
+    of field names. They are built on first use and then kept up to date as
+    changes are applied.
+
+    With collection_files=True, data_db_path is a directory holding one file
+    per top level collection (see CollectionFiles). Collections are then only
+    parsed when used, and saves only rewrite the collections which changed.
+    This replaces the change log, so the two can't be combined.
+
+    Timed out transactions are expired on the next load, or as soon as they
+    time out if a TransactionReaper is given as reaper.
 
+    Read results are cached, serialized, until a change touches their path,
+    using up to query_cache_max_bytes (0 turns the cache off).
+
+    If replication_log_path is given, each save appends the changes saved to
+    that log as one json line of {"rev": ..., "time": ..., "changes": [...]},
+    for replicas (see replication.ReplicaStorageHandler) to apply. The log
+    is trimmed to its newer half once past REPLICATION_LOG_MAX_BYTES.
+
+    Collections given in columnar (a list of paths) are held in memory as
+    ColumnarCollections, which take far less memory for many records with
+    the same fields, and filter and aggregate over their columns. They may
+    only hold records, not other collections.
+
+    With multiprocess=True any number of processes may share the store:
+    each operation holds a file lock, staleness is checked against a memory
+    mapped header holding the revision and last id rather than by checking
+    the files, and open transactions are kept in a shared file so another
+    process can continue or commit them. All writes are on disk before the
+    lock is released, so it implies at least batch durability, and there
+    should be a journal so commits can be checked for conflicts with writes
+    made by other processes.
     """
-    def __init__(self, data_db_path, metadata_db_path):
+    def __init__(self, data_db_path, metadata_db_path, log_db_path=None,
+                 compact_threshold=COMPACT_THRESHOLD, writer=None,
+                 journal_db_path=None, journal_size=JOURNAL_SIZE, indexes=None,
+                 collection_files=False, reaper=None,
+                 query_cache_max_bytes=QUERY_CACHE_MAX_BYTES, multiprocess=False,
+                 columnar=None, replication_log_path=None):
+        if collection_files and log_db_path is not None:
+            raise ValueError('collection_files and a change log can not be combined')
+        self._columnar_paths = [normalise_path(path) for path in columnar or []]
+        if '' in self._columnar_paths:
+            raise ValueError('The top level can not be columnar')
         self.data = None
         self._metadata = None
         self._must_reload = True
-        self._transaction_id = None
-        self._revision_before_transaction = None
-        self._transaction_start_time = None
-        self._transaction_timeout = None
-        self._data_file_wrapper = JsonFileWrapper(data_db_path)
-        self._meta_file_wrapper = JsonFileWrapper(metadata_db_path, {REV_KEY: 0, LAST_ID_KEY: 0})
+        self._transactions = {}
+        self._expired_transaction_ids = collections.deque(maxlen=100)
+        self._reaper = reaper
+        self._collection_files = collection_files
+        if collection_files:
+            self._data_file_wrapper = CollectionFiles(data_db_path, writer)
+        else:
+            self._data_file_wrapper = JsonFileWrapper(data_db_path, writer=writer)
+        self._meta_file_wrapper = JsonFileWrapper(
+            metadata_db_path, {REV_KEY: 0, LAST_ID_KEY: 0}, writer)
+        self._pending_changes = []
+        self._undo_log = None
+        self._change_log = None
+        if log_db_path is not None:
+            self._change_log = JsonLinesFile(log_db_path, writer)
+        self._compact_threshold = compact_threshold
+        self._compaction_thread = None
+        self._journal = []
+        self._journal_revs = []
+        self._journal_start = None
+        self._journal_size = journal_size
+        self._journal_file = None
+        if journal_db_path is not None:
+            self._journal_file = JsonLinesFile(journal_db_path, writer)
+        self._replication_log = None
+        if replication_log_path is not None:
+            self._replication_log = JsonLinesFile(replication_log_path, writer)
+        self._index_fields = {}
+        self._indexes = {}
+        self._query_cache = QueryCache(query_cache_max_bytes)
+        self._saved = threading.Condition()
+        self._save_count = 0
+        self._save_listeners = []
+        self._writer = writer or DEFAULT_WRITER
+        self._file_lock = None
+        self._thread_lock = threading.RLock()
+        self._header = None
+        self._shared_transactions = None
+        self._shared_transactions_text = None
+        if multiprocess:
+            self._file_lock = FileLock(metadata_db_path + '.lock')
+            self._header = RevisionHeader(metadata_db_path + '.header')
+            self._shared_transactions = JsonFileWrapper(
+                metadata_db_path + '.transactions', {'open': {}, 'expired': []}, writer)
+        for path, fields in (indexes or {}).items():
+            for field in fields:
+                self.add_index(path, field)
 
     @property
     def revision(self):
@@ -53,96 +274,792 @@ class JsonTwoFileStorageHandler:
         self._metadata[LAST_ID_KEY] = value
 
     def load(self):
-        self._check_if_transaction_timed_out()
-        if self._must_reload:
-            self.data = self._data_file_wrapper.load(True)
-            self._metadata = self._meta_file_wrapper.load(True)
+        """
+        Loads the store if it isn't loaded or its files were changed on disk
+        by someone else (e.g. another worker process). Only the changed files
+        are parsed again.
+        """
+        self._expire_transactions()
+        if self._header is not None and not self._must_reload:
+            stale = self._header.read()[0] != self.revision
+        else:
+            stale = self._must_reload or self._files_changed_on_disk()
+        if stale:
+            if self._compaction_thread is not None:
+                self._compaction_thread.join()
+            self.data = self._data_file_wrapper.load()
+            self._metadata = self._meta_file_wrapper.load()
+            if self._change_log is not None:
+                self._replay_change_log()
+            self._load_journal()
+            self._make_columnar()
+            self._indexes = {}
+            self._query_cache.clear()
+            self._pending_changes = []
             self._must_reload = False
+        if self._header is not None:
+            # Ids allocated in other processes' transactions aren't saved yet
+            self.last_id = max(self.last_id, self._header.read()[1])
+
+    @contextlib.contextmanager
+    def locked(self):
+        """
+        In multiprocess mode, holds the lock shared by all processes using
+        the store. Entering brings in the other processes' transactions, and
+        leaving publishes this process's changes. Otherwise holds a lock
+        shared by the threads using the store (e.g. the reaper's).
+        """
+        if self._file_lock is None:
+            with self._thread_lock:
+                yield
+            return
+        outermost = self._file_lock.acquire()
+        try:
+            if outermost:
+                self._read_shared_transactions()
+            yield
+        finally:
+            try:
+                if outermost:
+                    self._publish()
+            finally:
+                self._file_lock.release()
+
+    def _read_shared_transactions(self):
+        if self._shared_transactions_text is None or self._shared_transactions.changed_on_disk():
+            state = self._shared_transactions.load()
+            self._transactions = {
+                transaction_id: Transaction.from_dict(d) for transaction_id, d in state['open'].items()
+            }
+            self._expired_transaction_ids = collections.deque(state['expired'], maxlen=100)
+            self._shared_transactions_text = ujson.dumps(self._shared_transactions_state())
+
+    def _shared_transactions_state(self):
+        return {
+            'open': {t.id: t.to_dict() for t in self._transactions.values()},
+            'expired': list(self._expired_transaction_ids),
+        }
+
+    def _publish(self):
+        self._writer.flush()
+        if self._metadata is not None:
+            self._header.write(self.revision, self.last_id)
+        text = ujson.dumps(self._shared_transactions_state())
+        if text != self._shared_transactions_text:
+            self._shared_transactions.save_text(text, wait=True)
+            self._shared_transactions_text = text
+
+    @property
+    def has_open_transactions(self):
+        return bool(self._transactions)
+
+    @property
+    def estimated_size(self):
+        """
+        Size of the store's files and cached query results in bytes, a cheap
+        stand in for its size in memory.
+        """
+        files = [self._data_file_wrapper, self._meta_file_wrapper,
+                 self._change_log, self._journal_file]
+        return sum(f.size() for f in files if f is not None) + self._query_cache.bytes
+
+    @property
+    def parse_stats(self):
+        """
+        How many times, and for how long in total, store files were parsed.
+        """
+        files = [self._data_file_wrapper, self._meta_file_wrapper,
+                 self._change_log, self._journal_file]
+        files = [f for f in files if f is not None]
+        return {
+            'parse_count': sum(f.parse_count for f in files),
+            'parse_seconds': sum(f.parse_seconds for f in files),
+        }
+
+    def _files_changed_on_disk(self):
+        files = [self._data_file_wrapper, self._meta_file_wrapper,
+                 self._change_log, self._journal_file]
+        return any(f.changed_on_disk() for f in files if f is not None)
 
     def save(self):
-        self._data_file_wrapper.save()
-        self._meta_file_wrapper.save()
+        if self._change_log is None:
+            self._data_file_wrapper.save()
+            self._meta_file_wrapper.save()
+        else:
+            self._change_log.append(self._pending_changes)
+            if self._change_log.size() > self._compact_threshold:
+                # Other processes mustn't see a half written snapshot
+                self.compact(wait=self._file_lock is not None)
+        self._add_to_journal(self._pending_changes)
+        if self._pending_changes:
+            self._replicate({'rev': self.revision, 'time': time.time(), 'changes': self._pending_changes})
+        self._pending_changes = []
+        self._notify_saved()
+
+    def _replicate(self, entry):
+        if self._replication_log is None:
+            return
+        self._replication_log.append([entry])
+        if self._replication_log.size() > REPLICATION_LOG_MAX_BYTES:
+            # Replicas see the file replaced and read it again from the start
+            entries = list(self._replication_log.read())
+            self._replication_log.rewrite(entries[len(entries) // 2:])
+
+    def _notify_saved(self):
+        with self._saved:
+            self._save_count += 1
+            self._saved.notify_all()
+        for listener in list(self._save_listeners):
+            listener()
+
+    def export_records(self, path=''):
+        """
+        Returns an iterator over each record under path as a line of NDJSON:
+
+            {"path": "some/collection", "key": 12, "record": {...}}
+
+        A dict whose id is its key is taken to be a record, any other dict a
+        collection to export the records of. The records are those in the
+        store at the time of the call, however it changes after.
+        """
+        with self.locked():
+            self.load()
+            collection = copy_collections(self._drill(path))
+        return iter_export_lines(normalise_path(path), collection)
+
+    @exclusive
+    def snapshot(self, archive_path, wait=False):
+        """
+        Writes the store as it is now to archive_path, as gzipped json:
 
+            {"rev": 12, "last_id": 40, "data": {...}}
+
+        Only copying the collections holds up other calls, serializing and
+        writing happen in a background thread. Returns a Future for the
+        revision and last id written.
+        """
+        self.load()
+        start = time.perf_counter()
+        snapshot = {'rev': self.revision, 'last_id': self.last_id, 'data': copy_collections(self.data)}
+        METRICS.observe('pointy_snapshot_copy_seconds', time.perf_counter() - start)
+        future = concurrent.futures.Future()
+
+        def write_archive():
+            try:
+                with METRICS.timer('pointy_snapshot_write_seconds'):
+                    atomic_write_gzipped(archive_path, iter_json_chunks(snapshot))
+                future.set_result({'revision': snapshot['rev'], 'last_id': snapshot['last_id']})
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=write_archive).start()
+        if wait:
+            future.result()
+        return future
+
+    @exclusive
+    def import_records(self, lines, batch_size=IMPORT_BATCH_SIZE):
+        """
+        Adds records from lines of NDJSON as export_records writes them,
+        where lines without a key are given a new id. Lines are applied in
+        batches, each with one revision and a block of ids, and the store is
+        saved once at the end. If a line is invalid nothing is imported.
+
+        Clients must read everything again afterwards, as the changes aren't
+        journaled. Returns the new revision and the number imported.
+        """
+        self.load()
+        imported = 0
+        top_level_names = set()
+        try:
+            batch = []
+            for number, line in enumerate(lines, 1):
+                if not line.strip():
+                    continue
+                try:
+                    entry = ujson.loads(line)
+                except ValueError:
+                    entry = None
+                if not isinstance(entry, dict) or not isinstance(entry.get('path'), str) \
+                        or 'record' not in entry:
+                    raise ApiError(
+                        code='invalid_import',
+                        data={'line': number},
+                        msg='Invalid record on line {}'.format(number)
+                    )
+                batch.append(entry)
+                if len(batch) == batch_size:
+                    self._import_batch(batch, top_level_names)
+                    imported += len(batch)
+                    batch = []
+            if batch:
+                self._import_batch(batch, top_level_names)
+                imported += len(batch)
+        except BaseException:
+            # Drop the batches already applied, none of which were saved
+            self._data_file_wrapper.load(force=True)
+            self._meta_file_wrapper.load(force=True)
+            self._must_reload = True
+            raise
+        if self._collection_files:
+            for name in top_level_names:
+                self.data.mark_dirty(name)
+        self._indexes = {}
+        self._query_cache.clear()
+        if self._change_log is not None:
+            if self._compaction_thread is not None:
+                self._compaction_thread.join()
+            self.compact(wait=True)
+        self._reset_journal()
+        self.save()
+        # Nothing was journaled, so replicas must load the store again
+        self._replicate({'rev': self.revision, 'time': time.time(), 'resync': True})
+        return {'revision': self.revision, 'imported': imported}
+
+    def _import_batch(self, batch, top_level_names):
+        self.revision += 1
+        next_id = self.last_id + 1
+        self.last_id += sum(1 for entry in batch if entry.get('key') is None)
+        for entry in batch:
+            key, record = entry.get('key'), entry['record']
+            if key is None:
+                key = next_id
+                next_id += 1
+            elif isinstance(key, int) or (isinstance(key, str) and key.isdigit()):
+                # Keep new ids clear of imported ones (keys are strings once saved)
+                self.last_id = max(self.last_id, int(key))
+            if isinstance(record, dict) and 'id' not in record:
+                # Without its key as id the record would pass for a collection
+                record['id'] = key
+            drill(self.data, entry['path'])[key] = record
+            top_level_names.add(record_path(entry['path'], key).split('/')[0])
+
+    def add_save_listener(self, listener):
+        """
+        Calls listener (with no arguments) after each save, on the saving
+        thread. Saves made by other processes aren't seen.
+        """
+        self._save_listeners.append(listener)
+
+    def remove_save_listener(self, listener):
+        self._save_listeners.remove(listener)
+
+    @property
+    def watch_poll_interval(self):
+        """
+        How long a watcher may wait for a save before checking again, None
+        if it need only wait for a save.
+        """
+        return WATCH_POLL_INTERVAL if self._header is not None else None
+
+    def watch(self, revision, timeout=30, delta=False):
+        """
+        Waits until the store's revision differs from the client's, or at
+        most timeout seconds (capped at WATCH_MAX_TIMEOUT), then returns the
+        current revision. With delta the changes since the client's revision
+        are included, as changes_since returns them:
+
+        result_example = {
+            "revision": 1234,
+            "changes": [...]            # only with delta
+        }
+
+        If the journal doesn't reach back to the client's revision there are
+        no changes but "resync_required": true.
+        """
+        deadline = time.monotonic() + min(float(timeout), WATCH_MAX_TIMEOUT)
+        while True:
+            with self._saved:
+                save_count = self._save_count
+            result = self.revision_moved(revision, delta)
+            remaining = deadline - time.monotonic()
+            if result is not None or remaining <= 0:
+                return result or {'revision': self.revision}
+            if self.watch_poll_interval is not None:
+                remaining = min(remaining, self.watch_poll_interval)
+            with self._saved:
+                if self._save_count == save_count:
+                    self._saved.wait(remaining)
+
+    @exclusive
+    def revision_moved(self, revision, delta=False):
+        """
+        The result for watch() if the revision differs from the client's,
+        otherwise None.
+        """
+        self.load()
+        revision = int(revision)
+        if self.revision == revision:
+            return None
+        result = {'revision': self.revision}
+        if delta:
+            try:
+                result['changes'] = self.changes_since(revision)['changes']
+            except ApiError as e:
+                if e.code != 'resync_required':
+                    raise
+                result['resync_required'] = True
+        return result
+
+    @exclusive
+    def changes_since(self, revision):
+        """
+        Returns the changes saved after the client's revision, keeping only
+        the last change to each record:
+
+        result_example = {
+            "revision": 1234,
+            "changes": [
+                {"rev": 1233, "op": "update", "path": "some/collection",
+                 "key": "12", "record": {...}},
+                {"rev": 1234, "op": "delete", "path": "some/collection",
+                 "key": "13"}
+            ]
+        }
+
+        Raises resync_required if the journal no longer reaches back to the
+        client's revision, in which case the client should read everything.
+        """
+        self.load()
+        revision = int(revision)
+        if revision < self._journal_start or revision > self._journal_end:
+            raise ApiError(
+                code='resync_required',
+                data={
+                    'client_revision': revision,
+                    'journal_start': self._journal_start,
+                    'server_revision': self._journal_end,
+                },
+                msg='Changes since revision {} are no longer available'.format(revision)
+            )
+        latest = {}
+        for change in self._journal[bisect.bisect_right(self._journal_revs, revision):]:
+            record_path = (change['path'], change['key'])
+            latest.pop(record_path, None)
+            latest[record_path] = change
+        return {'revision': self._journal_end, 'changes': list(latest.values())}
+
+    @property
+    def _journal_end(self):
+        if self._journal:
+            return self._journal_revs[-1]
+        return self._journal_start
+
+    def _load_journal(self):
+        """
+        Loads the journal, discarding it if it doesn't lead up to the current
+        revision (e.g. the journal was enabled after the store was created).
+        """
+        entries = []
+        if self._journal_file is not None:
+            entries = [e for e in self._journal_file.read() if e['rev'] <= self.revision]
+        if entries and entries[-1]['rev'] == self.revision:
+            self._journal = entries
+            self._journal_revs = [e['rev'] for e in entries]
+            self._journal_start = entries[0]['rev'] - 1
+        else:
+            self._reset_journal()
+
+    def _reset_journal(self):
+        self._journal = []
+        self._journal_revs = []
+        self._journal_start = self.revision
+        if self._journal_file is not None:
+            self._journal_file.rewrite([])
+
+    def _add_to_journal(self, changes):
+        if not changes:
+            return
+        self._journal.extend(changes)
+        self._journal_revs.extend(c['rev'] for c in changes)
+        if len(self._journal) > self._journal_size:
+            # Trim to half so the file isn't rewritten on every save
+            drop = len(self._journal) - self._journal_size // 2
+            self._journal_start = self._journal_revs[drop - 1]
+            del self._journal[:drop]
+            del self._journal_revs[:drop]
+            if self._journal_file is not None:
+                self._journal_file.rewrite(self._journal)
+        elif self._journal_file is not None:
+            self._journal_file.append(changes)
+
+    def compact(self, wait=False):
+        """
+        Writes the current state as the new snapshot and empties the log.
+
+        The collections are copied here (sharing the records) so later
+        changes can't leak into the snapshot, but serializing and writing it
+        happen in a background thread. Changes saved meanwhile go to a fresh
+        log, and the rotated log is only discarded once the snapshot is on
+        disk.
+        """
+        if self._compaction_thread is not None and self._compaction_thread.is_alive():
+            return
+        data = copy_collections(self.data)
+        metadata = dict(self._metadata)
+        self._change_log.rotate()
+
+        def write_snapshot():
+            # The rotated log may only go once the snapshot is durable
+            self._data_file_wrapper.save_text(ujson.dumps(data), wait=True)
+            self._meta_file_wrapper.save_text(ujson.dumps(metadata), wait=True)
+            self._change_log.discard_rotated()
+
+        self._compaction_thread = threading.Thread(target=write_snapshot)
+        self._compaction_thread.start()
+        if wait:
+            self._compaction_thread.join()
+
+    def _apply_change(self, op, path, key, record=None):
+        """
+        Applies a create, update or delete to the data, bumping the revision.
+        """
+        if self._undo_log is not None:
+            collection = drill(self.data, path)
+            self._undo_log.append((path, key, key in collection, collection.get(key)))
+        self.revision += 1
+        change = {'rev': self.revision, 'op': op, 'path': path, 'key': key}
+        if op != 'delete':
+            change['record'] = record
+        apply_change(self.data, change)
+        self._pending_changes.append(change)
+        self._changed_in_memory(path, key, None if op == 'delete' else record)
+
+    def _changed_in_memory(self, path, key, record):
+        changed = record_path(path, key)
+        self._query_cache.invalidate(changed)
+        if self._collection_files:
+            self.data.mark_dirty(changed.split('/')[0])
+        for indexed_path in [p for p in self._indexes if p == changed or p.startswith(changed + '/')]:
+            # The indexed collection was replaced or removed, so it's indexed
+            # again when next read
+            del self._indexes[indexed_path]
+        for index in self._indexes.get(normalise_path(path), {}).values():
+            index.remove(key)
+            if record is not None:
+                index.add(key, record)
+
+    @contextlib.contextmanager
+    def _undoable(self):
+        """
+        Undoes the changes applied in the with block if it raises, so a batch
+        of changes is applied in memory either in full or not at all.
+
+        Only the prior values of the keys written are kept, along with the
+        revision and last_id, so undoing costs as much as the batch did.
+        """
+        revision, last_id = self.revision, self.last_id
+        pending = len(self._pending_changes)
+        self._undo_log = []
+        try:
+            yield
+        except BaseException:
+            for path, key, existed, record in reversed(self._undo_log):
+                collection = drill(self.data, path)
+                if existed:
+                    collection[key] = record
+                else:
+                    collection.pop(key, None)
+                self._changed_in_memory(path, key, record if existed else None)
+            del self._pending_changes[pending:]
+            self.revision, self.last_id = revision, last_id
+            raise
+        finally:
+            self._undo_log = None
+
+    def add_index(self, path, field):
+        self._index_fields.setdefault(normalise_path(path), set()).add(field)
+        self._indexes.pop(normalise_path(path), None)
+
+    def _get_indexes(self, path):
+        """
+        Returns the indexes for the collection at path, building them if
+        they were declared but haven't been built since the last load.
+        """
+        path = normalise_path(path)
+        if path not in self._index_fields:
+            return {}
+        if path not in self._indexes:
+            collection = drill(self.data, path)
+            self._indexes[path] = {
+                field: SortedIndex(field, collection) for field in self._index_fields[path]
+            }
+        return self._indexes[path]
+
+    def _make_columnar(self):
+        """
+        Replaces the collections declared columnar (as loaded) with
+        ColumnarCollections.
+        """
+        for path in self._columnar_paths:
+            collection = drill(self.data, path)
+            if not isinstance(collection, ColumnarCollection):
+                parent_path, _, name = path.rpartition('/')
+                drill(self.data, parent_path)[name] = ColumnarCollection(collection)
+
+    def _replay_change_log(self):
+        """
+        Applies changes logged after the snapshot was taken.
+        """
+        for change in self._change_log.read():
+            if change['rev'] > self.revision:
+                apply_change(self.data, change)
+                self.revision = change['rev']
+                if change['op'] == 'create':
+                    self.last_id = max(self.last_id, change['key'])
+
+    @exclusive
+    def apply_changes(self, changes):
+        """
+        Applies changes saved by another store with the same history (the
+        primary of a replica), as its journal records them, without saving.
+        Changes at or below the revision are skipped, and applying a change
+        again is harmless.
+        """
+        applied = []
+        for change in changes:
+            if change['rev'] > self.revision:
+                apply_change(self.data, change)
+                self.revision = change['rev']
+                if change['op'] == 'create':
+                    self.last_id = max(self.last_id, change['key'])
+                self._changed_in_memory(change['path'], change['key'], change.get('record'))
+                applied.append(change)
+        if applied:
+            self._add_to_journal(applied)
+            self._notify_saved()
+        return len(applied)
+
+    @exclusive
     def start_transaction(self, timeout=5):
         self.load()
-        self._revision_before_transaction = self.revision
-        self._transaction_id = uuid.uuid4()
-        self._transaction_start_time = datetime.datetime.now()
-        self._transaction_timeout = timeout
-        return {'transaction_id': self._transaction_id, 'revision': self.revision}
+        transaction = Transaction(self.revision, timeout)
+        self._transactions[transaction.id] = transaction
+        if self._reaper is not None:
+            self._reaper.schedule(self, transaction)
+        return {'transaction_id': transaction.id, 'revision': self.revision}
 
+    @exclusive
     def abort_transaction(self, transaction_id):
         """
         Still returns revision if transaction doesn't exist or timed out.
         """
         self.load()
-        if transaction_id == self._transaction_id:
-            self._rollback_transaction()
+        if self._transactions.pop(transaction_id, None) is not None:
+            METRICS.inc('pointy_transactions_total', outcome='aborted')
         return {'revision': self.revision}
 
+    @exclusive
     def commit_transaction(self, transaction_id):
+        """
+        Applies the transaction's writes unless another writer changed any of
+        the same records since the transaction started.
+        """
         self.load()
-        self.check_transaction(transaction_id)
+        transaction = self.check_transaction(transaction_id)
+        self._transactions.pop(transaction_id, None)
+        conflicts = self._find_conflicts(transaction.start_revision, transaction.written_paths())
+        if conflicts:
+            METRICS.inc('pointy_transactions_total', outcome='conflict')
+            raise ApiError(
+                code='transaction_conflict',
+                data={'conflicts': conflicts},
+                msg='Records changed since transaction started: {}'.format(', '.join(conflicts))
+            )
+        with self._undoable():
+            for change in transaction.changes:
+                self._apply_change(change['op'], change['path'], change['key'], change.get('record'))
         self.save()
-        self._clear_transaction()
+        METRICS.inc('pointy_transactions_total', outcome='committed')
         return {'revision': self.revision}
 
     def check_transaction(self, transaction_id):
-        if transaction_id is None and self._transaction_id is None:
-            # No transaction expected or in progress, all good
-            return
-        if transaction_id is None and self._transaction_id is not None:
-            raise ApiError(code='transaction_in_progress')
-        if transaction_id is not None and self._transaction_id is None:
-            raise ApiError(code='no_transaction_in_progress')
-        if transaction_id != self._transaction_id:
+        """
+        Returns the open transaction with that id, or None if no id given.
+        """
+        if transaction_id is None:
+            return None
+        # The reaper may expire transactions from another thread, so read
+        # the transaction once
+        transaction = self._transactions.get(transaction_id)
+        if transaction is None:
+            if transaction_id in self._expired_transaction_ids:
+                raise ApiError(code='transaction_timed_out')
+            if not self._transactions:
+                raise ApiError(code='no_transaction_in_progress')
             raise ApiError(code='transaction_id_mismatch')
+        return transaction
 
-    def check_revision(self, revision):
-        if int(revision) != self.revision:
-            raise ApiError(
-                code='revision_mismatch',
-                data={
-                    'client_revision': revision,
-                    'server_revision': self.revision,
-                },
-                msg='Client revision: {}. Server revision: {}'.format(revision, self.revision)
-            )
+    def check_revision(self, revision, transaction=None, written_paths=()):
+        """
+        Inside a transaction the client must be at the transaction's revision.
+        Otherwise a stale revision is only rejected if a record the client
+        writes to was changed after it.
+        """
+        revision = int(revision)
+        METRICS.inc('pointy_revision_checks_total')
+        if transaction is not None:
+            server_revision = transaction.revision
+            conflicts = []
+            if revision == server_revision:
+                return
+        else:
+            server_revision = self.revision
+            if revision == server_revision:
+                return
+            conflicts = None
+            if revision < server_revision:
+                conflicts = self._find_conflicts(revision, written_paths)
+                if not conflicts:
+                    return
+        METRICS.inc('pointy_revision_mismatches_total')
+        raise ApiError(
+            code='revision_mismatch',
+            data={
+                'client_revision': revision,
+                'server_revision': server_revision,
+                'conflicts': conflicts,
+            },
+            msg='Client revision: {}. Server revision: {}'.format(revision, server_revision)
+        )
 
-    def _check_if_transaction_timed_out(self):
-        if self._transaction_id is not None:
-            now = datetime.datetime.now()
-            timeout = self._transaction_start_time + datetime.timedelta(seconds=self._transaction_timeout)
-            if now > timeout:
-                self._rollback_transaction()
-                raise ApiError(code='transaction_timed_out')
+    def _find_conflicts(self, revision, written_paths):
+        """
+        Returns those of written_paths (record paths as "path/key") changed
+        after revision, including by changes to a parent or child path. If the
+        journal no longer goes back that far, all are assumed to conflict.
+        """
+        written_paths = set(written_paths)
+        if not written_paths:
+            return []
+        if revision < self._journal_start:
+            return sorted(written_paths)
+        written_parents = set()
+        for written_path in written_paths:
+            written_parents.update(parent_paths(written_path))
+        conflicts = set()
+        for change in self._journal[bisect.bisect_right(self._journal_revs, revision):]:
+            changed_path = record_path(change['path'], change['key'])
+            if changed_path in written_paths:
+                conflicts.add(changed_path)
+            elif changed_path in written_parents:
+                conflicts.update(p for p in written_paths if p.startswith(changed_path + '/'))
+            else:
+                conflicts.update(p for p in parent_paths(changed_path) if p in written_paths)
+        return sorted(conflicts)
 
-    def _clear_transaction(self):
+    def _expire_transactions(self):
+        now = datetime.datetime.now()
+        for transaction in list(self._transactions.values()):
+            if transaction.has_timed_out(now):
+                self.expire_transaction(transaction.id)
+
+    @exclusive
+    def expire_transaction(self, transaction_id):
         """
-        To be called once a transaction is finished, regardless of outcome.
+        Drops the transaction's write set, returning whether it was open.
         """
-        self._transaction_id = None
-        self._revision_before_transaction = None
+        if self._transactions.pop(transaction_id, None) is None:
+            return False
+        self._expired_transaction_ids.append(transaction_id)
+        METRICS.inc('pointy_transactions_total', outcome='timed_out')
+        return True
+
 
-    def _rollback_transaction(self):
+class Transaction:
+    """
+    An open transaction. Its writes are kept in a private write set which
+    others don't see until it is committed.
+    """
+
+    def __init__(self, start_revision, timeout):
+        self.id = str(uuid.uuid4())
+        self.start_revision = start_revision
+        self.revision = start_revision
+        self.start_time = datetime.datetime.now()
+        self.timeout = timeout
+        self.changes = []
+        self._collections = {}
+
+    def has_timed_out(self, now):
+        return now > self.start_time + datetime.timedelta(seconds=self.timeout)
+
+    def add_change(self, op, path, key, record=None):
+        self.revision += 1
+        change = {'op': op, 'path': path, 'key': key}
+        if op != 'delete':
+            change['record'] = record
+        self.changes.append(change)
+        self._collections.setdefault(normalise_path(path), {})[key] = record
+
+    def mark(self):
+        return self.revision, len(self.changes)
+
+    def undo_to(self, mark):
         """
-        Annuls the current transaction.
+        Drops the changes added since mark() returned mark.
         """
-        assert self._transaction_id is not None
-        self._must_reload = True
-        self.revision = self._revision_before_transaction
-        self._clear_transaction()
+        self.revision, count = mark
+        del self.changes[count:]
+        self._index_changes()
+
+    def _index_changes(self):
+        self._collections = {}
+        for change in self.changes:
+            self._collections.setdefault(normalise_path(change['path']), {})[change['key']] = change.get('record')
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'start_revision': self.start_revision,
+            'revision': self.revision,
+            'start_time': self.start_time.timestamp(),
+            'timeout': self.timeout,
+            'changes': self.changes,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        transaction = cls(d['start_revision'], d['timeout'])
+        transaction.id = d['id']
+        transaction.revision = d['revision']
+        transaction.start_time = datetime.datetime.fromtimestamp(d['start_time'])
+        transaction.changes = d['changes']
+        transaction._index_changes()
+        return transaction
+
+    def view(self, path, collection):
+        """
+        Returns the collection as seen from within this transaction.
+        """
+        written = self._collections.get(normalise_path(path))
+        if not written:
+            return collection
+        collection = dict(collection)
+        for key, record in written.items():
+            if record is None:
+                collection.pop(key, None)
+            else:
+                collection[key] = record
+        return collection
+
+    def written_paths(self):
+        return [record_path(c['path'], c['key']) for c in self.changes if c['op'] != 'create']
 
 
 class ActionsMixin():
     """
     A mixin with the actions
     """
-    def push_actions(self, revision, action_sets, transaction_id=None):
+    @exclusive
+    def push_actions(self, revision, action_sets, transaction_id=None, stream=False):
         """
         @revision: the client stored revision (we will check if it matches)
         @transaction_id: the id of the open transaction (optional)
         @action_sets: changes to make.
+        @stream: return each query result as an iterator rather than a
+                 list. It walks a copy of the collection (sharing the
+                 records), so can be consumed after the store has changed.
 
         The action_sets dict may contain keys:
             create > dict
@@ -176,14 +1093,39 @@ class ActionsMixin():
             },
             "query_b": {                    # the return identifier
                 "path": "setting/13425",    # the json path
-            }
+            },
+            "query_c": {
+                "path": "some/collection",
+                "filter": {                 # optional, see query.py
+                    "status": "open",
+                    "age": {"gte": 18}
+                },
+                "sort": "-created",         # optional, "-" for descending
+                "limit": 50,                # optional
+                "offset": 100,              # optional
+                "fields": ["id", "name"]    # optional, only these fields
+            },
+            "query_d": {
+                "path": "some/collection",
+                "filter": {...},            # optional
+                "aggregate": {              # instead of the records
+                    "total": {"op": "count"},
+                    "spent": {"op": "sum", "field": "amount"},
+                    "oldest": {"op": "max", "field": "age"}
+                },
+                "group_by": "status"        # optional, a list of results
+            }                               # per value of status
         }
         result_example: {
             "revision": 1234,
             "new_ids": {...},
             "queries": {
                 "query_a": [...],
-                "query_b": {...}
+                "query_b": {...},
+                "query_d": [
+                    {"status": "open", "total": 3, "spent": 120, "oldest": 61},
+                    ...
+                ]
             }
         }
         The key is used to match the query results in the resuts>read dict
@@ -226,75 +1168,185 @@ class ActionsMixin():
 
 
         """
+        with METRICS.timer('pointy_push_actions_seconds'):
+            return self._push_actions(revision, action_sets, transaction_id, stream)
+
+    def _push_actions(self, revision, action_sets, transaction_id, stream):
         self.load()
-        self.check_transaction(transaction_id)
-        self.check_revision(revision)
-        new_ids = {}
-        queries = {}
-        if 'create' in action_sets:
-            for key, params in action_sets['create'].items():
-                new_ids[key] = self._create(**params)
-        if 'update' in action_sets:
-            for params in action_sets['update']:
-                self._update(**params)
-        if 'delete' in action_sets:
-            for params in action_sets['delete']:
-                self._delete(**params)
-        if 'read' in action_sets:
-            for key, params in action_sets['read'].items():
-                queries[key] = self._read(**params)
+        transaction = self.check_transaction(transaction_id)
+        written_paths = [
+            record_path(params['path'], params['key'])
+            for params in action_sets.get('update', []) + action_sets.get('delete', [])
+        ]
+        self.check_revision(revision, transaction, written_paths)
+        self._transaction = transaction
+        try:
+            new_ids = {}
+            queries = {}
+            # All writes or none, whether to the store or the transaction
+            with self._undoable(), self._undoable_in_transaction(transaction):
+                if 'create' in action_sets:
+                    for key, params in action_sets['create'].items():
+                        new_ids[key] = self._create(**params)
+                if 'update' in action_sets:
+                    for params in action_sets['update']:
+                        self._update(**params)
+                if 'delete' in action_sets:
+                    for params in action_sets['delete']:
+                        self._delete(**params)
+            if 'read' in action_sets:
+                read = functools.partial(self._iter_read, copy=True) if stream else self._read
+                for key, params in action_sets['read'].items():
+                    queries[key] = read(**params)
+        finally:
+            self._transaction = None
         result = {
-            'revision': self.revision,
+            'revision': self.revision if transaction is None else transaction.revision,
             'queries': queries,
             'new_ids': new_ids
         }
-        if transaction_id is None:
+        if transaction is None:
             self.save()
         return result
 
+    # Set by push_actions to the transaction the actions are part of, if any
+    _transaction = None
+
+    @contextlib.contextmanager
+    def _undoable_in_transaction(self, transaction):
+        if transaction is None:
+            yield
+            return
+        mark = transaction.mark()
+        try:
+            yield
+        except BaseException:
+            transaction.undo_to(mark)
+            raise
+
     def _drill(self, path):
-        collection = self.data
-        for chunk in path.split('/'):
-            if chunk != '':
-                if chunk not in collection:
-                    collection[chunk] = {}
-                collection = collection[chunk]
+        return drill(self.data, path)
+
+    def _view(self, path):
+        """
+        The collection at path as seen by the current transaction, if any.
+        """
+        collection = self._drill(path)
+        if self._transaction is not None:
+            collection = self._transaction.view(path, collection)
         return collection
 
+    def _write(self, op, path, key, record=None):
+        if self._transaction is not None:
+            self._transaction.add_change(op, path, key, record)
+        else:
+            self._apply_change(op, path, key, record)
+
     def _create(self, path, record):
-        collection = self._drill(path)
-        new_id = self.last_id
+        # Ids are allocated straight away, even in a transaction, so that
+        # concurrent transactions never hand out the same id
+        new_id = self.last_id + 1
         record['id'] = new_id
-        collection[new_id] = record
         self.last_id = new_id
-        self.revision += 1
+        self._write('create', path, new_id, record)
         return new_id
 
     def _update(self, path, key, record):
         """
         Update a record.
         """
-        collection = self._drill(path)
-        collection[key] = record
         record['id'] = key
-        self.revision += 1
+        self._write('update', path, key, record)
 
     def _delete(self, path, key):
         """
         Delete a record.
         """
-        collection = self._drill(path)
-        del collection[key]
-        self.revision += 1
+        if key not in self._view(path):
+            raise KeyError(key)
+        self._write('delete', path, key)
 
-    def _read(self, path):
+    def _read(self, path, filter=None, sort=None, limit=None, offset=0,
+              fields=None, aggregate=None, group_by=None):
         """
-        Reads a collection.
-        TODO: allow filtering (but really, just structure it differently...)
+        Reads a collection, optionally filtered, sorted and paged, returning
+        only the given fields of each record or aggregates over the matching
+        records (see query.aggregate).
         """
-        collection = self._drill(path)
-        return list(collection.values())
+        args = (path, filter, sort, limit, offset, fields, aggregate, group_by)
+        if self._view(path) is not self._drill(path) or not self._query_cache.max_bytes:
+            result = self._iter_read(*args)
+            return result if aggregate is not None else list(result)
+        options = [filter, sort, limit, offset, fields, aggregate, group_by]
+        result = self._query_cache.get(normalise_path(path), options)
+        if result is None:
+            result = self._query_cache.put(normalise_path(path), options, self._iter_read(*args))
+        return result
+
+    def _iter_read(self, path, filter=None, sort=None, limit=None, offset=0,
+                   fields=None, aggregate=None, group_by=None, copy=False):
+        """
+        As _read, but returns an iterator. With copy set it walks copies of
+        the collection and its indexes, rather than the live ones.
+        """
+        collection = self._view(path)
+        indexes = None
+        if collection is self._drill(path):
+            # Indexes only cover committed data, not a transaction's writes
+            indexes = self._get_indexes(path)
+        if aggregate is not None:
+            # Paging applies to records, aggregates are over all matches
+            if isinstance(collection, ColumnarCollection):
+                return collection.aggregate(parse_filter(filter), aggregate, group_by)
+            return aggregate_records(run_query(collection, filter, indexes=indexes), aggregate, group_by)
+        if copy:
+            collection = collection.copy() if isinstance(collection, ColumnarCollection) else dict(collection)
+            indexes = {field: index.copy() for field, index in (indexes or {}).items()}
+        records = run_query(collection, filter, sort, limit, offset, indexes)
+        if fields is not None:
+            records = project(records, fields)
+        return records
 
 
 class MyJsonStorageHandler(ActionsMixin, JsonTwoFileStorageHandler):
-    pass
\ No newline at end of file
+    pass
+
+def open_store_dir(store_dir, multiprocess=False):
+    """
+    Opens a store laid out as bottle_app lays them out, with or without a
+    change log or collection files.
+    """
+    def path(name):
+        return os.path.join(store_dir, name)
+    collection_files = os.path.isdir(path('data'))
+    log_db_path = None
+    if not collection_files and os.path.exists(path('changes.log')):
+        log_db_path = path('changes.log')
+    replication_log_path = None
+    if os.path.exists(path('replication.log')):
+        replication_log_path = path('replication.log')
+    return MyJsonStorageHandler(
+        path('data') if collection_files else path('data.json'), path('meta_data.json'),
+        log_db_path, journal_db_path=path('journal.log'),
+        collection_files=collection_files, multiprocess=multiprocess,
+        replication_log_path=replication_log_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bulk NDJSON export and import of a store')
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('store_dir', help='The directory holding the store files')
+    parser.add_argument('--path', default='', help='Export only the records under this path')
+    parser.add_argument('--file', help='File to export to or import from, instead of stdout/stdin')
+    parser.add_argument('--multiprocess', action='store_true',
+                        help='Lock the store, as when served in multiprocess mode')
+    args = parser.parse_args()
+    store = open_store_dir(args.store_dir, args.multiprocess)
+    if args.command == 'export':
+        with open(args.file, 'w') if args.file else sys.stdout as fp:
+            for line in store.export_records(args.path):
+                fp.write(line)
+    else:
+        with open(args.file) if args.file else sys.stdin as fp:
+            result = store.import_records(line.rstrip('\n') for line in fp)
+        print('Imported {} records, now at revision {}'.format(result['imported'], result['revision']))
@@ -0,0 +1,150 @@
+"""
+In-process metrics, rendered in the Prometheus text format.
+
+Instrumented code calls METRICS.inc / METRICS.observe / METRICS.timer, which
+do nothing but check a flag when metrics are disabled (set POINTY_METRICS=0
+or call METRICS.disable()).
+"""
+import bisect
+import contextlib
+import os
+import threading
+import time
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    """
+    Counters and histograms keyed by name and labels, plus collectors: functions
+    called at render time which return a list of (name, labels, value) gauges.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._counters = {}
+        self._histograms = {}
+        self._help = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def describe(self, name, help):
+        self._help[name] = help
+
+    def inc(self, name, amount=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram(buckets)
+            self._histograms[key].observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """
+        Observes the time taken by the with block, in seconds.
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def get(self, name, **labels):
+        """
+        The value of a counter, or the count of a histogram.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key in self._histograms:
+                return self._histograms[key].count
+            return self._counters.get(key, 0)
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+            self._histograms = {}
+
+    def render(self):
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items(), key=lambda item: item[0])
+        gauges = []
+        for collector in self._collectors:
+            gauges.extend((name, tuple(sorted(labels.items())), value) for name, labels, value in collector())
+        # Label values may be of any type, compare them as rendered
+        gauges.sort(key=lambda gauge: (gauge[0], [(k, str(v)) for k, v in gauge[1]]))
+
+        def header(name, metric_type):
+            if name in self._help:
+                lines.append('# HELP {} {}'.format(name, self._help[name]))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+
+        last_name = None
+        for (name, labels), value in counters:
+            if name != last_name:
+                header(name, 'counter')
+                last_name = name
+            lines.append('{}{} {}'.format(name, format_labels(labels), value))
+        for (name, labels), histogram in histograms:
+            if name != last_name:
+                header(name, 'histogram')
+                last_name = name
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    name, format_labels(labels + (('le', bound),)), cumulative))
+            lines.append('{}_sum{} {}'.format(name, format_labels(labels), histogram.sum))
+            lines.append('{}_count{} {}'.format(name, format_labels(labels), histogram.count))
+        for name, labels, value in gauges:
+            if name != last_name:
+                header(name, 'gauge')
+                last_name = name
+            lines.append('{}{} {}'.format(name, format_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(
+        k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) + '}'
+
+
+METRICS = Registry(enabled=os.environ.get('POINTY_METRICS', '1') != '0')
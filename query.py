@@ -0,0 +1,364 @@
+"""
+Filtering, sorting and paging of collections, with optional secondary
+indexes to avoid scanning the whole collection, and a cache of results.
+
+A filter is a dict of field to either a value (equality) or a dict of
+operators:
+
+    {"status": "open", "age": {"gte": 18, "lt": 65}, "tag": {"in": ["a", "b"]}}
+
+Values of different types never raise when compared, they are ordered by
+type: None, booleans, numbers, strings, then anything else.
+
+Instead of the records themselves a query may return only some of their
+fields, or aggregates over them, optionally per value of a field:
+
+    {"total": {"op": "count"}, "spent": {"op": "sum", "field": "amount"}}
+"""
+import bisect
+import collections
+import itertools
+import ujson
+from pointy.utils import ApiError, SerializedList, SerializedDict
+from pointy.metrics import METRICS
+
+OPERATORS = ('eq', 'gt', 'gte', 'lt', 'lte', 'in')
+AGGREGATES = ('count', 'sum', 'min', 'max')
+# Greater than any sort_key, used to bisect past all entries with a value
+_MAX_KEY = (5,)
+
+
+def sort_key(value):
+    if value is None:
+        return (0, 0)
+    if isinstance(value, bool):
+        return (1, value)
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, str):
+        return (3, value)
+    return (4, str(value))
+
+
+def parse_filter(filter):
+    """
+    Returns the filter as a list of (field, op, value).
+    """
+    conditions = []
+    for field, condition in (filter or {}).items():
+        if isinstance(condition, dict):
+            for op, value in condition.items():
+                if op not in OPERATORS:
+                    raise ApiError(code='invalid_query', msg='Unknown operator: {}'.format(op))
+                conditions.append((field, op, value))
+        else:
+            conditions.append((field, 'eq', condition))
+    return conditions
+
+
+def matches(record, conditions):
+    for field, op, value in conditions:
+        actual = record.get(field)
+        if op == 'eq':
+            if actual != value:
+                return False
+        elif op == 'in':
+            if actual not in value:
+                return False
+        else:
+            actual, value = sort_key(actual), sort_key(value)
+            if op == 'gt' and not actual > value:
+                return False
+            if op == 'gte' and not actual >= value:
+                return False
+            if op == 'lt' and not actual < value:
+                return False
+            if op == 'lte' and not actual <= value:
+                return False
+    return True
+
+
+class SortedIndex:
+    """
+    Keys of a collection sorted by the value of one field.
+    """
+
+    def __init__(self, field, collection=None):
+        self.field = field
+        self._entries = []
+        self._entry_by_key = {}
+        if collection is not None:
+            for key, record in collection.items():
+                self._entry_by_key[key] = self._entry(key, record)
+            self._entries = sorted(self._entry_by_key.values())
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, key, record):
+        self.remove(key)
+        entry = self._entry(key, record)
+        self._entry_by_key[key] = entry
+        bisect.insort(self._entries, entry)
+
+    def remove(self, key):
+        entry = self._entry_by_key.pop(key, None)
+        if entry is not None:
+            del self._entries[bisect.bisect_left(self._entries, entry)]
+
+    def copy(self):
+        copied = SortedIndex(self.field)
+        copied._entries = self._entries[:]
+        copied._entry_by_key = dict(self._entry_by_key)
+        return copied
+
+    def keys(self, op='eq', value=None, descending=False):
+        """
+        Keys whose value satisfies op, in order of value. With no op given
+        (op=None) returns all keys.
+        """
+        if op == 'in':
+            return itertools.chain.from_iterable(self.keys('eq', v) for v in value)
+        start, end = self._range(op, value)
+        positions = range(end - 1, start - 1, -1) if descending else range(start, end)
+        # Read entries by position rather than slicing, so walking the first
+        # few of a large index doesn't copy the rest
+        return (self._entries[i][2] for i in positions)
+
+    def count(self, op, value):
+        if op == 'in':
+            return sum(self.count('eq', v) for v in value)
+        start, end = self._range(op, value)
+        return end - start
+
+    def _range(self, op, value):
+        entries = self._entries
+        if op is None:
+            return 0, len(entries)
+        value = sort_key(value)
+        below = bisect.bisect_left(entries, (value,))
+        above = bisect.bisect_left(entries, (value, _MAX_KEY))
+        return {
+            'eq': (below, above),
+            'gt': (above, len(entries)),
+            'gte': (below, len(entries)),
+            'lt': (0, below),
+            'lte': (0, above),
+        }[op]
+
+    def _entry(self, key, record):
+        return (sort_key(record.get(self.field)), sort_key(key), key)
+
+
+def run_query(collection, filter=None, sort=None, limit=None, offset=0, indexes=None):
+    """
+    Returns an iterator over the matching records of collection.
+
+    @sort: a field name, prefixed with "-" for descending order.
+    @indexes: a dict of field to SortedIndex over this collection.
+
+    At most one index is used, either to narrow down the candidates for a
+    filter condition or to walk the records in sort order, whichever looks
+    like it touches fewer records.
+    """
+    conditions = parse_filter(filter)
+    indexes = indexes or {}
+    descending = sort is not None and sort.startswith('-')
+    sort_field = sort.lstrip('-') if sort is not None else None
+    offset = int(offset or 0)
+    wanted = None if limit is None else offset + int(limit)
+
+    best = None
+    for i, (field, op, value) in enumerate(conditions):
+        if field in indexes:
+            count = indexes[field].count(op, value)
+            if best is None or count < best[0]:
+                best = (count, i)
+
+    sorted_walk_cost = None
+    if sort_field in indexes and wanted is not None:
+        # Walking in sort order stops after `wanted` matches, which takes
+        # about wanted / selectivity records
+        candidates = best[0] if best is not None else len(collection)
+        sorted_walk_cost = wanted * len(collection) / max(candidates, 1)
+
+    if sorted_walk_cost is not None and (best is None or sorted_walk_cost < best[0]):
+        keys = indexes[sort_field].keys(None, descending=descending)
+        records = (collection[key] for key in keys)
+        sort_field = None
+    elif best is not None:
+        field, op, value = conditions.pop(best[1])
+        in_sort_order = sort_field == field and op != 'in'
+        keys = indexes[field].keys(op, value, descending and in_sort_order)
+        if in_sort_order:
+            sort_field = None
+        records = (collection[key] for key in keys)
+    elif conditions and hasattr(collection, 'matching_keys'):
+        # Columnar collections filter without building each record
+        records = (collection[key] for key in collection.matching_keys(conditions))
+        conditions = []
+    else:
+        records = iter(collection.values())
+
+    if conditions:
+        records = (record for record in records if matches(record, conditions))
+    if sort_field is not None:
+        records = iter(sorted(
+            records,
+            key=lambda record: sort_key(record.get(sort_field)),
+            reverse=descending
+        ))
+    return itertools.islice(records, offset, wanted)
+
+
+def project(records, fields):
+    """
+    The records with only the given fields (those they have).
+    """
+    for record in records:
+        yield {field: record[field] for field in fields if field in record}
+
+
+def parse_aggregates(aggregates):
+    """
+    Returns the aggregates as a list of (name, op, field).
+    """
+    if not isinstance(aggregates, dict):
+        raise ApiError(code='invalid_query', msg='Aggregates must be given as a dict')
+    parsed = []
+    for name, spec in aggregates.items():
+        if not isinstance(spec, dict):
+            raise ApiError(code='invalid_query', msg='Aggregate {} must be given as a dict'.format(name))
+        op = spec.get('op')
+        field = spec.get('field')
+        if op not in AGGREGATES:
+            raise ApiError(code='invalid_query', msg='Unknown aggregate: {}'.format(op))
+        if field is None and op != 'count':
+            raise ApiError(code='invalid_query', msg='Aggregate {} needs a field'.format(name))
+        parsed.append((name, op, field))
+    return parsed
+
+
+def aggregate(records, aggregates, group_by=None):
+    """
+    Computes aggregates over records in one pass.
+
+    @aggregates: a dict of result name to {"op": ..., "field": ...}, where op
+                 is count (of records, or of those with field set), or sum,
+                 min or max of field. Records without a value (or, for sum, a
+                 numeric value) for the field are skipped.
+    @group_by: a field name. If given, returns a list of dicts, one per value
+               of the field in sort order, each holding the field's value and
+               the aggregates over the records with that value.
+    """
+    return aggregate_rows(records, _record_value, aggregates, group_by)
+
+
+def aggregate_rows(rows, get, aggregates, group_by=None):
+    """
+    As aggregate, over rows whose field values are read with get(row, field),
+    which returns None for a row without the field.
+    """
+    parsed = parse_aggregates(aggregates)
+    groups = {}
+    for row in rows:
+        group_value = get(row, group_by) if group_by is not None else None
+        group_key = sort_key(group_value)
+        results = groups.get(group_key)
+        if results is None:
+            results = groups[group_key] = {group_by: group_value} if group_by is not None else {}
+            for name, op, field in parsed:
+                results[name] = 0 if op in ('count', 'sum') else None
+        for name, op, field in parsed:
+            if field is None:
+                results[name] += 1
+                continue
+            value = get(row, field)
+            if value is None:
+                continue
+            if op == 'count':
+                results[name] += 1
+            elif op == 'sum':
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    results[name] += value
+            else:
+                current = results[name]
+                if current is None:
+                    results[name] = value
+                elif op == 'min' and sort_key(value) < sort_key(current):
+                    results[name] = value
+                elif op == 'max' and sort_key(value) > sort_key(current):
+                    results[name] = value
+    if group_by is not None:
+        return [groups[key] for key in sorted(groups)]
+    if not groups:
+        return {name: 0 if op in ('count', 'sum') else None for name, op, field in parsed}
+    return groups[sort_key(None)]
+
+
+def _record_value(record, field):
+    return record.get(field)
+
+
+class QueryCache:
+    """
+    Results of reads, serialized, by collection path and query options.
+    Least recently used results go once over max_bytes.
+
+    A change to a record must be passed to invalidate(), which drops the
+    results for its collection and the collections above and below it.
+    """
+
+    def __init__(self, max_bytes=8 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._results = collections.OrderedDict()
+        self._options_by_path = {}
+
+    def get(self, path, options):
+        key = (path, ujson.dumps(options, sort_keys=True))
+        result = self._results.get(key)
+        if result is None:
+            METRICS.inc('pointy_query_cache_total', result='miss')
+        else:
+            METRICS.inc('pointy_query_cache_total', result='hit')
+            self._results.move_to_end(key)
+        return result
+
+    def put(self, path, options, result):
+        """
+        Caches a result, either records or aggregates, returning it as a
+        SerializedList or SerializedDict.
+        """
+        result = SerializedDict(result) if isinstance(result, dict) else SerializedList(result)
+        if len(result.json) > self.max_bytes:
+            return result
+        key = (path, ujson.dumps(options, sort_keys=True))
+        self._drop(key)
+        self._results[key] = result
+        self._options_by_path.setdefault(path, set()).add(key[1])
+        self.bytes += len(result.json)
+        while self.bytes > self.max_bytes:
+            self._drop(next(iter(self._results)))
+        return result
+
+    def invalidate(self, record_path):
+        for path in list(self._options_by_path):
+            if path == '' or path == record_path or record_path.startswith(path + '/') \
+                    or path.startswith(record_path + '/'):
+                for options in list(self._options_by_path.get(path, ())):
+                    self._drop((path, options))
+
+    def clear(self):
+        self._results.clear()
+        self._options_by_path = {}
+        self.bytes = 0
+
+    def _drop(self, key):
+        result = self._results.pop(key, None)
+        if result is not None:
+            self.bytes -= len(result.json)
+            options = self._options_by_path[key[0]]
+            options.discard(key[1])
+            if not options:
+                del self._options_by_path[key[0]]
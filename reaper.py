@@ -0,0 +1,99 @@
+"""
+Expires timed out transactions in a background thread, so an abandoned
+transaction is dropped once its timeout passes rather than whenever its
+store next gets a request.
+"""
+import datetime
+import math
+import threading
+import time
+import weakref
+from pointy.metrics import METRICS
+
+
+class TimerWheel:
+    """
+    Items scheduled by deadline in a ring of slots, each slot covering `tick`
+    seconds. Adding an item and popping due ones cost the same however many
+    items are scheduled. Items more than a turn of the wheel ahead stay in
+    their slot until the turn they're due on.
+    """
+
+    def __init__(self, tick=0.1, slots=512, clock=time.monotonic):
+        self.tick = tick
+        self._slots = [[] for i in range(slots)]
+        self._clock = clock
+        # The last tick whose slot was emptied of due items
+        self._current = int(clock() / tick)
+        self._lock = threading.Lock()
+
+    def add(self, deadline, item):
+        with self._lock:
+            due_tick = max(math.ceil(deadline / self.tick), self._current + 1)
+            self._slots[due_tick % len(self._slots)].append((due_tick, item))
+
+    def pop_due(self):
+        """
+        Removes and returns the items whose deadline has passed.
+        """
+        now_tick = int(self._clock() / self.tick)
+        due = []
+        with self._lock:
+            # After a long pause, visiting each slot once is enough
+            first = max(self._current + 1, now_tick - len(self._slots) + 1)
+            for tick in range(first, now_tick + 1):
+                slot = self._slots[tick % len(self._slots)]
+                if slot:
+                    due.extend(item for due_tick, item in slot if due_tick <= now_tick)
+                    slot[:] = [entry for entry in slot if entry[0] > now_tick]
+            self._current = max(self._current, now_tick)
+        return due
+
+
+class TransactionReaper:
+    """
+    Expires transactions as their timeouts pass, across any number of
+    stores. Stores call schedule() as transactions start, and are only
+    weakly referenced so evicted stores can still be freed.
+
+    The thread is started with the first transaction scheduled.
+    """
+
+    def __init__(self, tick=0.1, slots=512):
+        self._wheel = TimerWheel(tick, slots)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def schedule(self, store, transaction):
+        self._wheel.add(time.monotonic() + transaction.timeout, (weakref.ref(store), transaction))
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def reap(self):
+        """
+        Expires the transactions now due, returning how many were expired.
+        """
+        expired = 0
+        now = datetime.datetime.now()
+        for store_ref, transaction in self._wheel.pop_due():
+            store = store_ref()
+            if store is None:
+                continue
+            if transaction.has_timed_out(now):
+                expired += store.expire_transaction(transaction.id)
+            else:
+                # The wall clock lagged the wheel's, try again next tick
+                self._wheel.add(time.monotonic(), (store_ref, transaction))
+        if expired:
+            METRICS.inc('pointy_transactions_reaped_total', expired)
+        return expired
+
+    def _run(self):
+        while True:
+            time.sleep(self._wheel.tick)
+            try:
+                self.reap()
+            except Exception:
+                METRICS.inc('pointy_transaction_reaper_errors_total')
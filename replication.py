@@ -0,0 +1,175 @@
+"""
+Read replicas of a store, to spread reads over more processes.
+
+The primary (a store given a replication_log_path) appends each change set
+it saves to the replication log. A replica loads the primary's files once,
+then before each call applies the change sets appended since its last one,
+so it serves reads at a known revision a little behind the primary's.
+
+Replaying a change is harmless (records are set or removed as a whole), so
+a replica which loaded files a little newer than their revision converges
+as it replays the log. If the log doesn't reach back to the replica's
+revision (it was trimmed, or the store was bulk imported) the replica loads
+the primary's files again.
+"""
+import os
+import time
+import ujson
+from pointy.json_storage import MyJsonStorageHandler, WATCH_POLL_INTERVAL, QUERY_CACHE_MAX_BYTES
+from pointy.utils import ApiError
+from pointy.metrics import METRICS
+
+# Enough of the start of a log to tell it from a rewrite of the log, whose
+# first entry has another revision
+LOG_HEAD_BYTES = 64
+
+
+class LogTail:
+    """
+    Reads the lines appended to a file since the last read, starting over
+    when the file is replaced. A partly written last line is left for the
+    next read.
+    """
+
+    def __init__(self, filepath):
+        self._filepath = filepath
+        self._inode = None
+        self._head = b''
+        self._offset = 0
+
+    def restart(self):
+        self._offset = 0
+
+    def read_new(self):
+        try:
+            fp = open(self._filepath, 'rb')
+        except FileNotFoundError:
+            return []
+        with fp:
+            stat = os.fstat(fp.fileno())
+            head = fp.read(LOG_HEAD_BYTES)
+            # A replaced file's inode may be reused, so check its start too
+            if stat.st_ino != self._inode or stat.st_size < self._offset or not head.startswith(self._head):
+                self._inode = stat.st_ino
+                self._offset = 0
+            self._head = head
+            fp.seek(self._offset)
+            text = fp.read()
+        text = text[:text.rfind(b'\n') + 1]
+        self._offset += len(text)
+        return [ujson.loads(line) for line in text.splitlines() if line.strip()]
+
+
+class ReplicaStorageHandler(MyJsonStorageHandler):
+    """
+    A read only copy of the store whose files are at data_db_path and
+    metadata_db_path (and log_db_path, or collection_files, as the primary
+    uses them), following the primary's replication log.
+
+    Only reads are served: other calls raise an ApiError with code
+    'read_only', and nothing is ever written to the primary's files.
+    """
+
+    def __init__(self, data_db_path, metadata_db_path, replication_log_path, log_db_path=None,
+                 collection_files=False, indexes=None, columnar=None,
+                 query_cache_max_bytes=QUERY_CACHE_MAX_BYTES):
+        super().__init__(data_db_path, metadata_db_path, log_db_path, indexes=indexes,
+                         collection_files=collection_files, columnar=columnar,
+                         query_cache_max_bytes=query_cache_max_bytes)
+        self._tail = LogTail(replication_log_path)
+
+    @property
+    def watch_poll_interval(self):
+        # Nothing saves a replica, so watchers must poll the log
+        return WATCH_POLL_INTERVAL
+
+    def load(self):
+        if self._must_reload:
+            self._load_files()
+        self.catch_up()
+
+    def catch_up(self):
+        """
+        Applies the change sets the primary saved since the last call,
+        returning how many changes were applied.
+        """
+        applied, behind = self._apply_new_entries()
+        if behind:
+            self._reload()
+            applied, behind = self._apply_new_entries()
+            if behind:
+                # The files are behind the log, try again next call
+                self._tail.restart()
+        return applied
+
+    def _apply_new_entries(self):
+        """
+        Returns how many changes were applied, and whether the log skips
+        ahead of the revision.
+        """
+        applied = 0
+        for entry in self._tail.read_new():
+            if entry['rev'] <= self.revision:
+                continue
+            if entry.get('resync') or entry['changes'][0]['rev'] > self.revision + 1:
+                return applied, True
+            count = self.apply_changes(entry['changes'])
+            applied += count
+            METRICS.inc('pointy_replication_changes_applied_total', count)
+            METRICS.observe('pointy_replication_lag_seconds', time.time() - entry['time'])
+        return applied, False
+
+    def _reload(self):
+        METRICS.inc('pointy_replica_reloads_total')
+        self._data_file_wrapper.load(force=True)
+        self._meta_file_wrapper.load(force=True)
+        self._must_reload = True
+        self._load_files()
+        self._tail.restart()
+
+    def _load_files(self):
+        super().load()
+        if self._collection_files:
+            # Parse every collection now, while they match the revision
+            for name in self.data:
+                self.data[name]
+
+    def save(self):
+        self._pending_changes = []
+
+    def push_actions(self, revision, action_sets, transaction_id=None, stream=False):
+        if transaction_id is not None or set(action_sets) - {'read'}:
+            raise_read_only()
+        return super().push_actions(revision, action_sets, stream=stream)
+
+    def start_transaction(self, *args, **kwargs):
+        raise_read_only()
+
+    def commit_transaction(self, *args, **kwargs):
+        raise_read_only()
+
+    def abort_transaction(self, *args, **kwargs):
+        raise_read_only()
+
+    def import_records(self, *args, **kwargs):
+        raise_read_only()
+
+
+def raise_read_only():
+    raise ApiError(code='read_only', msg='Replicas only serve reads, send writes to the primary')
+
+
+def open_replica_dir(store_dir):
+    """
+    Opens a replica of the store in store_dir, laid out as bottle_app lays
+    them out with JSON_REPLICATION set.
+    """
+    def path(name):
+        return os.path.join(store_dir, name)
+    collection_files = os.path.isdir(path('data'))
+    log_db_path = None
+    if not collection_files and os.path.exists(path('changes.log')):
+        log_db_path = path('changes.log')
+    return ReplicaStorageHandler(
+        path('data') if collection_files else path('data.json'), path('meta_data.json'),
+        path('replication.log'), log_db_path, collection_files=collection_files)
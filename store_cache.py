@@ -0,0 +1,85 @@
+"""
+A bounded cache of open stores.
+"""
+import collections
+import threading
+
+
+class StoreCache:
+    """
+    Least recently used cache of stores, limited both in number of stores
+    and in their estimated size in bytes. Stores with open transactions are
+    never evicted, so the limits may be exceeded while they're open.
+
+    @open_store: function taking a key and returning a new store.
+    """
+
+    def __init__(self, open_store, max_entries=1000, max_bytes=512 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._open_store = open_store
+        self._stores = collections.OrderedDict()
+        self._sizes = {}
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self._stores
+
+    def __len__(self):
+        return len(self._stores)
+
+    @property
+    def total_bytes(self):
+        return self._total_bytes
+
+    def values(self):
+        with self._lock:
+            return list(self._stores.values())
+
+    def get(self, key):
+        with self._lock:
+            if key in self._stores:
+                self.hits += 1
+                self._stores.move_to_end(key)
+                store = self._stores[key]
+            else:
+                self.misses += 1
+                store = self._stores[key] = self._open_store(key)
+            self._set_size(key, store.estimated_size)
+            self._evict(keep=key)
+            return store
+
+    def peek(self, key):
+        """
+        The store for key if it's open, without opening it or counting a
+        hit or miss.
+        """
+        with self._lock:
+            return self._stores.get(key)
+
+    def stats(self):
+        return {
+            'entries': len(self._stores),
+            'bytes': self._total_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def _set_size(self, key, size):
+        self._total_bytes += size - self._sizes.get(key, 0)
+        self._sizes[key] = size
+
+    def _evict(self, keep):
+        for key in list(self._stores):
+            if len(self._stores) <= self.max_entries and self._total_bytes <= self.max_bytes:
+                return
+            if key == keep or self._stores[key].has_open_transactions:
+                continue
+            del self._stores[key]
+            self._total_bytes -= self._sizes.pop(key)
+            self.evictions += 1
@@ -1,5 +1,8 @@
+import os
+import pytest
 from cryptography.fernet import Fernet
-from ..accounts import AccountRegister
+from ..accounts import AccountRegister, ShardedAccountRegister, migrate_to_shards
+from ..utils import ApiError
 from .utils_for_tests import wipe_json_dbs, tmp_db_file
 
 '''
@@ -49,3 +52,76 @@ def test_password_matching():
     assert ar.password_matches('bob', 'new_pass')
     assert not ar.password_matches('bob', '1234')
 
+
+
+def test_password_check_remembered_until_password_changed():
+    ar = new_account_register()
+    ar.create_user('bob', '1234')
+    assert ar.password_matches('bob', '1234')
+    ar._cipher_suite = None  # Any decryption would now fail
+    assert ar.password_matches('bob', '1234')
+    with pytest.raises(AttributeError):
+        ar.password_matches('bob', 'wrong')
+
+
+def test_session_token():
+    ar = new_account_register()
+    ar.create_user('bob', '1234')
+    ar.add_user_app('bob', 'app1')
+    token = ar.issue_session_token('bob', 'app1')['token']
+    assert ar.verify_session_token(token, 'app1') == 'bob'
+    for bad_token, app in [(token, 'app2'), (token + '0', 'app1'), ('nonsense', 'app1')]:
+        with pytest.raises(ApiError) as err:
+            ar.verify_session_token(bad_token, app)
+        assert err.value.code == 'invalid_session'
+
+
+def test_session_token_invalidated():
+    ar = new_account_register()
+    ar.create_user('bob', '1234')
+    ar.add_user_app('bob', 'app1')
+    token = ar.issue_session_token('bob', 'app1')['token']
+    ar.change_password('bob', 'new_pass')
+    with pytest.raises(ApiError):
+        ar.verify_session_token(token, 'app1')
+    token = ar.issue_session_token('bob', 'app1')['token']
+    ar.remove_user_app('bob', 'app1')
+    with pytest.raises(ApiError):
+        ar.verify_session_token(token, 'app1')
+
+
+def test_session_token_expires():
+    ar = AccountRegister(SECRET_KEY, tmp_db_file('account_register'), session_ttl=-1)
+    ar.create_user('bob', '1234')
+    ar.add_user_app('bob', 'app1')
+    token = ar.issue_session_token('bob', 'app1')['token']
+    with pytest.raises(ApiError) as err:
+        ar.verify_session_token(token, 'app1')
+    assert err.value.code == 'session_expired'
+
+
+def test_sharded_register():
+    db_dir = tmp_db_file('sharded_register')
+    ar = ShardedAccountRegister(SECRET_KEY, db_dir, shard_count=4)
+    usernames = ['user{}'.format(i) for i in range(20)]
+    for username in usernames:
+        ar.create_user(username, username + '_pass')
+        ar.add_user_app(username, 'app1')
+    assert len(os.listdir(db_dir)) == 5
+
+    reopened = ShardedAccountRegister(SECRET_KEY, db_dir, shard_count=8)
+    for username in usernames:
+        assert reopened.has_account_for_app(username, 'app1')
+        assert reopened.password_matches(username, username + '_pass')
+    assert not reopened.user_exists('bob')
+
+
+def test_migrate_to_shards():
+    ar = new_account_register()
+    ar.create_user('bob', '1234')
+    ar.add_user_app('bob', 'app1')
+    db_dir = tmp_db_file('migrated_register')
+    migrate_to_shards(ar._db._filepath, db_dir, shard_count=4)
+    sharded = ShardedAccountRegister(SECRET_KEY, db_dir)
+    assert sharded.has_account_for_app('bob', 'app1')
+    assert sharded.password_matches('bob', '1234')
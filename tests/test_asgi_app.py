@@ -0,0 +1,64 @@
+import asyncio
+import ujson
+from ..benchmarks.in_process import APP, setup_apps, auth_header
+from ..metrics import METRICS
+from .utils_for_tests import tmp_db_file
+import asgi_app
+
+
+def call(method, path, authorization=None, body=b'', query_string=b''):
+    headers = [] if authorization is None else [(b'authorization', authorization.encode('latin-1'))]
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query_string,
+             'headers': headers}
+    asyncio.run(asgi_app.application(scope, receive, send))
+    start = sent[0]
+    response_headers = {k.decode('latin-1'): v.decode('latin-1') for k, v in start['headers']}
+    return start['status'], response_headers, b''.join(m.get('body', b'') for m in sent[1:])
+
+
+def test_login_issues_session_token_for_later_calls():
+    setup_apps(tmp_db_file('apps'), ['tim'])
+    status, headers, body = call('POST', '/{}/login'.format(APP), auth_header('tim'))
+    assert status == 200
+    token = ujson.loads(body)['data']['token']
+    read = ujson.dumps({'revision': 0, 'action_sets': {'read': {'r': {'path': 'records'}}}})
+    status, headers, body = call('POST', '/{}/push_actions'.format(APP), 'Bearer ' + token,
+                                 read.encode('utf-8'))
+    assert ujson.loads(body)['status'] == 'success'
+
+
+def test_login_without_credentials_or_account():
+    setup_apps(tmp_db_file('apps'), ['tim'])
+    status, headers, body = call('POST', '/{}/login'.format(APP))
+    assert status == 401 and 'www-authenticate' in headers
+    status, headers, body = call('POST', '/{}/login'.format(APP), auth_header('sam'))
+    assert status == 403
+
+
+def test_unknown_apps_and_methods_share_metric_series():
+    setup_apps(tmp_db_file('apps'), ['tim'])
+    status, headers, body = call('POST', '/evil/m0', auth_header('tim'))
+    assert status == 404
+    assert 'evil' not in METRICS.render()
+
+
+def test_browsers_may_revalidate_cross_origin():
+    status, headers, body = call('OPTIONS', '/{}/push_actions'.format(APP))
+    assert 'If-None-Match' in headers['access-control-allow-headers']
+    assert 'X-Session-Token' in headers['access-control-allow-headers']
+    assert headers['access-control-expose-headers'] == 'ETag'
+
+
+def test_watch_with_invalid_revision_is_bad_request():
+    setup_apps(tmp_db_file('apps'), ['tim'])
+    status, headers, body = call('GET', '/{}/watch'.format(APP), auth_header('tim'),
+                                 query_string=b'revision=abc')
+    assert status == 400
@@ -0,0 +1,69 @@
+import os
+import pytest
+from .. import backup
+from ..backup import snapshot_all, restore
+from ..json_storage import open_store_dir
+from .utils_for_tests import tmp_db_file
+
+
+def create_store(base_dir, app, user, name):
+    store_dir = os.path.join(base_dir, app, user)
+    os.makedirs(store_dir)
+    store = open_store_dir(store_dir)
+    store.push_actions(0, {'create': {'a': {'path': 'people', 'record': {'name': name}}}})
+    return store_dir
+
+
+def test_snapshot_all_stores_then_restore():
+    root = tmp_db_file('backup')
+    base_dir = os.path.join(root, 'base')
+    store_dirs = [create_store(base_dir, 'pointy_v2', 'tim', 'tim'),
+                  create_store(base_dir, 'pointy_v2', 'ann', 'ann')]
+    os.makedirs(os.path.join(base_dir, 'accounts'))
+    dest_dir = os.path.join(root, 'backups')
+    results = snapshot_all(base_dir, dest_dir, concurrency=2)
+    assert results == {store_dir: {'revision': 1, 'last_id': 1} for store_dir in store_dirs}
+
+    restored_dir = os.path.join(root, 'restored')
+    restore(os.path.join(dest_dir, 'pointy_v2', 'ann.json.gz'), restored_dir)
+    restored = open_store_dir(restored_dir)
+    result = restored.push_actions(1, {'read': {'people': {'path': 'people'}}})
+    assert result['queries']['people'] == [{'id': 1, 'name': 'ann'}]
+    with pytest.raises(ValueError):
+        restore(os.path.join(dest_dir, 'pointy_v2', 'tim.json.gz'), restored_dir)
+
+
+def test_snapshot_leaves_store_files_alone():
+    root = tmp_db_file('backup_read_only')
+    base_dir = os.path.join(root, 'base')
+    store_dir = create_store(base_dir, 'pointy_v2', 'tim', 'tim')
+    names = sorted(os.listdir(store_dir))
+    # A journal which doesn't lead up to the revision is reset on load
+    journal = '{"rev": 9, "op": "delete", "path": "people", "key": 1}\n'
+    with open(os.path.join(store_dir, 'journal.log'), 'w') as fp:
+        fp.write(journal)
+    results = snapshot_all(base_dir, os.path.join(root, 'backups'))
+    assert results == {store_dir: {'revision': 1, 'last_id': 1}}
+    assert sorted(os.listdir(store_dir)) == names
+    with open(os.path.join(store_dir, 'journal.log')) as fp:
+        assert fp.read() == journal
+
+
+def test_snapshot_read_again_if_saved_meanwhile(monkeypatch):
+    root = tmp_db_file('backup_saved_meanwhile')
+    base_dir = os.path.join(root, 'base')
+    store_dir = create_store(base_dir, 'pointy_v2', 'tim', 'tim')
+    opened = []
+
+    def open_replica_dir(store_dir):
+        if not opened:
+            # A save lands while the first copy is being read
+            store = open_store_dir(store_dir)
+            store.push_actions(1, {'create': {'a': {'path': 'people', 'record': {'name': 'ann'}}}})
+        opened.append(store_dir)
+        return real_open_replica_dir(store_dir)
+    real_open_replica_dir = backup.open_replica_dir
+    monkeypatch.setattr(backup, 'open_replica_dir', open_replica_dir)
+    results = snapshot_all(base_dir, os.path.join(root, 'backups'))
+    assert results == {store_dir: {'revision': 2, 'last_id': 2}}
+    assert len(opened) == 2
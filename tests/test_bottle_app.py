@@ -0,0 +1,62 @@
+import io
+import ujson
+from ..benchmarks.in_process import APP, setup_apps, auth_header, wsgi_call, bottle_app
+from ..metrics import METRICS
+from .utils_for_tests import tmp_db_file
+
+
+def login(authorization=None):
+    environ = {
+        'REQUEST_METHOD': 'POST',
+        'PATH_INFO': '/{}/login'.format(APP),
+        'QUERY_STRING': '',
+        'CONTENT_LENGTH': '0',
+        'wsgi.input': io.BytesIO(b''),
+    }
+    if authorization is not None:
+        environ['HTTP_AUTHORIZATION'] = authorization
+    responses = []
+    chunks = bottle_app.application(environ, lambda status, headers, exc_info=None: responses.append(
+        (status, {name.lower(): value for name, value in headers})))
+    body = b''.join(c if isinstance(c, bytes) else c.encode('utf-8') for c in chunks)
+    status, headers = responses[0]
+    return int(status.split()[0]), headers, body
+
+
+def test_login_issues_session_token():
+    setup_apps(tmp_db_file('apps'), ['tim'])
+    status, headers, body = login(auth_header('tim'))
+    assert status == 200
+    assert ujson.loads(body)['data']['token']
+
+
+def test_login_without_credentials_is_unauthorized():
+    setup_apps(tmp_db_file('apps'), ['tim'])
+    for authorization in (None, 'Basic !!!', 'Token abc'):
+        status, headers, body = login(authorization)
+        assert status == 401
+        assert 'www-authenticate' in headers
+
+
+def test_login_as_unknown_user_is_forbidden():
+    setup_apps(tmp_db_file('apps'), ['tim'])
+    status, headers, body = login(auth_header('sam'))
+    assert status == 403
+
+
+def test_unknown_apps_and_methods_share_metric_series():
+    setup_apps(tmp_db_file('apps'), ['tim'])
+    for i in range(3):
+        bottle_app.wrap_storage_call(bottle_app.request, 'evil{}'.format(i), 'm{}'.format(i), {})
+    wsgi_call('tim', 'm3', b'{}')
+    rendered = METRICS.render()
+    assert 'evil' not in rendered and 'm3' not in rendered
+    assert METRICS.get('pointy_requests_total', app='invalid', method='invalid', status='http_error') >= 4
+
+
+def test_browsers_may_revalidate_cross_origin():
+    setup_apps(tmp_db_file('apps'), ['tim'])
+    status, headers, body = login(auth_header('tim'))
+    assert 'If-None-Match' in headers['access-control-allow-headers']
+    assert 'X-Session-Token' in headers['access-control-allow-headers']
+    assert headers['access-control-expose-headers'] == 'ETag'
@@ -0,0 +1,71 @@
+import pytest
+import ujson
+from ..columnar import ColumnarCollection
+from ..query import run_query, aggregate
+
+
+def make_records():
+    return {
+        i: {'id': i, 'status': 'open' if i % 3 else 'closed', 'created': i * 10, 'done': i % 2 == 0}
+        for i in range(1, 31)
+    }
+
+
+def test_behaves_as_dict_of_records():
+    records = make_records()
+    records[5]['note'] = None
+    records[7]['tags'] = ['a', 'b']
+    collection = ColumnarCollection(records)
+    assert dict(collection) == records
+    del collection[3]
+    del records[3]
+    collection[31] = records[31] = {'id': 31, 'status': 'open'}
+    collection[4] = records[4] = {'id': 4, 'created': 'soon'}
+    assert dict(collection) == records
+    assert sorted(collection) == sorted(records)
+    assert ujson.loads(ujson.dumps({'records': collection})) == \
+        {'records': {str(k): v for k, v in records.items()}}
+
+
+def test_only_records_can_be_held():
+    collection = ColumnarCollection()
+    with pytest.raises(TypeError):
+        collection['theme'] = 'red'
+
+
+@pytest.mark.parametrize('filter', [
+    {'status': 'open', 'created': {'gte': 50}},
+    {'status': 'missing'},
+    {'created': {'lt': 45}, 'done': True},
+    {'status': {'in': ['closed']}},
+    {'note': None},
+    {'note': {'gt': 1}},
+])
+def test_filters_match_dict_collections(filter):
+    records = make_records()
+    records[2]['created'] = None
+    del records[4]['created']
+    collection = ColumnarCollection(records)
+    expected = list(run_query(records, filter, sort='id'))
+    assert list(run_query(collection, filter, sort='id')) == expected
+
+
+def test_aggregates_match_dict_collections():
+    records = make_records()
+    collection = ColumnarCollection(records)
+    aggregates = {'count': {'op': 'count'}, 'total': {'op': 'sum', 'field': 'created'},
+                  'first': {'op': 'min', 'field': 'created'}}
+    conditions = [('created', 'gt', 100)]
+    assert collection.aggregate(conditions, aggregates, 'status') == \
+        aggregate(run_query(records, {'created': {'gt': 100}}), aggregates, 'status')
+
+
+def test_booleans_read_back_as_booleans():
+    collection = ColumnarCollection({1: {'id': 1, 'done': True}, 2: {'id': 2, 'done': False}})
+    assert collection[1] == {'id': 1, 'done': True}
+    assert collection[1]['done'] is True
+    assert ujson.dumps(collection[2]) == '{"id":2,"done":false}'
+    assert collection.matching_keys([('done', 'eq', True)]) == [1]
+    collection[3] = {'id': 3, 'done': 'maybe'}
+    assert [collection[key]['done'] for key in (1, 2, 3)] == [True, False, 'maybe']
+    assert collection[1]['done'] is True
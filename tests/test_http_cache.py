@@ -0,0 +1,66 @@
+import gzip
+import pytest
+import ujson
+from ..json_storage import MyJsonStorageHandler
+from ..utils import ApiError
+from ..http_cache import ResponseCache, conditional_call, is_cacheable, accepts_gzip
+from .utils_for_tests import tmp_db_file
+
+READ = {'revision': 0, 'action_sets': {'read': {'records': {'path': 'records'}}}}
+
+
+class CountingStorage(MyJsonStorageHandler):
+
+    calls = 0
+
+    def push_actions(self, *args, **kwargs):
+        self.calls += 1
+        return super().push_actions(*args, **kwargs)
+
+
+def test_only_reads_outside_transactions_are_cacheable():
+    assert is_cacheable('push_actions', READ)
+    assert not is_cacheable('push_actions', dict(READ, transaction_id='x'))
+    assert not is_cacheable('push_actions', {'revision': 0, 'action_sets': {'create': {}}})
+    assert not is_cacheable('start_transaction', {})
+
+
+def test_accepts_gzip():
+    assert accepts_gzip('deflate, gzip;q=0.8')
+    assert not accepts_gzip('gzip;q=0')
+    assert not accepts_gzip(None)
+
+
+def test_conditional_call_revalidates_and_caches_by_revision():
+    storage = CountingStorage(tmp_db_file('data'), tmp_db_file('meta'))
+    cache = ResponseCache()
+    status, headers, body = conditional_call(cache, 'app', 'bob', storage, 'push_actions', READ)
+    assert status == 200 and storage.calls == 1
+    etag = headers['ETag']
+
+    status, headers, body = conditional_call(cache, 'app', 'bob', storage, 'push_actions', READ, etag)
+    assert status == 304 and body == b''
+    status, headers, body = conditional_call(cache, 'app', 'bob', storage, 'push_actions', READ)
+    assert status == 200 and storage.calls == 1
+
+    for i in range(50):
+        storage.push_actions(storage.revision, {
+            'create': {'a': {'path': 'records', 'record': {'name': 'tim'}}}
+        })
+    calls = storage.calls
+    status, headers, body = conditional_call(cache, 'app', 'bob', storage, 'push_actions', READ,
+                                             etag, 'gzip')
+    assert status == 200 and storage.calls == calls + 1
+    assert headers['ETag'] != etag
+    assert headers['Content-Encoding'] == 'gzip'
+    assert len(ujson.loads(gzip.decompress(body))['data']['queries']['records']) == 50
+
+
+def test_client_revision_checked_despite_cached_response():
+    storage = CountingStorage(tmp_db_file('data'), tmp_db_file('meta'))
+    cache = ResponseCache()
+    status, headers, body = conditional_call(cache, 'app', 'bob', storage, 'push_actions', READ)
+    assert status == 200
+    with pytest.raises(ApiError) as err:
+        conditional_call(cache, 'app', 'bob', storage, 'push_actions', dict(READ, revision=5))
+    assert err.value.code == 'revision_mismatch'
@@ -1,7 +1,13 @@
+import gzip
+import multiprocessing
 import os
+import threading
+import time
 import pytest
-from ..json_storage import MyJsonStorageHandler
+import ujson
+from ..json_storage import MyJsonStorageHandler, copy_collections
 from ..utils import ApiError
+from ..metrics import METRICS
 from .utils_for_tests import wipe_json_dbs, tmp_db_file
 
 
@@ -124,14 +130,105 @@ def test_raises_error_when_transaction_timed_out():
     assert result['revision'] == original_revision
 
 
-def test_raises_error_when_transaction_in_progress():
+def test_push_without_transaction_while_transaction_in_progress():
     storage = get_storage()
-    result = storage.start_transaction()
-    original_revision = result['revision']
+    transaction_id = storage.start_transaction()['transaction_id']
+    result = storage.push_actions(0, CREATE_RECORD, transaction_id)
+    storage.push_actions(0, CREATE_RECORD, None)
+    result = storage.commit_transaction(transaction_id)
+    result = storage.push_actions(result['revision'], READ_RECORDS)
+    assert result['revision'] == 2
+    assert len(result["queries"]["records"]) == 2
+
+
+def test_transaction_writes_are_private_until_commit():
+    storage = get_storage()
+    transaction_id = storage.start_transaction()['transaction_id']
+    result = storage.push_actions(0, CREATE_RECORD, transaction_id)
+    result = storage.push_actions(result['revision'], READ_RECORDS, transaction_id)
+    assert len(result["queries"]["records"]) == 1
+    result = storage.push_actions(0, READ_RECORDS)
+    assert result['revision'] == 0
+    assert len(result["queries"]["records"]) == 0
+
+
+def test_failed_push_is_undone_in_memory():
+    storage = get_storage()
+    result = storage.push_actions(0, CREATE_RECORD)
+    existing_id = result['new_ids']['a']
+    failing = {'create': {'b': {'path': 'records', 'record': {'name': 'sam'}}}, 'update': [
+        {"key": existing_id, "path": "records", "record": {"name": "andrea"}}
+    ], 'delete': [{"key": 999, "path": "records"}]}
+    with pytest.raises(KeyError):
+        storage.push_actions(result['revision'], failing)
+    assert storage.revision == 1
+    assert storage.last_id == 1
+    assert list(storage.data['records']) == [existing_id]
+    assert storage.data['records'][existing_id]['name'] == 'tim'
+    assert storage.parse_stats['parse_count'] == 2
+
+
+def test_failed_push_in_transaction_leaves_write_set_unchanged():
+    storage = get_storage()
+    transaction_id = storage.start_transaction()['transaction_id']
+    result = storage.push_actions(0, CREATE_RECORD, transaction_id)
+    with pytest.raises(KeyError):
+        storage.push_actions(result['revision'], dict(CREATE_RECORD, delete=[
+            {"key": 999, "path": "records"}
+        ]), transaction_id)
+    storage.commit_transaction(transaction_id)
+    result = storage.push_actions(storage.revision, READ_RECORDS)
+    assert result['revision'] == 1
+    assert len(result["queries"]["records"]) == 1
+
+
+def update_record(key, name):
+    return {'update': [{"key": key, "path": "records", "record": {"name": name}}]}
+
+
+def test_concurrent_transactions_on_different_records_both_commit():
+    storage = get_storage()
+    result = storage.push_actions(0, CREATE_RECORD)
+    first_id = result['new_ids']["a"]
+    result = storage.push_actions(result['revision'], CREATE_RECORD)
+    second_id = result['new_ids']["a"]
+    first = storage.start_transaction()
+    second = storage.start_transaction()
+    storage.push_actions(first['revision'], update_record(first_id, 'x'), first['transaction_id'])
+    storage.push_actions(second['revision'], update_record(second_id, 'y'), second['transaction_id'])
+    storage.commit_transaction(first['transaction_id'])
+    result = storage.commit_transaction(second['transaction_id'])
+    result = storage.push_actions(result['revision'], READ_RECORDS)
+    assert sorted(r['name'] for r in result["queries"]["records"]) == ['x', 'y']
+
+
+def test_concurrent_transactions_on_same_record_conflict():
+    storage = get_storage()
+    result = storage.push_actions(0, CREATE_RECORD)
+    new_id = result['new_ids']["a"]
+    first = storage.start_transaction()
+    second = storage.start_transaction()
+    storage.push_actions(first['revision'], update_record(new_id, 'x'), first['transaction_id'])
+    storage.push_actions(second['revision'], update_record(new_id, 'y'), second['transaction_id'])
+    storage.commit_transaction(first['transaction_id'])
     with pytest.raises(ApiError) as err:
-        result = storage.push_actions(result['revision'], CREATE_RECORD, None)
-    assert err.value.code == 'transaction_in_progress'
-    assert result['revision'] == original_revision
+        storage.commit_transaction(second['transaction_id'])
+    assert err.value.code == 'transaction_conflict'
+    assert err.value.data['conflicts'] == ['records/{}'.format(new_id)]
+
+
+def test_stale_revision_only_rejected_for_changed_records():
+    storage = get_storage()
+    result = storage.push_actions(0, CREATE_RECORD)
+    first_id = result['new_ids']["a"]
+    stale_revision = result['revision']
+    result = storage.push_actions(result['revision'], CREATE_RECORD)
+    second_id = result['new_ids']["a"]
+    result = storage.push_actions(result['revision'], update_record(second_id, 'x'))
+    storage.push_actions(stale_revision, update_record(first_id, 'y'))
+    with pytest.raises(ApiError) as err:
+        storage.push_actions(stale_revision, update_record(second_id, 'z'))
+    assert err.value.code == 'revision_mismatch'
 
 
 def test_raises_error_when_no_transaction_in_progress():
@@ -155,3 +252,458 @@ def test_raises_error_when_transaction_id_mismatch():
     assert err.value.code == 'transaction_id_mismatch'
     assert result['revision'] == original_revision
 
+
+
+def get_logged_storage(name, compact_threshold=1024 * 1024):
+    return MyJsonStorageHandler(
+        tmp_db_file(name + '_data'),
+        tmp_db_file(name + '_meta'),
+        tmp_db_file(name + '_log'),
+        compact_threshold
+    )
+
+
+def test_change_log_replayed_on_load():
+    storage = get_logged_storage('log_replay')
+    result = storage.push_actions(0, CREATE_RECORD)
+    new_id = result['new_ids']["a"]
+    result = storage.push_actions(result['revision'], {
+        'delete': [{"key": new_id, "path": "records"}]
+    })
+    result = storage.push_actions(result['revision'], CREATE_RECORD)
+
+    reopened = MyJsonStorageHandler(
+        storage._data_file_wrapper._filepath,
+        storage._meta_file_wrapper._filepath,
+        storage._change_log._filepath
+    )
+    result = reopened.push_actions(result['revision'], READ_RECORDS)
+    assert result['revision'] == 3
+    assert reopened.last_id == 2
+    assert [r['id'] for r in result["queries"]["records"]] == [2]
+
+
+def test_compaction_serializes_in_background(monkeypatch):
+    storage = get_logged_storage('log_compact_background')
+    result = storage.push_actions(0, CREATE_RECORD)
+    dumped_on = []
+    dumps = ujson.dumps
+
+    def recording_dumps(obj, *args, **kwargs):
+        if isinstance(obj, dict) and 'records' in obj:
+            dumped_on.append(threading.current_thread())
+        return dumps(obj, *args, **kwargs)
+    monkeypatch.setattr(ujson, 'dumps', recording_dumps)
+    storage.compact()
+    storage.push_actions(result['revision'], {
+        'create': {'a': {'path': 'records', 'record': {'name': 'sam'}}}
+    })
+    storage._compaction_thread.join()
+    assert dumped_on and threading.current_thread() not in dumped_on
+    with open(storage._data_file_wrapper._filepath) as fp:
+        assert len(ujson.load(fp)['records']) == 1
+
+
+def test_change_log_compacted_into_snapshot():
+    storage = get_logged_storage('log_compact', compact_threshold=1)
+    result = storage.push_actions(0, CREATE_RECORD)
+    storage.compact(wait=True)
+    assert storage._change_log.size() == 0
+
+    reopened = MyJsonStorageHandler(
+        storage._data_file_wrapper._filepath,
+        storage._meta_file_wrapper._filepath,
+        storage._change_log._filepath
+    )
+    result = reopened.push_actions(result['revision'], READ_RECORDS)
+    assert result['revision'] == 1
+    assert len(result["queries"]["records"]) == 1
+
+
+def test_changes_since():
+    storage = get_storage()
+    result = storage.push_actions(0, CREATE_RECORD)
+    first_id = result['new_ids']["a"]
+    client_revision = result['revision']
+    result = storage.push_actions(result['revision'], CREATE_RECORD)
+    second_id = result['new_ids']["a"]
+    result = storage.push_actions(result['revision'], {
+        'update': [{"key": first_id, "path": "records", "record": {"name": "andrea"}}],
+        'delete': [{"key": first_id, "path": "records"}]
+    })
+    result = storage.changes_since(client_revision)
+    assert result['revision'] == 4
+    assert [(c['op'], c['key']) for c in result['changes']] == [
+        ('create', second_id),
+        ('delete', first_id),
+    ]
+    assert storage.changes_since(4)['changes'] == []
+
+
+def test_changes_since_journal_persisted():
+    journal_path = tmp_db_file('journal')
+    storage = MyJsonStorageHandler(tmp_db_file('data'), tmp_db_file('meta'),
+                                   journal_db_path=journal_path)
+    result = storage.push_actions(0, CREATE_RECORD)
+    reopened = MyJsonStorageHandler(storage._data_file_wrapper._filepath,
+                                    storage._meta_file_wrapper._filepath,
+                                    journal_db_path=journal_path)
+    assert len(reopened.changes_since(0)['changes']) == 1
+
+
+def test_changes_since_requires_resync_when_journal_trimmed():
+    storage = MyJsonStorageHandler(tmp_db_file('data'), tmp_db_file('meta'), journal_size=2)
+    revision = 0
+    for i in range(3):
+        revision = storage.push_actions(revision, CREATE_RECORD)['revision']
+    with pytest.raises(ApiError) as err:
+        storage.changes_since(0)
+    assert err.value.code == 'resync_required'
+    assert len(storage.changes_since(2)['changes']) == 1
+
+
+def test_filtered_read_uses_indexes_kept_up_to_date():
+    storage = MyJsonStorageHandler(tmp_db_file('data'), tmp_db_file('meta'),
+                                   indexes={'records': ['name']})
+    result = storage.push_actions(0, CREATE_RECORD)
+    new_id = result['new_ids']["a"]
+    query = {'read': {'tims': {'path': 'records', 'filter': {'name': 'tim'}}}}
+    result = storage.push_actions(result['revision'], query)
+    assert len(result['queries']['tims']) == 1
+    result = storage.push_actions(result['revision'], update_record(new_id, 'andrea'))
+    result = storage.push_actions(result['revision'], query)
+    assert result['queries']['tims'] == []
+    assert storage._indexes['records']['name'].count('eq', 'andrea') == 1
+
+
+def test_index_dropped_when_collection_removed():
+    storage = MyJsonStorageHandler(tmp_db_file('data'), tmp_db_file('meta'),
+                                   indexes={'lists/groceries': ['name']})
+
+    def push(action_sets):
+        return storage.push_actions(storage.revision or 0, action_sets)
+    query = {'read': {'milk': {'path': 'lists/groceries', 'filter': {'name': 'milk'}}}}
+    push({'create': {'a': {'path': 'lists/groceries', 'record': {'name': 'milk'}}}})
+    assert len(push(query)['queries']['milk']) == 1
+    push({'delete': [{'key': 'groceries', 'path': 'lists'}]})
+    push({'create': {'a': {'path': 'lists/groceries', 'record': {'name': 'eggs'}}}})
+    assert push(query)['queries']['milk'] == []
+    push({'delete': [{'key': 'lists', 'path': ''}]})
+    push({'create': {'a': {'path': 'lists/groceries', 'record': {'name': 'milk'}}}})
+    assert [r['id'] for r in push(query)['queries']['milk']] == [3]
+
+
+def test_streamed_read_returns_iterator():
+    storage = get_storage()
+    result = storage.push_actions(0, CREATE_RECORD)
+    result = storage.push_actions(result['revision'], READ_RECORDS, stream=True)
+    records = result['queries']['records']
+    assert not isinstance(records, list)
+    assert [r['name'] for r in records] == ['tim']
+
+
+def test_streamed_read_unaffected_by_later_writes():
+    storage = MyJsonStorageHandler(tmp_db_file('data'), tmp_db_file('meta'),
+                                   indexes={'records': ['name']})
+    for name in ('tim', 'sam', 'ann'):
+        storage.push_actions(storage.revision or 0, {
+            'create': {'a': {'path': 'records', 'record': {'name': name}}}
+        })
+    result = storage.push_actions(storage.revision, {'read': {
+        'all': {'path': 'records'},
+        'sorted': {'path': 'records', 'sort': 'name', 'limit': 3},
+    }}, stream=True)
+    storage.push_actions(storage.revision, {
+        'delete': [{'key': 1, 'path': 'records'}, {'key': 2, 'path': 'records'}],
+        'create': {'b': {'path': 'records', 'record': {'name': 'abe'}}},
+    })
+    assert sorted(r['name'] for r in result['queries']['all']) == ['ann', 'sam', 'tim']
+    assert [r['name'] for r in result['queries']['sorted']] == ['ann', 'sam', 'tim']
+
+
+def test_files_only_parsed_again_when_changed_on_disk():
+    storage = get_storage()
+    result = storage.push_actions(0, CREATE_RECORD)
+    parse_count = storage.parse_stats['parse_count']
+    for i in range(3):
+        result = storage.push_actions(result['revision'], CREATE_RECORD)
+    assert storage.parse_stats['parse_count'] == parse_count
+
+    other_worker = MyJsonStorageHandler(storage._data_file_wrapper._filepath,
+                                        storage._meta_file_wrapper._filepath)
+    other_worker.push_actions(result['revision'], CREATE_RECORD)
+    result = storage.push_actions(result['revision'] + 1, READ_RECORDS)
+    assert storage.parse_stats['parse_count'] > parse_count
+    assert len(result['queries']['records']) == 5
+
+
+def test_transaction_outcomes_and_mismatches_counted():
+    METRICS.reset()
+    storage = get_storage()
+    transaction_id = storage.start_transaction()['transaction_id']
+    storage.abort_transaction(transaction_id)
+    transaction_id = storage.start_transaction()['transaction_id']
+    storage.commit_transaction(transaction_id)
+    with pytest.raises(ApiError):
+        storage.push_actions(10, READ_RECORDS)
+    assert METRICS.get('pointy_transactions_total', outcome='aborted') == 1
+    assert METRICS.get('pointy_transactions_total', outcome='committed') == 1
+    assert METRICS.get('pointy_revision_mismatches_total') == 1
+
+
+def test_collection_files_only_saves_and_loads_used_collections():
+    storage = MyJsonStorageHandler(tmp_db_file('collections'), tmp_db_file('meta'),
+                                   collection_files=True)
+    result = storage.push_actions(0, CREATE_RECORD)
+    result = storage.push_actions(result['revision'], {
+        'create': {'b': {'path': 'settings/theme', 'record': {'colour': 'red'}}}
+    })
+    data_dir = storage._data_file_wrapper._dirpath
+    assert sorted(os.listdir(data_dir)) == ['records.json', 'settings.json']
+    records_mtime = os.stat(os.path.join(data_dir, 'records.json')).st_mtime_ns
+    result = storage.push_actions(result['revision'], {
+        'create': {'b': {'path': 'settings/theme', 'record': {'colour': 'blue'}}}
+    })
+    assert os.stat(os.path.join(data_dir, 'records.json')).st_mtime_ns == records_mtime
+
+    reopened = MyJsonStorageHandler(data_dir, storage._meta_file_wrapper._filepath,
+                                    collection_files=True)
+    result = reopened.push_actions(result['revision'], READ_RECORDS)
+    assert [r['name'] for r in result['queries']['records']] == ['tim']
+    assert reopened.parse_stats['parse_count'] == 2  # meta and records only
+    assert reopened.last_id == 3
+
+
+def test_reads_cached_until_path_changed():
+    storage = get_storage()
+    result = storage.push_actions(0, CREATE_RECORD)
+    new_id = result['new_ids']['a']
+    first = storage.push_actions(result['revision'], READ_RECORDS)['queries']['records']
+    assert storage.push_actions(result['revision'], READ_RECORDS)['queries']['records'] is first
+    result = storage.push_actions(result['revision'], update_record(new_id, 'andrea'))
+    records = storage.push_actions(result['revision'], READ_RECORDS)['queries']['records']
+    assert records is not first
+    assert records[0]['name'] == 'andrea'
+
+
+def get_shared_storage(data_path, meta_path, journal_path):
+    return MyJsonStorageHandler(data_path, meta_path, journal_db_path=journal_path,
+                                multiprocess=True)
+
+
+def create_records(paths, count):
+    storage = get_shared_storage(*paths)
+    for i in range(count):
+        storage.push_actions(0, {'create': {'a': {'path': 'records', 'record': {'n': i}}}})
+
+
+def test_multiprocess_workers_share_store():
+    paths = (tmp_db_file('data'), tmp_db_file('meta'), tmp_db_file('journal'))
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=create_records, args=(paths, 25)) for i in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    result = get_shared_storage(*paths).push_actions(0, READ_RECORDS)
+    assert result['revision'] == 100
+    assert sorted(r['id'] for r in result['queries']['records']) == list(range(1, 101))
+
+
+def test_multiprocess_transaction_continued_by_another_worker():
+    paths = (tmp_db_file('data'), tmp_db_file('meta'), tmp_db_file('journal'))
+    worker_a = get_shared_storage(*paths)
+    worker_b = get_shared_storage(*paths)
+    started = worker_a.start_transaction()
+    result = worker_b.push_actions(started['revision'], CREATE_RECORD, started['transaction_id'])
+    new_id = result['new_ids']['a']
+    result = worker_b.push_actions(0, {'create': {'a': {'path': 'records', 'record': {'n': 1}}}})
+    assert result['new_ids']['a'] == new_id + 1
+    worker_a.commit_transaction(started['transaction_id'])
+    result = worker_b.push_actions(0, READ_RECORDS)
+    assert result['revision'] == 2
+    assert sorted(r['id'] for r in result['queries']['records']) == [new_id, new_id + 1]
+
+
+def test_watch_returns_once_revision_moves():
+    storage = get_storage()
+    result = storage.push_actions(0, CREATE_RECORD)
+    assert storage.watch(result['revision'], timeout=0.01) == {'revision': 1}
+
+    def push_later():
+        time.sleep(0.05)
+        storage.push_actions(1, update_record(result['new_ids']['a'], 'andrea'))
+    thread = threading.Thread(target=push_later)
+    thread.start()
+    started = time.monotonic()
+    watched = storage.watch(1, timeout=5, delta=True)
+    thread.join()
+    assert time.monotonic() - started < 1
+    assert watched['revision'] == 2
+    assert [c['record']['name'] for c in watched['changes']] == ['andrea']
+    assert storage.watch(0)['revision'] == 2
+
+
+def test_read_with_projection_and_aggregates():
+    storage = get_storage()
+    result = storage.push_actions(0, CREATE_RECORD)
+    result = storage.push_actions(result['revision'], {
+        'create': {'b': {'path': 'records', 'record': {'name': 'sam', 'age': 40}}}
+    })
+    result = storage.push_actions(result['revision'], {'read': {
+        'names': {'path': 'records', 'fields': ['id', 'name'], 'sort': 'name'},
+        'ages': {'path': 'records', 'aggregate': {
+            'count': {'op': 'count'}, 'total': {'op': 'sum', 'field': 'age'}
+        }},
+    }})
+    assert result['queries']['names'] == [{'id': 2, 'name': 'sam'}, {'id': 1, 'name': 'tim'}]
+    assert result['queries']['ages'] == {'count': 2, 'total': 63}
+
+
+def test_export_then_import_records():
+    storage = get_storage()
+    result = storage.push_actions(0, CREATE_RECORD)
+    result = storage.push_actions(result['revision'], {
+        'create': {'b': {'path': 'settings/theme', 'record': {'colour': 'red'}}}
+    })
+    lines = list(storage.export_records())
+    assert len(lines) == 2
+
+    restored = get_storage()
+    result = restored.import_records(lines)
+    assert result == {'revision': 1, 'imported': 2}
+    assert restored.data == storage.data
+
+
+def test_keyed_records_without_ids_round_trip():
+    lines = [
+        '{"path": "people", "key": 7, "record": {"name": "ann"}}',
+        '{"path": "settings", "key": "theme", "record": {"colour": "red"}}',
+    ]
+    storage = get_storage()
+    storage.import_records(lines)
+    exported = sorted(storage.export_records())
+    assert [ujson.loads(line) for line in exported] == [
+        {'path': 'people', 'key': 7, 'record': {'name': 'ann', 'id': 7}},
+        {'path': 'settings', 'key': 'theme', 'record': {'colour': 'red', 'id': 'theme'}},
+    ]
+    restored = get_storage()
+    restored.import_records(exported)
+    assert sorted(restored.export_records()) == exported
+
+
+def test_export_unaffected_by_later_writes():
+    storage = get_storage()
+    for name in ('tim', 'sam'):
+        storage.push_actions(storage.revision or 0, {
+            'create': {'a': {'path': 'records', 'record': {'name': name}}}
+        })
+    lines = storage.export_records()
+    first = next(lines)
+    storage.push_actions(storage.revision, {
+        'delete': [{'key': 1, 'path': 'records'}, {'key': 2, 'path': 'records'}],
+        'create': {'c': {'path': 'records', 'record': {'name': 'ann'}}},
+    })
+    names = sorted(ujson.loads(line)['record']['name'] for line in [first] + list(lines))
+    assert names == ['sam', 'tim']
+
+
+def test_import_allocates_ids_in_batches():
+    storage = get_logged_storage('import')
+    result = storage.push_actions(0, CREATE_RECORD)
+    lines = ['{"path": "records", "record": {"n": %d}}' % i for i in range(5)]
+    result = storage.import_records(lines, batch_size=2)
+    assert result == {'revision': 4, 'imported': 5}
+    assert sorted(storage.data['records']) == [1, 2, 3, 4, 5, 6]
+    assert storage.last_id == 6
+    with pytest.raises(ApiError) as err:
+        storage.changes_since(1)
+    assert err.value.code == 'resync_required'
+
+    reopened = MyJsonStorageHandler(storage._data_file_wrapper._filepath,
+                                    storage._meta_file_wrapper._filepath,
+                                    storage._change_log._filepath)
+    result = reopened.push_actions(result['revision'], READ_RECORDS)
+    assert len(result['queries']['records']) == 6
+
+
+def test_new_ids_follow_imported_keys():
+    def create(storage, name):
+        return storage.push_actions(storage.revision or 0, {
+            'create': {'a': {'path': 'records', 'record': {'name': name}}}
+        })
+    storage = get_storage()
+    create(storage, 'tim')
+    create(storage, 'sam')
+    restored = get_storage()
+    restored.import_records(storage.export_records())
+    result = create(restored, 'ann')
+    assert result['new_ids']['a'] == 3
+    result = restored.push_actions(result['revision'], READ_RECORDS)
+    assert sorted(r['id'] for r in result['queries']['records']) == [1, 2, 3]
+
+
+def test_import_with_invalid_line_imports_nothing():
+    storage = get_storage()
+    result = storage.push_actions(0, CREATE_RECORD)
+    lines = ['{"path": "records", "record": {"n": 1}}', '{"record": {"n": 2}}']
+    with pytest.raises(ApiError) as err:
+        storage.import_records(lines, batch_size=1)
+    assert err.value.data == {'line': 2}
+    result = storage.push_actions(result['revision'], READ_RECORDS)
+    assert result['revision'] == 1
+    assert len(result['queries']['records']) == 1
+
+
+def test_columnar_collection_saved_and_loaded():
+    storage = MyJsonStorageHandler(
+        tmp_db_file('columnar_data'),
+        tmp_db_file('columnar_meta'),
+        tmp_db_file('columnar_log'),
+        columnar=['records']
+    )
+    result = storage.push_actions(0, CREATE_RECORD)
+    result = storage.push_actions(result['revision'], {
+        'create': {'b': {'path': 'records', 'record': {'name': 'sam', 'age': 40}}},
+        'update': [{'path': 'records', 'key': 1, 'record': {'name': 'tim', 'age': 24}}],
+        'read': {'ages': {'path': 'records', 'filter': {'age': {'gt': 30}},
+                          'aggregate': {'total': {'op': 'sum', 'field': 'age'}}}},
+    })
+    assert type(storage.data['records']).__name__ == 'ColumnarCollection'
+    assert result['queries']['ages'] == {'total': 40}
+    storage.compact(wait=True)
+
+    reopened = MyJsonStorageHandler(
+        storage._data_file_wrapper._filepath,
+        storage._meta_file_wrapper._filepath,
+        storage._change_log._filepath,
+        columnar=['records']
+    )
+    result = reopened.push_actions(result['revision'], {'read': {
+        'names': {'path': 'records', 'filter': {'name': 'tim'}, 'fields': ['name', 'age']}
+    }})
+    assert result['queries']['names'] == [{'name': 'tim', 'age': 24}]
+    assert len(reopened.data['records']) == 2
+
+
+def test_snapshot_unaffected_by_later_writes():
+    storage = get_storage()
+    result = storage.push_actions(0, CREATE_RECORD)
+    archive_path = tmp_db_file('snapshot') + '.gz'
+    future = storage.snapshot(archive_path)
+    storage.push_actions(result['revision'], {
+        'update': [{'path': 'records', 'key': 1, 'record': {'name': 'sam'}}],
+        'create': {'b': {'path': 'records', 'record': {'name': 'ann'}}},
+    })
+    assert future.result() == {'revision': 1, 'last_id': 1}
+    with gzip.open(archive_path, 'rt') as fp:
+        snapshot = ujson.load(fp)
+    assert snapshot['data'] == {'records': {'1': {'id': 1, 'name': 'tim', 'age': 23}}}
+
+
+def test_snapshot_copies_collections_but_shares_records():
+    storage = get_storage()
+    storage.push_actions(0, {'create': {'a': {'path': 'people/staff', 'record': {'name': 'tim'}}}})
+    copied = copy_collections(storage.data)
+    assert copied['people']['staff'] is not storage.data['people']['staff']
+    assert copied['people']['staff'][1] is storage.data['people']['staff'][1]
@@ -0,0 +1,48 @@
+from ..metrics import Registry
+
+
+def test_render_counters_histograms_and_gauges():
+    registry = Registry()
+    registry.describe('requests_total', 'Requests handled')
+    registry.inc('requests_total', method='read')
+    registry.inc('requests_total', 2, method='read')
+    registry.observe('latency_seconds', 0.003, buckets=(0.001, 0.01))
+    registry.add_collector(lambda: [('cache_entries', {}, 7)])
+    assert registry.get('requests_total', method='read') == 3
+    assert registry.render().splitlines() == [
+        '# HELP requests_total Requests handled',
+        '# TYPE requests_total counter',
+        'requests_total{method="read"} 3',
+        '# TYPE latency_seconds histogram',
+        'latency_seconds_bucket{le="0.001"} 0',
+        'latency_seconds_bucket{le="0.01"} 1',
+        'latency_seconds_bucket{le="+Inf"} 1',
+        'latency_seconds_sum 0.003',
+        'latency_seconds_count 1',
+        '# TYPE cache_entries gauge',
+        'cache_entries 7',
+    ]
+
+
+def test_disabled_registry_records_nothing():
+    registry = Registry(enabled=False)
+    registry.inc('requests_total')
+    with registry.timer('latency_seconds'):
+        pass
+    assert registry.get('requests_total') == 0
+    assert registry.get('latency_seconds') == 0
+
+
+def test_gauges_from_several_collectors_rendered_together():
+    registry = Registry()
+    registry.add_collector(lambda: [('store_bytes', {'user': 'tim'}, 5), ('cache_entries', {}, 1)])
+    registry.add_collector(lambda: [('store_bytes', {'user': 'bob'}, 3)])
+    registry.add_collector(lambda: [('store_bytes', {'user': 7}, 2)])
+    assert registry.render().splitlines() == [
+        '# TYPE cache_entries gauge',
+        'cache_entries 1',
+        '# TYPE store_bytes gauge',
+        'store_bytes{user="7"} 2',
+        'store_bytes{user="bob"} 3',
+        'store_bytes{user="tim"} 5',
+    ]
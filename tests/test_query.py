@@ -0,0 +1,105 @@
+import pytest
+from ..query import SortedIndex, run_query, QueryCache, aggregate
+from ..utils import ApiError
+
+
+def make_collection():
+    return {
+        i: {'id': i, 'status': 'open' if i % 3 else 'closed', 'created': i * 10}
+        for i in range(1, 31)
+    }
+
+
+def ids(records):
+    return [r['id'] for r in records]
+
+
+@pytest.mark.parametrize('indexed', [(), ('status',), ('created',), ('status', 'created')])
+def test_results_same_with_or_without_indexes(indexed):
+    collection = make_collection()
+    indexes = {field: SortedIndex(field, collection) for field in indexed}
+    result = run_query(collection, {'status': 'open', 'created': {'gte': 50}},
+                       sort='-created', limit=3, offset=1, indexes=indexes)
+    assert ids(result) == [28, 26, 25]
+
+
+def test_in_and_range_filters():
+    collection = make_collection()
+    result = run_query(collection, {'id': {'in': [2, 4, 40]}, 'created': {'lt': 40}})
+    assert ids(result) == [2]
+
+
+def test_index_kept_up_to_date():
+    collection = make_collection()
+    index = SortedIndex('status', collection)
+    index.remove(1)
+    index.add(3, {'status': 'open'})
+    assert sorted(index.keys('eq', 'closed')) == list(range(6, 31, 3))
+    assert 1 not in index.keys('eq', 'open')
+
+
+def test_mixed_types_do_not_raise():
+    collection = {1: {'v': None}, 2: {'v': 'a'}, 3: {'v': 5}, 4: {}}
+    index = SortedIndex('v', collection)
+    assert list(index.keys('gt', 1)) == [3, 2]
+    assert len(list(run_query(collection, sort='v'))) == 4
+
+
+def test_unknown_operator():
+    with pytest.raises(ApiError):
+        list(run_query(make_collection(), {'status': {'like': 'o%'}}))
+
+
+def test_query_cache_invalidated_by_changes_above_and_below():
+    cache = QueryCache()
+    for path in ('', 'a', 'a/b', 'a/b/c', 'x'):
+        cache.put(path, [None], [{'path': path}])
+    cache.invalidate('a/b/7')
+    assert cache.get('a/b', [None]) is None
+    assert cache.get('a', [None]) is None
+    assert cache.get('', [None]) is None
+    assert cache.get('a/b/c', [None]) is not None
+    assert cache.get('x', [None]).json == '[{"path":"x"}]'
+    cache.invalidate('a/b/c')
+    assert cache.get('a/b/c', [None]) is None
+
+
+def test_query_cache_bounded_in_bytes():
+    cache = QueryCache(max_bytes=20)
+    cache.put('a', [None], [{'n': 1}])
+    cache.put('b', [None], [{'n': 2}])
+    cache.put('c', [None], [{'n': 3}])
+    assert cache.get('a', [None]) is None
+    assert cache.bytes == 18
+
+
+def test_aggregate_in_groups():
+    records = [
+        {'status': 'open', 'amount': 10, 'age': 30},
+        {'status': 'open', 'amount': 5, 'age': 61},
+        {'status': 'closed', 'amount': 'n/a'},
+        {'amount': 1},
+    ]
+    spec = {
+        'total': {'op': 'count'},
+        'aged': {'op': 'count', 'field': 'age'},
+        'spent': {'op': 'sum', 'field': 'amount'},
+        'youngest': {'op': 'min', 'field': 'age'},
+        'oldest': {'op': 'max', 'field': 'age'},
+    }
+    assert aggregate(records, spec) == {'total': 4, 'aged': 2, 'spent': 16, 'youngest': 30, 'oldest': 61}
+    assert aggregate(records, spec, 'status') == [
+        {'status': None, 'total': 1, 'aged': 0, 'spent': 1, 'youngest': None, 'oldest': None},
+        {'status': 'closed', 'total': 1, 'aged': 0, 'spent': 0, 'youngest': None, 'oldest': None},
+        {'status': 'open', 'total': 2, 'aged': 2, 'spent': 15, 'youngest': 30, 'oldest': 61},
+    ]
+    assert aggregate([], {'total': {'op': 'count'}}) == {'total': 0}
+    with pytest.raises(ApiError):
+        aggregate(records, {'x': {'op': 'avg', 'field': 'age'}})
+
+
+@pytest.mark.parametrize('spec', ['count', ['count'], None])
+def test_aggregate_spec_not_a_dict(spec):
+    with pytest.raises(ApiError) as err:
+        aggregate([{'age': 30}], {'x': spec})
+    assert err.value.code == 'invalid_query'
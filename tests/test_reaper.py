@@ -0,0 +1,66 @@
+import threading
+import time
+import pytest
+from ..json_storage import MyJsonStorageHandler
+from ..reaper import TimerWheel, TransactionReaper
+from ..metrics import METRICS
+from ..utils import ApiError
+from .utils_for_tests import tmp_db_file
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_timer_wheel_pops_items_once_due():
+    clock = FakeClock()
+    wheel = TimerWheel(tick=1, slots=4, clock=clock)
+    wheel.add(102, 'soon')
+    wheel.add(109, 'next turn')
+    clock.now = 101.5
+    assert wheel.pop_due() == []
+    clock.now = 102
+    assert wheel.pop_due() == ['soon']
+    clock.now = 106
+    assert wheel.pop_due() == []
+    clock.now = 200
+    assert wheel.pop_due() == ['next turn']
+    assert wheel.pop_due() == []
+
+
+def test_reaper_expires_transactions_without_a_request():
+    reaper = TransactionReaper(tick=0.01)
+    storage = MyJsonStorageHandler(tmp_db_file('data'), tmp_db_file('meta'), reaper=reaper)
+    abandoned = storage.start_transaction(timeout=0.05)['transaction_id']
+    storage.start_transaction(timeout=60)
+    deadline = time.monotonic() + 5
+    while len(storage._transactions) > 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(storage._transactions) == 1
+    with pytest.raises(ApiError) as err:
+        storage.commit_transaction(abandoned)
+    assert err.value.code == 'transaction_timed_out'
+
+
+def test_transaction_expired_or_committed_not_both():
+    storage = MyJsonStorageHandler(tmp_db_file('data'), tmp_db_file('meta'))
+    transaction_id = storage.start_transaction(timeout=60)['transaction_id']
+    committed = METRICS.get('pointy_transactions_total', outcome='committed')
+    timed_out = METRICS.get('pointy_transactions_total', outcome='timed_out')
+    expired = []
+    reaper = threading.Thread(target=lambda: expired.append(storage.expire_transaction(transaction_id)))
+    with storage.locked():
+        reaper.start()
+        reaper.join(0.05)
+        # The reaper waits for the commit to finish
+        assert reaper.is_alive()
+        storage.commit_transaction(transaction_id)
+    reaper.join()
+    assert expired == [False]
+    assert METRICS.get('pointy_transactions_total', outcome='committed') == committed + 1
+    assert METRICS.get('pointy_transactions_total', outcome='timed_out') == timed_out
@@ -0,0 +1,109 @@
+import multiprocessing
+import pytest
+from .. import json_storage
+from ..json_storage import MyJsonStorageHandler
+from ..replication import ReplicaStorageHandler, LogTail
+from ..utils import ApiError
+from ..metrics import METRICS
+from .utils_for_tests import tmp_db_file
+
+READ_PEOPLE = {'read': {'people': {'path': 'people', 'sort': 'id'}}}
+
+
+def create_person(storage, name):
+    return storage.push_actions(0, {'create': {'a': {'path': 'people', 'record': {'name': name}}}})
+
+
+def get_pair(name):
+    paths = (tmp_db_file(name + '_data'), tmp_db_file(name + '_meta'),
+             tmp_db_file(name + '_log'), tmp_db_file(name + '_replication'))
+    primary = MyJsonStorageHandler(paths[0], paths[1], paths[2], replication_log_path=paths[3])
+    create_person(primary, 'tim')
+    replica = ReplicaStorageHandler(paths[0], paths[1], paths[3], paths[2])
+    return primary, replica
+
+
+def names(result):
+    return [r['name'] for r in result['queries']['people']]
+
+
+def test_replica_follows_primary():
+    primary, replica = get_pair('follow')
+    assert names(replica.push_actions(0, READ_PEOPLE)) == ['tim']
+    create_person(primary, 'ann')
+    primary.push_actions(primary.revision, {'delete': [{'path': 'people', 'key': 1}]})
+    lag_count = METRICS.get('pointy_replication_lag_seconds')
+    result = replica.push_actions(0, READ_PEOPLE)
+    assert result['revision'] == primary.revision == 3
+    assert names(result) == ['ann']
+    assert METRICS.get('pointy_replication_lag_seconds') == lag_count + 2
+    assert replica.changes_since(1)['revision'] == 3
+
+
+def test_replica_only_serves_reads():
+    primary, replica = get_pair('read_only')
+    with pytest.raises(ApiError) as err:
+        create_person(replica, 'ann')
+    assert err.value.code == 'read_only'
+    with pytest.raises(ApiError):
+        replica.start_transaction()
+    assert names(primary.push_actions(0, READ_PEOPLE)) == ['tim']
+
+
+def test_replica_reloads_when_log_trimmed(monkeypatch):
+    primary, replica = get_pair('trimmed')
+    replica.load()
+    monkeypatch.setattr(json_storage, 'REPLICATION_LOG_MAX_BYTES', 300)
+    for name in ['ann', 'sam', 'bob', 'eve', 'joe']:
+        create_person(primary, name)
+    assert len(list(primary._replication_log.read())) < 5
+    reloads = METRICS.get('pointy_replica_reloads_total')
+    assert names(replica.push_actions(0, READ_PEOPLE)) == ['tim', 'ann', 'sam', 'bob', 'eve', 'joe']
+    assert METRICS.get('pointy_replica_reloads_total') == reloads + 1
+
+
+def test_log_tail_starts_over_when_rewritten_in_place():
+    path = tmp_db_file('tail_log')
+    with open(path, 'w') as fp:
+        fp.write('{"rev": 1, "n": "a"}\n{"rev": 2, "n": "b"}\n')
+    tail = LogTail(path)
+    assert [e['rev'] for e in tail.read_new()] == [1, 2]
+    # Same inode and a longer file, as when a replaced file's inode is reused
+    with open(path, 'w') as fp:
+        fp.write('{"rev": 3, "n": "ccc"}\n{"rev": 4, "n": "ddd"}\n{"rev": 5}\n')
+    assert [e['rev'] for e in tail.read_new()] == [3, 4, 5]
+    with open(path, 'a') as fp:
+        fp.write('{"rev": 6}\n')
+    assert [e['rev'] for e in tail.read_new()] == [6]
+
+
+def test_replica_reloads_after_import():
+    primary, replica = get_pair('import')
+    replica.load()
+    primary.import_records(['{"path": "people", "record": {"name": "ann"}}'])
+    assert names(replica.push_actions(0, READ_PEOPLE)) == ['tim', 'ann']
+
+
+def read_in_replica(paths, revision, queue):
+    replica = ReplicaStorageHandler(*paths)
+    while replica.push_actions(0, READ_PEOPLE)['revision'] < revision:
+        pass
+    queue.put(names(replica.push_actions(0, READ_PEOPLE)))
+
+
+def test_replicas_in_other_processes():
+    paths = (tmp_db_file('process_data'), tmp_db_file('process_meta'),
+             tmp_db_file('process_replication'), tmp_db_file('process_log'))
+    primary = MyJsonStorageHandler(paths[0], paths[1], paths[3], replication_log_path=paths[2])
+    create_person(primary, 'tim')
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    replicas = [context.Process(target=read_in_replica, args=(paths, 20, queue)) for i in range(2)]
+    for replica in replicas:
+        replica.start()
+    for i in range(19):
+        create_person(primary, str(i))
+    results = [queue.get(timeout=10), queue.get(timeout=10)]
+    for replica in replicas:
+        replica.join()
+    assert results == [['tim'] + [str(i) for i in range(19)]] * 2
@@ -0,0 +1,45 @@
+from ..store_cache import StoreCache
+
+
+class FakeStore:
+
+    def __init__(self, key, size=10):
+        self.key = key
+        self.estimated_size = size
+        self.has_open_transactions = False
+
+
+def test_evicts_least_recently_used():
+    cache = StoreCache(FakeStore, max_entries=2)
+    a = cache.get('a')
+    cache.get('b')
+    assert cache.get('a') is a
+    cache.get('c')
+    assert 'a' in cache and 'c' in cache and 'b' not in cache
+    assert cache.stats() == {'entries': 2, 'bytes': 20, 'hits': 1, 'misses': 3, 'evictions': 1}
+
+
+def test_evicts_to_stay_within_bytes():
+    cache = StoreCache(lambda key: FakeStore(key, size=40), max_bytes=100)
+    for key in 'abc':
+        cache.get(key)
+    assert len(cache) == 2
+    assert cache.total_bytes == 80
+
+
+def test_never_evicts_store_with_open_transaction():
+    cache = StoreCache(FakeStore, max_entries=1)
+    cache.get('a').has_open_transactions = True
+    cache.get('b')
+    assert 'a' in cache and 'b' in cache
+    cache.get('a').has_open_transactions = False
+    cache.get('c')
+    assert len(cache) == 1 and 'c' in cache
+
+
+def test_peek_neither_opens_nor_counts():
+    cache = StoreCache(FakeStore, max_entries=2)
+    assert cache.peek('a') is None
+    a = cache.get('a')
+    assert cache.peek('a') is a
+    assert cache.stats()['hits'] == 0 and cache.stats()['misses'] == 1
@@ -0,0 +1,72 @@
+import os
+import threading
+import pytest
+import ujson
+from .. import utils
+from ..utils import GroupCommitWriter, JsonFileWrapper, JsonLinesFile, iter_json_chunks
+from .utils_for_tests import tmp_db_file
+
+
+@pytest.mark.parametrize('durability', ['request', 'batch', 'async'])
+def test_writes_visible_after_flush(durability):
+    writer = GroupCommitWriter(durability)
+    wrapper = JsonFileWrapper(tmp_db_file('writer_' + durability), writer=writer)
+    wrapper.save({'a': 1})
+    writer.flush()
+    assert wrapper.load(True) == {'a': 1}
+    assert not os.path.exists(wrapper._filepath + '.tmp')
+
+
+def test_batch_coalesces_concurrent_writes(monkeypatch):
+    batches = []
+    write = utils._write_batch
+
+    def write_batch(writes):
+        batches.append(len(writes))
+        return write(writes)
+    monkeypatch.setattr(utils, '_write_batch', write_batch)
+    writer = GroupCommitWriter('batch', window=0.05)
+    log = JsonLinesFile(tmp_db_file('writer_log'), writer)
+    wrapper = JsonFileWrapper(tmp_db_file('writer_batch'), writer=writer)
+
+    threads = [threading.Thread(target=log.append, args=([{'n': i}],)) for i in range(5)]
+    threads += [threading.Thread(target=wrapper.save, args=({'v': i},)) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(e['n'] for e in log.read()) == list(range(5))
+    assert wrapper.load(True)['v'] in range(3)
+    # Eight writers, written together in far fewer batches
+    assert sum(batches) == len(threads)
+    assert len(batches) < len(threads)
+
+
+def test_rejects_unknown_durability():
+    with pytest.raises(ValueError):
+        GroupCommitWriter('sometimes')
+
+
+def test_iter_json_chunks_streams_iterators():
+    records = ({'id': i} for i in range(100))
+    chunks = list(iter_json_chunks({'a': 1, 'b': {'c': records, 'd': [1, 2]}}, chunk_size=50))
+    assert len(chunks) > 1
+    assert ujson.loads(''.join(chunks)) == {
+        'a': 1,
+        'b': {'c': [{'id': i} for i in range(100)], 'd': [1, 2]}
+    }
+
+
+def test_json_file_wrapper_detects_changes_on_disk():
+    filepath = tmp_db_file('wrapper_changes')
+    wrapper = JsonFileWrapper(filepath)
+    wrapper.save({'a': 1})
+    wrapper.load()
+    assert not wrapper.changed_on_disk()
+    wrapper.save({'a': 2})
+    assert not wrapper.changed_on_disk()
+    JsonFileWrapper(filepath).save({'a': 3})
+    assert wrapper.changed_on_disk()
+    assert wrapper.load() == {'a': 3}
+    assert wrapper.parse_count == 2
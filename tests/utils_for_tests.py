@@ -4,6 +4,8 @@ from datetime import datetime
 
 
 JSON_TEST_DIR = os.path.join(os.path.dirname(__file__), 'json_dbs')
+# Test runs write their files here, it isn't kept in the repo
+os.makedirs(JSON_TEST_DIR, exist_ok=True)
 
 
 def wipe_json_dbs():
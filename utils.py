@@ -1,5 +1,22 @@
+import collections.abc
+import gzip
+import mmap
 import os
+import struct
+import threading
+import time
+import urllib.parse
 import ujson
+from pointy.metrics import METRICS
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+DURABILITY_REQUEST = 'request'
+DURABILITY_BATCH = 'batch'
+DURABILITY_ASYNC = 'async'
+DURABILITY_LEVELS = (DURABILITY_REQUEST, DURABILITY_BATCH, DURABILITY_ASYNC)
 
 
 class ApiError(Exception):
@@ -12,37 +29,559 @@ class ApiError(Exception):
         self.data = data
 
 
+def atomic_write(filepath, text):
+    """
+    Writes text to a temp file, fsyncs it and renames it over filepath, so
+    readers see either the old or the new file, never a partial one.
+    """
+    tmp_filepath = filepath + '.tmp'
+    with open(tmp_filepath, 'w') as fp:
+        fp.write(text)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp_filepath, filepath)
+    _fsync_dir(os.path.dirname(filepath))
+
+
+def atomic_write_gzipped(filepath, chunks):
+    """
+    As atomic_write, but gzipping an iterable of text chunks as they come.
+    """
+    tmp_filepath = filepath + '.tmp'
+    with open(tmp_filepath, 'wb') as fp:
+        with gzip.GzipFile(fileobj=fp, mode='wb', compresslevel=6) as gz:
+            for chunk in chunks:
+                gz.write(chunk.encode('utf-8'))
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp_filepath, filepath)
+    _fsync_dir(os.path.dirname(filepath))
+
+
+def durable_append(filepath, text):
+    with open(filepath, 'a') as fp:
+        fp.write(text)
+        fp.flush()
+        os.fsync(fp.fileno())
+
+
+def _fsync_dir(dirpath):
+    fd = os.open(dirpath or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _write_batch(writes):
+    """
+    Writes a list of (filepath, text, append, on_written) with one write and
+    one fsync per file. A replace drops any earlier writes queued for the
+    same file. The on_written callbacks (if not None) are called once the
+    file is written.
+    """
+    files = {}
+    for filepath, text, append, on_written in writes:
+        if append and filepath in files:
+            files[filepath][1] += text
+        else:
+            callbacks = files[filepath][2] if filepath in files else []
+            files[filepath] = [append, text, callbacks]
+        if on_written is not None:
+            files[filepath][2].append(on_written)
+    for filepath, (append, text, callbacks) in files.items():
+        if append:
+            durable_append(filepath, text)
+        else:
+            atomic_write(filepath, text)
+        for on_written in callbacks:
+            on_written()
+
+
+def file_signature(stat):
+    """
+    Identifies a version of a file well enough to tell if it was changed.
+    """
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+class DiskChangeTracker:
+    """
+    Tells whether a file changed on disk since we last read or wrote it,
+    from its inode, size and mtime. Our own writes which haven't reached the
+    disk yet don't count as changes.
+    """
+
+    def __init__(self, filepath):
+        self._filepath = filepath
+        self._signature = None
+        self._writes_in_flight = 0
+        self._lock = threading.Lock()
+
+    def changed(self):
+        with self._lock:
+            if self._writes_in_flight:
+                return False
+            return self._current_signature() != self._signature
+
+    def mark_read(self, fp=None):
+        """
+        Records the file as read, from its open file object if given so the
+        signature is that of the file actually read.
+        """
+        with self._lock:
+            if fp is None:
+                self._signature = self._current_signature()
+            else:
+                self._signature = file_signature(os.fstat(fp.fileno()))
+
+    def write_started(self):
+        with self._lock:
+            self._writes_in_flight += 1
+
+    def write_finished(self):
+        with self._lock:
+            self._writes_in_flight -= 1
+            self._signature = self._current_signature()
+
+    def _current_signature(self):
+        try:
+            return file_signature(os.stat(self._filepath))
+        except OSError:
+            return None
+
+
+class FileLock:
+    """
+    An exclusive advisory lock on a file (flock), shared between processes.
+    It is reentrant within a process: threads wait for each other, and
+    acquire() returns True only for the outermost acquisition.
+    """
+
+    def __init__(self, filepath):
+        if fcntl is None:
+            raise RuntimeError('File locks need fcntl, which this platform lacks')
+        self._filepath = filepath
+        self._fd = None
+        self._depth = 0
+        self._lock = threading.RLock()
+
+    def acquire(self):
+        self._lock.acquire()
+        self._depth += 1
+        if self._depth > 1:
+            return False
+        try:
+            if self._fd is None:
+                self._fd = os.open(self._filepath, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        except BaseException:
+            self._depth -= 1
+            self._lock.release()
+            raise
+        return True
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._lock.release()
+
+
+class RevisionHeader:
+    """
+    A store's revision and last id in a small memory mapped file, so
+    processes sharing the store can tell if their copy is stale with one
+    read of shared memory.
+    """
+    _FORMAT = '<qq'
+
+    def __init__(self, filepath):
+        size = struct.calcsize(self._FORMAT)
+        fd = os.open(filepath, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self._mmap = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+    def read(self):
+        """Returns (revision, last_id), both 0 for a new header"""
+        return struct.unpack_from(self._FORMAT, self._mmap)
+
+    def write(self, revision, last_id):
+        struct.pack_into(self._FORMAT, self._mmap, 0, revision, last_id)
+
+
+class _Batch:
+
+    def __init__(self):
+        self.writes = []
+        self.done = threading.Event()
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+
+
+class GroupCommitWriter:
+    """
+    Performs file writes with one of three durability levels:
+
+        request  --  each write is fsynced on the caller's thread
+        batch    --  writes arriving within `window` seconds of each other are
+                     written together by a background thread, with one fsync
+                     per file, and callers block until their batch is durable
+        async    --  as batch, but callers don't wait
+
+    Writes always go through a temp file and a rename, or an append, so a
+    crash never leaves a half written file behind.
+    """
+
+    def __init__(self, durability=DURABILITY_REQUEST, window=0.002):
+        if durability not in DURABILITY_LEVELS:
+            raise ValueError('Unknown durability: {}'.format(durability))
+        self.durability = durability
+        self._window = window
+        self._condition = threading.Condition()
+        self._batch = None
+        self._inflight = None
+        self._thread = None
+
+    def write(self, filepath, text, wait=None, on_written=None):
+        """Replaces the file's contents with text"""
+        self._submit(filepath, text, False, wait, on_written)
+
+    def append(self, filepath, text, wait=None, on_written=None):
+        self._submit(filepath, text, True, wait, on_written)
+
+    def flush(self):
+        """
+        Blocks until all writes submitted so far are on disk.
+        """
+        with self._condition:
+            batches = [b for b in (self._inflight, self._batch) if b is not None]
+        for batch in batches:
+            batch.wait()
+
+    def _submit(self, filepath, text, append, wait, on_written):
+        if self.durability == DURABILITY_REQUEST:
+            _write_batch([(filepath, text, append, on_written)])
+            return
+        with self._condition:
+            if self._batch is None:
+                self._batch = _Batch()
+            batch = self._batch
+            batch.writes.append((filepath, text, append, on_written))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        if wait or (wait is None and self.durability == DURABILITY_BATCH):
+            batch.wait()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._batch is None:
+                    self._condition.wait()
+            # Let writes from concurrent requests join the batch
+            time.sleep(self._window)
+            with self._condition:
+                batch = self._inflight = self._batch
+                self._batch = None
+            try:
+                _write_batch(batch.writes)
+            except Exception as e:
+                batch.error = e
+            finally:
+                with self._condition:
+                    self._inflight = None
+                batch.done.set()
+
+
+DEFAULT_WRITER = GroupCommitWriter()
+
+
 class JsonFileWrapper:
-    """Wrapper around a json file"""
+    """
+    Wrapper around a json file, which is only parsed again when it changed
+    on disk. Parse counts and times are kept in parse_count / parse_seconds.
+    """
 
-    def __init__(self, filepath, initial_data=None):
+    def __init__(self, filepath, initial_data=None, writer=None):
         if initial_data is None:
             initial_data = {}
         self._filepath = filepath
         self._must_reload = True
-        self._loaded_timestamp = None
+        self._tracker = DiskChangeTracker(filepath)
         self._data = initial_data
+        self._writer = writer or DEFAULT_WRITER
+        self.parse_count = 0
+        self.parse_seconds = 0.0
 
     def save(self, data=None):
         if data is None:
             data = self._data
-        with open(self._filepath, 'w') as fp:
-            ujson.dump(data, fp, indent=4)
+        with METRICS.timer('pointy_json_serialize_seconds'):
+            text = ujson.dumps(data, indent=4)
+        self.save_text(text)
+
+    def save_text(self, text, wait=None):
+        """Writes already serialized json"""
+        METRICS.inc('pointy_file_bytes_written_total', len(text))
+        self._tracker.write_started()
+        self._writer.write(self._filepath, text, wait, self._tracker.write_finished)
 
     def load(self, force=False):
         if force or self._must_reload or self._file_on_disk_changed():
             if not os.path.exists(self._filepath):
                 self.save()
+            self._writer.flush()
+            start = time.perf_counter()
             with open(self._filepath) as fp:
+                self._tracker.mark_read(fp)
                 self._data = ujson.load(fp)
+                METRICS.inc('pointy_file_bytes_read_total', fp.tell())
+            parse_seconds = time.perf_counter() - start
+            METRICS.observe('pointy_json_parse_seconds', parse_seconds)
+            self.parse_seconds += parse_seconds
+            self.parse_count += 1
             self._must_reload = False
         return self._data
 
+    def changed_on_disk(self):
+        return self._must_reload or self._file_on_disk_changed()
+
+    def size(self):
+        try:
+            return os.path.getsize(self._filepath)
+        except OSError:
+            return 0
+
     def _file_on_disk_changed(self):
-        # TODO: implement
-        return False
-        if self._loaded_timestamp is None:
-            return True
+        return self._tracker.changed()
+
+
+class CollectionFiles(collections.abc.MutableMapping):
+    """
+    The top level of a data tree kept as one json file per key in a
+    directory, used in place of a JsonFileWrapper for the data file:
+
+        records.json  --  data['records']
+        settings.json  --  data['settings']
+
+    load() returns the object itself, a mapping which parses each file on
+    first access. Collections changed in place must be passed to mark_dirty,
+    and save() only writes those (adding, replacing and deleting keys marks
+    them itself).
+
+    Changes on disk are detected from the directory, which any rename into
+    it (i.e. any save by another process) changes.
+    """
+
+    def __init__(self, dirpath, writer=None):
+        self._dirpath = dirpath
+        self._must_reload = True
+        self._tracker = DiskChangeTracker(dirpath)
+        self._writer = writer or DEFAULT_WRITER
+        # Size on disk of every collection, loaded or not
+        self._sizes = {}
+        self._loaded = {}
+        self._dirty = set()
+        self.parse_count = 0
+        self.parse_seconds = 0.0
+
+    def load(self, force=False):
+        if force or self._must_reload or self._tracker.changed():
+            os.makedirs(self._dirpath, exist_ok=True)
+            self._writer.flush()
+            self._tracker.mark_read()
+            self._sizes = {}
+            for entry in os.scandir(self._dirpath):
+                if entry.name.endswith('.json'):
+                    self._sizes[urllib.parse.unquote(entry.name[:-5])] = entry.stat().st_size
+            self._loaded = {}
+            self._dirty = set()
+            self._must_reload = False
+        return self
+
+    def mark_dirty(self, name):
+        self._dirty.add(name)
+
+    def save(self):
+        deleted = [name for name in self._dirty if name not in self._sizes]
+        if deleted:
+            # Don't let a queued write recreate the file after it's removed
+            self._writer.flush()
+            self._tracker.write_started()
+            try:
+                for name in deleted:
+                    try:
+                        os.remove(self._filepath(name))
+                    except FileNotFoundError:
+                        pass
+            finally:
+                self._tracker.write_finished()
+        for name in sorted(self._dirty.difference(deleted)):
+            with METRICS.timer('pointy_json_serialize_seconds'):
+                text = ujson.dumps(self[name], indent=4)
+            METRICS.inc('pointy_file_bytes_written_total', len(text))
+            self._sizes[name] = len(text)
+            self._tracker.write_started()
+            self._writer.write(self._filepath(name), text, on_written=self._tracker.write_finished)
+        self._dirty = set()
+
+    def changed_on_disk(self):
+        return self._must_reload or self._tracker.changed()
+
+    def size(self):
+        return sum(self._sizes.values())
+
+    def _filepath(self, name):
+        return os.path.join(self._dirpath, urllib.parse.quote(str(name), safe='') + '.json')
+
+    def __getitem__(self, name):
+        if name not in self._loaded:
+            if name not in self._sizes:
+                raise KeyError(name)
+            start = time.perf_counter()
+            with open(self._filepath(name)) as fp:
+                self._loaded[name] = ujson.load(fp)
+                METRICS.inc('pointy_file_bytes_read_total', fp.tell())
+            parse_seconds = time.perf_counter() - start
+            METRICS.observe('pointy_json_parse_seconds', parse_seconds)
+            self.parse_seconds += parse_seconds
+            self.parse_count += 1
+        return self._loaded[name]
+
+    def __setitem__(self, name, value):
+        self._loaded[name] = value
+        self._sizes.setdefault(name, 0)
+        self._dirty.add(name)
+
+    def __delitem__(self, name):
+        if name not in self._sizes:
+            raise KeyError(name)
+        del self._sizes[name]
+        self._loaded.pop(name, None)
+        self._dirty.add(name)
+
+    def __contains__(self, name):
+        return name in self._sizes
+
+    def __iter__(self):
+        return iter(list(self._sizes))
+
+    def __len__(self):
+        return len(self._sizes)
+
+
+class SerializedList(list):
+    """
+    A list which keeps its json serialization, so dumps_response and
+    iter_json_chunks don't serialize it again. It mustn't be changed.
+    """
+
+    def __init__(self, items=()):
+        super().__init__(items)
+        self.json = ujson.dumps(self)
+
+
+class SerializedDict(dict):
+    """
+    As SerializedList, for a dict.
+    """
+
+    def __init__(self, items=()):
+        super().__init__(items)
+        self.json = ujson.dumps(self)
+
+
+def dumps_response(value):
+    """
+    As ujson.dumps, but reusing the json of any SerializedList or
+    SerializedDict found directly or in dicts.
+    """
+    if isinstance(value, (SerializedList, SerializedDict)):
+        return value.json
+    if isinstance(value, dict):
+        return '{' + ','.join('{}:{}'.format(ujson.dumps(str(key)), dumps_response(item))
+                              for key, item in value.items()) + '}'
+    return ujson.dumps(value)
+
+
+def iter_json_chunks(value, chunk_size=64 * 1024):
+    """
+    Serializes value as json in chunks of roughly chunk_size characters.
+
+    Lists, dicts and scalars are serialized as usual, while any other
+    iterable (e.g. a generator of records) is written as a json array one
+    item at a time, so it is never held in memory in full.
+    """
+    return join_chunks(_iter_json_parts(value), chunk_size)
+
+
+def join_chunks(texts, chunk_size=64 * 1024):
+    """
+    Joins an iterable of (small) strings into chunks of roughly chunk_size
+    characters.
+    """
+    buffer = []
+    size = 0
+    for text in texts:
+        buffer.append(text)
+        size += len(text)
+        if size >= chunk_size:
+            yield ''.join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+def _iter_json_parts(value):
+    if isinstance(value, (SerializedList, SerializedDict)):
+        yield value.json
+    elif isinstance(value, collections.abc.Mapping):
+        yield '{'
+        for i, (key, item) in enumerate(value.items()):
+            yield '{}{}:'.format(',' if i else '', ujson.dumps(str(key)))
+            yield from _iter_json_parts(item)
+        yield '}'
+    elif isinstance(value, (list, tuple, str, bytes)) or not hasattr(value, '__iter__'):
+        yield ujson.dumps(value)
+    else:
+        yield '['
+        for i, item in enumerate(value):
+            if i:
+                yield ','
+            yield ujson.dumps(item)
+        yield ']'
+
+
+def iter_lines(read, chunk_size=64 * 1024):
+    """
+    Yields the lines of a byte stream as str, without line endings, holding
+    only a chunk at a time.
+
+    @read: a function taking a size and returning up to that many bytes,
+           or no bytes at the end.
+    """
+    buffer = b''
+    while True:
+        chunk = read(chunk_size)
+        if not chunk:
+            break
+        lines = (buffer + chunk).split(b'\n')
+        buffer = lines.pop()
+        for line in lines:
+            yield line.decode('utf-8')
+    if buffer:
+        yield buffer.decode('utf-8')
 
 
 def get_two_file_paths(base_path, database_name):
@@ -54,3 +593,85 @@ def get_two_file_paths(base_path, database_name):
     def path(suffix):
         return os.path.join(base_path, '{}_{}.json'.format(database_name, suffix))
     return path('data_db'), path('meta_db')
+
+
+class JsonLinesFile:
+    """
+    Append-only file of compact json lines.
+
+    The file can be rotated out of the way (e.g. while a snapshot is written
+    elsewhere), in which case reads return the rotated lines followed by the
+    current ones until the rotated file is discarded.
+    """
+
+    def __init__(self, filepath, writer=None):
+        self._filepath = filepath
+        self._rotated_filepath = filepath + '.rotated'
+        self._writer = writer or DEFAULT_WRITER
+        self._tracker = DiskChangeTracker(filepath)
+        self.parse_count = 0
+        self.parse_seconds = 0.0
+
+    def append(self, entries):
+        if not entries:
+            return
+        with METRICS.timer('pointy_json_serialize_seconds'):
+            lines = ''.join(ujson.dumps(entry) + '\n' for entry in entries)
+        METRICS.inc('pointy_file_bytes_written_total', len(lines))
+        self._tracker.write_started()
+        self._writer.append(self._filepath, lines, on_written=self._tracker.write_finished)
+
+    def rewrite(self, entries):
+        with METRICS.timer('pointy_json_serialize_seconds'):
+            lines = ''.join(ujson.dumps(entry) + '\n' for entry in entries)
+        METRICS.inc('pointy_file_bytes_written_total', len(lines))
+        self._tracker.write_started()
+        self._writer.write(self._filepath, lines, on_written=self._tracker.write_finished)
+
+    def read(self):
+        self._writer.flush()
+        self._tracker.mark_read()
+        start = time.perf_counter()
+        for filepath in (self._rotated_filepath, self._filepath):
+            if os.path.exists(filepath):
+                with open(filepath) as fp:
+                    for line in fp:
+                        METRICS.inc('pointy_file_bytes_read_total', len(line))
+                        try:
+                            yield ujson.loads(line)
+                        except ValueError:
+                            # A torn final line from a crash mid-append
+                            break
+        parse_seconds = time.perf_counter() - start
+        METRICS.observe('pointy_json_parse_seconds', parse_seconds)
+        self.parse_seconds += parse_seconds
+        self.parse_count += 1
+
+    def changed_on_disk(self):
+        return self._tracker.changed()
+
+    def size(self):
+        try:
+            return os.path.getsize(self._filepath)
+        except OSError:
+            return 0
+
+    def rotate(self):
+        """
+        Moves current lines to the rotated file, appending to any lines left
+        there by a rotation which was never discarded.
+        """
+        self._writer.flush()
+        if not os.path.exists(self._filepath):
+            return
+        if os.path.exists(self._rotated_filepath):
+            with open(self._filepath) as src, open(self._rotated_filepath, 'a') as dst:
+                dst.write(src.read())
+            os.remove(self._filepath)
+        else:
+            os.rename(self._filepath, self._rotated_filepath)
+        self._tracker.mark_read()
+
+    def discard_rotated(self):
+        if os.path.exists(self._rotated_filepath):
+            os.remove(self._rotated_filepath)